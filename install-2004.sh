@@ -25,6 +25,7 @@ apt-get install -y bc wget \
    uwsgi \
    uwsgi-plugin-asyncio-python3 \
    uwsgi-plugin-gevent-python3 \
+   uwsgi-plugin-greenlet-python3 \
    uwsgi-plugin-python3 \
    uwsgi-plugin-tornado-python3 \
    php-fpm \
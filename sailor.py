@@ -10,39 +10,39 @@ try:
 except AssertionError:
     exit("Sailor requires Python >= 3.6")
 
+# Only the modules every command needs are imported here. click, yaml, sqlite3,
+# urllib... are imported where they are used: 'sailor.py' runs for every clone,
+# fetch and push over SSH, and the git paths don't load them
 import sys
-import click
 import json
-import yaml
-import configparser
-from click import secho as echo
-from collections import defaultdict, deque
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
 from datetime import datetime
-from fcntl import fcntl, F_SETFL, F_GETFL
+from fcntl import fcntl, flock, F_SETFL, F_GETFL, LOCK_EX, LOCK_NB
 from glob import glob
-from hashlib import md5
-from multiprocessing import cpu_count
-from os import chmod, getgid, getuid, symlink, unlink, remove, stat, listdir, environ, makedirs, O_NONBLOCK
-from os.path import abspath, basename, dirname, exists, getmtime, join, realpath, splitext
+from hashlib import md5, sha256
+from io import StringIO
+from os import cpu_count, sysconf, chmod, fstat, getgid, getpid, getuid, rename, symlink, unlink, remove, stat, listdir, environ, makedirs, O_NONBLOCK
+from os.path import abspath, basename, dirname, exists, getmtime, getsize, isdir, islink, join, realpath, splitext
 from re import sub
 import re
 from shutil import copyfile, rmtree, which
-from socket import socket, AF_INET, SOCK_STREAM
+from signal import signal, SIGTERM
+from socket import socket, AF_INET, AF_UNIX, SOCK_STREAM
 from sys import argv, stdin, stdout, stderr, version_info, exit
 from stat import S_IRUSR, S_IWUSR, S_IXUSR
-from subprocess import call, check_output, Popen, STDOUT, PIPE
-from tempfile import NamedTemporaryFile
-from traceback import format_exc
-from time import sleep
-import urllib.request
-from urllib.request import urlopen
+import subprocess
+from subprocess import check_output, CalledProcessError, Popen, DEVNULL, STDOUT, PIPE
+from time import monotonic, sleep, time
 from pwd import getpwuid
 from grp import getgrgid
 
 # -----------------------------------------------------------------------------
 
 NAME = "Sailor"
-VERSION = "0.12.0" 
+VERSION = "0.13.0"
 VALID_RUNTIME = ["python", "node", "static", "shell"]
 
 
@@ -56,16 +56,119 @@ GIT_ROOT = abspath(join(DOT_ROOT, "repos"))
 LOG_ROOT = abspath(join(DOT_ROOT, "logs"))
 NGINX_ROOT = abspath(join(DOT_ROOT, "nginx"))
 METRICS_ROOT = abspath(join(DOT_ROOT, "metrics"))
+SERIES_ROOT = abspath(join(DOT_ROOT, "series"))
 SETTINGS_ROOT = abspath(join(DOT_ROOT, "settings"))
 UWSGI_AVAILABLE = abspath(join(DOT_ROOT, "uwsgi-available"))
 UWSGI_ENABLED = abspath(join(DOT_ROOT, "uwsgi-enabled"))
 UWSGI_ROOT = abspath(join(DOT_ROOT, "uwsgi"))
+RELEASES_ROOT = abspath(join(DOT_ROOT, "releases"))
+WHEELS_ROOT = abspath(join(DOT_ROOT, "wheels"))
+NPM_CACHE_ROOT = abspath(join(DOT_ROOT, "npm-cache"))
+LOCK_ROOT = abspath(join(DOT_ROOT, "locks"))
 
 ACME_ROOT = environ.get('ACME_ROOT', join(environ['HOME'], '.acme.sh'))
 ACME_WWW = abspath(join(DOT_ROOT, "acme"))
 UWSGI_LOG_MAXSIZE = '1048576'
-# deeploy info file
+# async cores per process for 'uwsgi.gevent: true' and 'uwsgi.asyncio: true'
+UWSGI_ASYNC_CORES = 100
+# where the Debian/Ubuntu uwsgi-plugin-* packages install the plugins
+UWSGI_PLUGINS_DIR = "/usr/lib/uwsgi/plugins"
+# uWSGI cheaper algorithms for 'process.<kind>.scaling.algo', the first one is the default
+UWSGI_CHEAPER_ALGOS = ["spare", "spare2", "backlog", "busyness"]
+# nginx reloads: incron watches the trigger file, reloads are at least NGINX_RELOAD_WINDOW seconds apart
+NGINX_RELOAD_TRIGGER = join(DOT_ROOT, "nginx.reload")
+NGINX_RELOAD_LOCK = join(DOT_ROOT, "nginx.lock")
+NGINX_VALIDATED = join(DOT_ROOT, "nginx.validated")
+NGINX_RELOAD_WINDOW = 2
+NGINX_MAIN_CONF = "/etc/nginx/nginx.conf"
+NGINX_MODULES_ENABLED = "/etc/nginx/modules-enabled"
+NGINX_QUIC_LISTEN = re.compile(r"^(\s*listen\s+)(\S+):443 quic( reuseport)?;", re.M)
+# resident agent serving CLI requests, commands fall back to running in-process when it is down
+AGENT_SOCKET = join(DOT_ROOT, "agent.sock")
+# import time budget of the git paths in ms, and the modules they must not load ('x:startup')
+STARTUP_IMPORT_BUDGET = 60
+STARTUP_LAZY_MODULES = ["click", "yaml", "sqlite3", "urllib", "configparser", "concurrent", "multiprocessing", "tempfile"]
+INTERNAL_COMMANDS = ["init", "git-hook", "git-upload-pack", "git-receive-pack", "deploy-queue"]
+# read-only commands only: the agent runs them on threads sharing the deploy locks, the nginx state and the
+# environment, commands changing apps (and their pip/npm/git output) run in the caller's own process
+AGENT_COMMANDS = ["ls", "info", "deploys", "autoscale", "metrics", "stats"]
+# autoscaler ('x:autoscale'): seconds between samples, default cooldown between changes of a process, decisions kept per app
+AUTOSCALE_INTERVAL = 30
+AUTOSCALE_COOLDOWN = 300
+AUTOSCALE_HISTORY = 1000
+# metrics history ('x:sampler'): seconds between samples, and samples kept per process (24h at 30s) in its ring buffer
+SAMPLE_INTERVAL = 30
+SERIES_SLOTS = 2880
+# time, requests, tx, cpu ticks, rss, latency (ms), busy (%), backlog, workers, processes
+SERIES_FIELDS = ["time", "requests", "tx", "cpu", "rss", "latency", "busy", "backlog", "workers", "processes"]
+SERIES_FORMAT = "<dQQQQffIHH"
+SERIES_MAGIC = b"SAILRNG1"
+# Prometheus exporter ('x:exporter'), localhost only by default
+EXPORTER_BIND = "127.0.0.1"
+EXPORTER_PORT = 9195
+# access lines of the wsgi/shell worker logs (the 'log-format' of spawn_worker), read back by 'stats'
+ACCESS_LOG_REGEXP = r'\[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<uri>\S+)[^"]*" (?P<status>\d{3}) (?P<size>\d+) .* (?P<msecs>\d+)ms\s*$'
+# 'log' checks the logs this often when inotify isn't available
+LOG_POLL_INTERVAL = 0.5
+# URIs kept by 'stats' for the slowest ones, the least seen are dropped past it
+STATS_URI_LIMIT = 5000
+# 'git push -o follow' gives up after this many seconds without a queue worker for the waiting push
+DEPLOY_FOLLOW_GRACE = 10
+# files listing the dependencies installed in ENV_ROOT, 'rollback' checks the releases agree on them
+DEPENDENCY_MANIFESTS = ["requirements.txt", "package.json", "package-lock.json"]
+# zero downtime deploys: the web worker ordinals of the second slot start at WEB_SLOT_SIZE + 1
+WEB_SLOT_SIZE = 100
+# deeploy info file (legacy, migrated into the state store)
 DEPLOYINFO_FILE = join(DOT_ROOT, "DEPLOYINFO")
+# state store: deploy info, settings, ports and deploy history
+STATE_DB_FILE = join(DOT_ROOT, "state.db")
+STATE_DB_VERSION = 6
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployinfo (
+    app TEXT NOT NULL, key TEXT NOT NULL, value TEXT,
+    PRIMARY KEY (app, key)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    app TEXT NOT NULL, section TEXT NOT NULL, key TEXT NOT NULL, value TEXT,
+    PRIMARY KEY (app, section, key)
+);
+CREATE TABLE IF NOT EXISTS ports (
+    app TEXT NOT NULL, kind TEXT NOT NULL, ordinal INTEGER NOT NULL, port INTEGER NOT NULL,
+    PRIMARY KEY (app, kind, ordinal)
+);
+CREATE TABLE IF NOT EXISTS deploys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    app TEXT NOT NULL, created TEXT NOT NULL, revision TEXT, outcome TEXT, data TEXT
+);
+CREATE INDEX IF NOT EXISTS deploys_app ON deploys (app, id);
+CREATE TABLE IF NOT EXISTS nginx_reloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    requested REAL NOT NULL, duration REAL NOT NULL, removed TEXT
+);
+CREATE TABLE IF NOT EXISTS probes (
+    name TEXT PRIMARY KEY, signature TEXT NOT NULL, data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deploy_queue (
+    app TEXT PRIMARY KEY, revision TEXT NOT NULL, queued TEXT NOT NULL, coalesced INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS autoscale (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    app TEXT NOT NULL, kind TEXT NOT NULL, created TEXT NOT NULL, action TEXT NOT NULL, data TEXT
+);
+CREATE INDEX IF NOT EXISTS autoscale_app ON autoscale (app, kind, id);
+CREATE TABLE IF NOT EXISTS releases (
+    app TEXT NOT NULL, name TEXT NOT NULL, activated REAL NOT NULL,
+    PRIMARY KEY (app, name)
+);
+"""
+# one connection per thread
+_STATE_DB = threading.local()
+# per-app deploy locks held by this process
+_DEPLOY_LOCKS = {}
+# nginx confs changed by this process and not yet reloaded
+_NGINX_PENDING = {"changed": None}
+# bulk commands write confs and reload from several threads
+_NGINX_PENDING_LOCK = threading.Lock()
 
 if 'sbin' not in environ['PATH']:
     environ['PATH'] = "/usr/local/sbin:/usr/sbin:/sbin:" + environ['PATH']
@@ -73,6 +176,11 @@ if 'sbin' not in environ['PATH']:
 if BOX_BIN not in environ['PATH']:
     environ['PATH'] = BOX_BIN + ":" + environ['PATH']
 
+# parsed sailor.yml, keyed by path -> (signature, data)
+_CONFIG_CACHE = {}
+# nginx capabilities, keyed by the signature of the nginx binary
+_NGINX_CAPABILITIES = {}
+
 CRON_REGEXP = "^((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) (.*)$"
 
 
@@ -83,9 +191,18 @@ CRON_REGEXP = "^((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*
 SKIP_NGINX_USE_UWSGI_SERVER_NAME = "_"
 
 # NGINX
+# load balancing of the web workers: 'nginx.balance'
+NGINX_BALANCE_METHODS = {
+    "round_robin": "",
+    "least_conn": "least_conn;",
+    "ip_hash": "ip_hash;",
+    "hash": "hash $remote_addr consistent;",
+}
+
 NGINX_TEMPLATE = """
+$INTERNAL_NGINX_MAPS
 upstream $APP {
-  server $NGINX_SOCKET;
+$INTERNAL_NGINX_UPSTREAM
 }
 server {
   listen              $NGINX_IPV6_ADDRESS:80;
@@ -101,8 +218,9 @@ $INTERNAL_NGINX_COMMON
 """
 
 NGINX_HTTPS_ONLY_TEMPLATE = """
+$INTERNAL_NGINX_MAPS
 upstream $APP {
-  server $NGINX_SOCKET;
+$INTERNAL_NGINX_UPSTREAM
 }
 server {
   listen              $NGINX_IPV6_ADDRESS:80;
@@ -127,6 +245,7 @@ $INTERNAL_NGINX_COMMON
 NGINX_COMMON_FRAGMENT = """
   listen              $NGINX_IPV6_ADDRESS:$NGINX_SSL;
   listen              $NGINX_IPV4_ADDRESS:$NGINX_SSL;
+  $INTERNAL_NGINX_PROTOCOLS
   ssl_certificate     $NGINX_ROOT/$APP.crt;
   ssl_certificate_key $NGINX_ROOT/$APP.key;
   server_name         $NGINX_SERVER_NAME;
@@ -139,6 +258,7 @@ NGINX_COMMON_FRAGMENT = """
   gzip_min_length 2048;
   gzip_vary on;
   gzip_disable "MSIE [1-6]\.(?!.*SV1)";
+  $INTERNAL_NGINX_COMPRESSION
 
   $INTERNAL_NGINX_CUSTOM_CLAUSES
 
@@ -154,12 +274,36 @@ NGINX_PORTMAP_FRAGMENT = """
     $INTERNAL_NGINX_UWSGI_SETTINGS
     proxy_http_version 1.1;
     proxy_set_header Upgrade $http_upgrade;
-    proxy_set_header Connection "upgrade";
+    proxy_set_header Connection $INTERNAL_NGINX_CONNECTION;
     proxy_set_header Host $http_host;
     proxy_set_header X-Forwarded-Proto $scheme;
     proxy_set_header X-Forwarded-For $remote_addr;
     proxy_set_header X-Forwarded-Port $server_port;
     proxy_set_header X-Request-Start $msec;
+    $INTERNAL_NGINX_EARLY_DATA
+    $NGINX_ACL
+  }
+"""
+
+# 'Connection' header sent upstream: 'upgrade' for websockets, empty so other requests reuse pooled connections
+INTERNAL_NGINX_CONNECTION_MAP = """
+map $http_upgrade $connection_var {
+  default upgrade;
+  ''      '';
+}
+"""
+
+# nginx -> uWSGI over a unix socket, with the uwsgi protocol ('uwsgi.unix_socket: true')
+NGINX_UWSGI_PORTMAP_FRAGMENT = """
+  location    / {
+    $INTERNAL_NGINX_UWSGI_SETTINGS
+    uwsgi_param HTTPS $https if_not_empty;
+    uwsgi_param UWSGI_SCHEME $scheme;
+    uwsgi_param HTTP_X_FORWARDED_PROTO $scheme;
+    uwsgi_param HTTP_X_FORWARDED_FOR $remote_addr;
+    uwsgi_param HTTP_X_FORWARDED_PORT $server_port;
+    uwsgi_param HTTP_X_REQUEST_START $msec;
+    $INTERNAL_NGINX_EARLY_DATA
     $NGINX_ACL
   }
 """
@@ -182,11 +326,19 @@ INTERNAL_NGINX_STATIC_MAPPING = """
       sendfile_max_chunk 1m;
       tcp_nopush on;
       directio 8m;
-      aio threads;
+      $nginx_aio
       alias $static_path;
   }
 """
 
+# brotli next to gzip, when nginx has the module ('nginx.brotli: false' to disable)
+INTERNAL_NGINX_BROTLI = """
+  brotli on;
+  brotli_comp_level 5;
+  brotli_min_length 2048;
+  brotli_types text/plain text/xml text/css application/javascript application/x-javascript text/javascript application/json application/xml+rss application/atom+xml;
+"""
+
 INTERNAL_NGINX_UWSGI_SETTINGS = """
     uwsgi_pass $APP;
     uwsgi_param QUERY_STRING $query_string;
@@ -229,6 +381,11 @@ INTERNAL_NGINX_STATIC_CLAUSES = """
 """
 # -----------------------------------------------------------------------------
 
+def echo(message=None, **styles):
+    """ click.secho, click is loaded by the first command printing something """
+    from click import secho
+    secho(message, **styles)
+
 def utcnow():
     return datetime.utcnow()
   
@@ -289,50 +446,218 @@ def install_acme_sh():
     call("curl https://get.acme.sh | sh -s", cwd=BOX_ROOT, shell=True)
 
 
+def state_db():
+    """
+    Return the connection to the state store (SQLite in WAL mode).
+    It holds deploy info, settings, port assignments and deploy history
+    """
+    if getattr(_STATE_DB, "db", None) is None:
+        if not exists(DOT_ROOT):
+            makedirs(DOT_ROOT)
+        import sqlite3
+        db = sqlite3.connect(STATE_DB_FILE, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        migrated = []
+        with state_transaction(db):
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version < STATE_DB_VERSION:
+                for statement in STATE_DB_SCHEMA.split(";"):
+                    db.execute(statement)
+                if version == 0:
+                    migrated = _migrate_ini_state(db)
+                db.execute("PRAGMA user_version = %d" % STATE_DB_VERSION)
+        # keep the legacy files around, out of the way
+        for f in migrated:
+            rename(f, f + ".migrated")
+        _STATE_DB.db = db
+    return _STATE_DB.db
+
+@contextmanager
+def state_transaction(db=None):
+    """ 'BEGIN IMMEDIATE' transaction, serializing writers across processes """
+    db = db or state_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def _migrate_ini_state(db):
+    """ Import the legacy DEPLOYINFO and settings/<app>/ENV INI files, return the files imported """
+    def read_ini(ini_file):
+        import configparser
+        config = configparser.ConfigParser(interpolation=None)
+        config.optionxform = str
+        config.read(ini_file)
+        return config
+
+    migrated = []
+    if exists(DEPLOYINFO_FILE):
+        config = read_ini(DEPLOYINFO_FILE)
+        for app in config.sections():
+            _upsert_deployinfo(db, app, dict(config.items(app)))
+        migrated.append(DEPLOYINFO_FILE)
+
+    if exists(SETTINGS_ROOT):
+        for app in listdir(SETTINGS_ROOT):
+            env_file = join(SETTINGS_ROOT, app, "ENV")
+            if exists(env_file):
+                config = read_ini(env_file)
+                for section in config.sections():
+                    _upsert_settings(db, app, section, dict(config.items(section)))
+                migrated.append(env_file)
+    return migrated
+
+def _upsert_deployinfo(db, app, props):
+    db.executemany("""INSERT INTO deployinfo (app, key, value) VALUES (?, ?, ?)
+        ON CONFLICT (app, key) DO UPDATE SET value = excluded.value""",
+        [(app, k, str(v)) for k, v in props.items()])
+
+def _upsert_settings(db, app, section, data):
+    db.executemany("""INSERT INTO settings (app, section, key, value) VALUES (?, ?, ?, ?)
+        ON CONFLICT (app, section, key) DO UPDATE SET value = excluded.value""",
+        [(app, section, k, str(v)) for k, v in data.items()])
+
 def write_deployinfo(app, props:dict):
     """ To write deploy info  """
-    config = configparser.ConfigParser()   
-    config.optionxform = str
-    if exists(DEPLOYINFO_FILE):          
-      config.read(DEPLOYINFO_FILE)
-    if not config.has_section(app):
-      config.add_section(app)
-    for k, v in props.items():
-      config.set(app, k, str(v))
-    with open(DEPLOYINFO_FILE, "w+") as f:
-        config.write(f)    
-    
+    with state_transaction() as db:
+        _upsert_deployinfo(db, app, props)
+
 def read_deployinfo(app):
     """ To read deploy info """
-    config = configparser.ConfigParser()  
-    config.optionxform = str           
-    if exists(DEPLOYINFO_FILE):          
-      config.read(DEPLOYINFO_FILE)
-    if config.has_section(app):
-      return {o: config.get(app, o) for o in config.options(app)}
-    return {}
-
-def _get_env(app):
-    env_file = join(SETTINGS_ROOT, app, "ENV")
-    if not exists(env_file):
-        with open(env_file, 'w') as f:
-            f.write('')
-    config = configparser.ConfigParser() 
-    config.optionxform = str              
-    config.read(env_file)
-    return config
+    rows = state_db().execute("SELECT key, value FROM deployinfo WHERE app = ? ORDER BY rowid", (app,))
+    return {k: v for k, v in rows}
 
 def read_settings(app, section):
-    data = json.loads(json.dumps(_get_env(app)._sections.get(section)))
-    return {} if not data else data
+    rows = state_db().execute("SELECT key, value FROM settings WHERE app = ? AND section = ? ORDER BY rowid", (app, section))
+    return {k: v for k, v in rows}
 
 def write_settings(app, section, data):
-    env_file = join(SETTINGS_ROOT, app, "ENV")
-    env = _get_env(app)
-    if section not in env:
-        env.add_section(section)
-    [env.set(section, k.upper(), str(v)) for k,v in data.items()]
-    env.write(open(env_file, "w"))
+    with state_transaction() as db:
+        _upsert_settings(db, app, section, {k.upper(): v for k, v in data.items()})
+
+def replace_settings(app, section, data):
+    """ Set a section of the settings of an app to exactly 'data' (ie: read back with read_settings) """
+    with state_transaction() as db:
+        db.execute("DELETE FROM settings WHERE app = ? AND section = ?", (app, section))
+        _upsert_settings(db, app, section, data)
+
+def delete_settings(app):
+    """ Remove all the settings of an app """
+    with state_transaction() as db:
+        db.execute("DELETE FROM settings WHERE app = ?", (app,))
+
+def delete_app_state(app):
+    """ Remove the deploy info, port assignments and release order of an app, its deploy history stays """
+    with state_transaction() as db:
+        for table in ("deployinfo", "ports", "releases"):
+            db.execute("DELETE FROM %s WHERE app = ?" % table, (app,))
+
+def read_ports(app, kind=None):
+    """ Return the ports assigned to an app, as {(kind, ordinal): port} """
+    sql, args = "SELECT kind, ordinal, port FROM ports WHERE app = ?", [app]
+    if kind:
+        sql, args = sql + " AND kind = ?", args + [kind]
+    return {(k, o): p for k, o, p in state_db().execute(sql + " ORDER BY kind, ordinal", args)}
+
+def write_port(app, kind, ordinal, port):
+    with state_transaction() as db:
+        db.execute("""INSERT INTO ports (app, kind, ordinal, port) VALUES (?, ?, ?, ?)
+            ON CONFLICT (app, kind, ordinal) DO UPDATE SET port = excluded.port""", (app, kind, ordinal, int(port)))
+
+def write_release_activated(app, name):
+    """ Record that a release of an app was made the current one """
+    with state_transaction() as db:
+        db.execute("""INSERT INTO releases (app, name, activated) VALUES (?, ?, ?)
+            ON CONFLICT (app, name) DO UPDATE SET activated = excluded.activated""", (app, name, time()))
+
+def read_releases_activated(app):
+    """ Return {release name: when it was last made current} for an app """
+    return dict(state_db().execute("SELECT name, activated FROM releases WHERE app = ?", (app,)))
+
+def delete_release(app, name):
+    with state_transaction() as db:
+        db.execute("DELETE FROM releases WHERE app = ? AND name = ?", (app, name))
+
+def add_deploy_history(app, props:dict):
+    """ Append a deploy record to the app history """
+    props = dict(props)
+    props.setdefault("created", utcnow())
+    with state_transaction() as db:
+        db.execute("INSERT INTO deploys (app, created, revision, outcome, data) VALUES (?, ?, ?, ?, ?)",
+                   (app, str(props["created"]), props.get("revision"), props.get("outcome"), json.dumps(props, default=str)))
+
+def read_deploy_history(app, limit=20):
+    """ Return the latest deploy records of an app, newest first """
+    rows = state_db().execute("SELECT data FROM deploys WHERE app = ? ORDER BY id DESC LIMIT ?", (app, limit))
+    return [json.loads(data) for data, in rows]
+
+def add_autoscale_decision(app, kind, action, props:dict):
+    """ Log a decision of the autoscaler, keeping the last AUTOSCALE_HISTORY ones of the app """
+    props = dict(props, kind=kind, action=action)
+    props.setdefault("created", utcnow())
+    props.setdefault("time", time())
+    with state_transaction() as db:
+        db.execute("INSERT INTO autoscale (app, kind, created, action, data) VALUES (?, ?, ?, ?, ?)",
+                   (app, kind, str(props["created"]), action, json.dumps(props, default=str)))
+        db.execute("DELETE FROM autoscale WHERE app = ? AND id <= "
+                   "(SELECT id FROM autoscale WHERE app = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                   (app, app, AUTOSCALE_HISTORY))
+
+def read_autoscale_decisions(app, limit=20, kind=None, actions=None):
+    """ Return the latest decisions of the autoscaler for an app, newest first """
+    query, params = "SELECT data FROM autoscale WHERE app = ?", [app]
+    if kind:
+        query, params = query + " AND kind = ?", params + [kind]
+    if actions:
+        query, params = query + " AND action IN (%s)" % ",".join("?" * len(actions)), params + list(actions)
+    rows = state_db().execute(query + " ORDER BY id DESC LIMIT ?", params + [limit])
+    return [json.loads(data) for data, in rows]
+
+def enqueue_deploy(app, rev):
+    """ Queue a revision for deploy, replacing the one still waiting. Returns how many were coalesced """
+    with state_transaction() as db:
+        row = db.execute("SELECT coalesced FROM deploy_queue WHERE app = ?", (app,)).fetchone()
+        coalesced = row[0] + 1 if row else 0
+        db.execute("INSERT OR REPLACE INTO deploy_queue (app, revision, queued, coalesced) VALUES (?, ?, ?, ?)",
+                   (app, rev, str(utcnow()), coalesced))
+    return coalesced
+
+def pop_queued_deploy(app):
+    """ Take the revision waiting for deploy: (revision, coalesced) or None """
+    with state_transaction() as db:
+        row = db.execute("SELECT revision, coalesced FROM deploy_queue WHERE app = ?", (app,)).fetchone()
+        if row:
+            db.execute("DELETE FROM deploy_queue WHERE app = ?", (app,))
+    return row
+
+def read_queued_deploy(app):
+    """ Return the revision waiting for deploy, or None """
+    row = state_db().execute("SELECT revision FROM deploy_queue WHERE app = ?", (app,)).fetchone()
+    return row[0] if row else None
+
+def read_probe(name, signature):
+    """ Return the cached result of a probe, None if missing or taken for another signature """
+    row = state_db().execute("SELECT data FROM probes WHERE name = ? AND signature = ?", (name, signature)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def write_probe(name, signature, data):
+    with state_transaction() as db:
+        db.execute("INSERT OR REPLACE INTO probes (name, signature, data) VALUES (?, ?, ?)", (name, signature, json.dumps(data)))
+
+def add_nginx_reload(requested, duration, removed):
+    with state_transaction() as db:
+        db.execute("INSERT INTO nginx_reloads (requested, duration, removed) VALUES (?, ?, ?)",
+                   (requested, duration, ",".join(removed)))
+
+def read_nginx_reload_stats():
+    """ Return the count, last request time and durations of the nginx reloads """
+    count, last, avg = state_db().execute("SELECT COUNT(*), MAX(requested), AVG(duration) FROM nginx_reloads").fetchone()
+    row = state_db().execute("SELECT duration FROM nginx_reloads ORDER BY id DESC LIMIT 1").fetchone()
+    return {"count": count, "last": last, "avg_duration": avg, "last_duration": row[0] if row else None}
 
 def expandvars(buffer, env, default=None, skip_escaped=False):
     """expand shell-style environment variables in a buffer"""
@@ -351,6 +676,50 @@ def command_output(cmd):
     except:
         return ""
 
+def nginx_capabilities():
+    """
+    What the local nginx supports. The probe runs 'nginx -V' once, its result
+    is kept in the state store until the nginx binary or its enabled modules change
+    """
+    binary = which("nginx")
+    if not binary:
+        return {}
+    binary = realpath(binary)
+    st = stat(binary)
+    signature = "%s:%d:%d:%d" % (binary, st.st_ino, st.st_mtime_ns, st.st_size)
+    # dynamic modules are enabled by links in modules-enabled, loaded from nginx.conf
+    for path in (NGINX_MODULES_ENABLED, NGINX_MAIN_CONF):
+        signature += ":%d" % (stat(path).st_mtime_ns if exists(path) else 0)
+    if signature not in _NGINX_CAPABILITIES:
+        capabilities = read_probe("nginx", signature)
+        if capabilities is None:
+            capabilities = probe_nginx(command_output("nginx -V"))
+            write_probe("nginx", signature, capabilities)
+        _NGINX_CAPABILITIES[signature] = capabilities
+    return _NGINX_CAPABILITIES[signature]
+
+def probe_nginx(output):
+    """ Features of an nginx build, from the output of 'nginx -V' """
+    def version_of(pattern):
+        match = re.search(pattern, output)
+        return tuple(map(int, match.groups())) if match else (0, 0, 0)
+
+    version = version_of(r"nginx/(\d+)\.(\d+)\.(\d+)")
+    openssl = version_of(r"built with OpenSSL (\d+)\.(\d+)\.(\d+)")
+    # dynamic modules (ie: distro packages) are loaded from modules-enabled
+    modules_enabled = " ".join(listdir(NGINX_MODULES_ENABLED)) if exists(NGINX_MODULES_ENABLED) else ""
+    return {
+        "version": ".".join(map(str, version)),
+        "http2": "--with-http_v2_module" in output,
+        # 'listen ... http2' is deprecated by 'http2 on;' since 1.25.1
+        "http2_directive": version >= (1, 25, 1),
+        "spdy": "--with-http_spdy_module" in output and version != (1, 6, 2),
+        "http3": "--with-http_v3_module" in output,
+        "brotli": bool(re.search(r"--add-module=\S*brotli", output)) or "brotli" in modules_enabled,
+        "aio_threads": "--with-threads" in output,
+        "ssl_early_data": "--with-http_ssl_module" in output and version >= (1, 15, 3) and openssl >= (1, 1, 1),
+    }
+
 def parse_settings(filename, env={}):
     """Parses a settings file and returns a dict with environment variables"""
     if not exists(filename):
@@ -367,10 +736,31 @@ def parse_settings(filename, env={}):
                 return {}
     return env
 
-def get_config(app):
-    """ Return the info from sailor.yml """
-    config_file = join(APP_ROOT, app, "sailor.yml")
+def _config_signature(config_file):
+    """ Identify a version of a file by inode, mtime and size """
+    st = stat(config_file)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
+def _cached_config(app, key, loader):
+    """
+    Memoize data derived from an app's sailor.yml.
+    Entries are dropped as soon as the file signature changes,
+    ie: after a 'git reset --hard' that touches sailor.yml
+    """
+    config_file = join(APP_ROOT, app, "sailor.yml")
+    signature = _config_signature(config_file)
+    cached = _CONFIG_CACHE.get(config_file)
+    if not cached or cached[0] != signature:
+        cached = (signature, {})
+        _CONFIG_CACHE[config_file] = cached
+    if key not in cached[1]:
+        cached[1][key] = loader()
+    # callers get their own copy, the cached value is never mutated
+    return deepcopy(cached[1][key])
+
+def _load_config(app):
+    import yaml
+    config_file = join(APP_ROOT, app, "sailor.yml")
     with open(config_file) as f:
         config = yaml.safe_load(f)["apps"]
         for c in config:
@@ -378,11 +768,18 @@ def get_config(app):
                 return c
         _error("App '%s' is missing or didn't match any app 'name' in sailor.yml." % app)
 
+def get_config(app):
+    """ Return the info from sailor.yml """
+    return _cached_config(app, "config", lambda: _load_config(app))
+
 def get_app_processes(app):
     """ Returns the applications to run """
     return {k.lower(): v  for k,v in get_config(app).get('process', {}).items()}
 
 def parse_app_processes(app):
+    return _cached_config(app, "processes", lambda: _parse_app_processes(app))
+
+def _parse_app_processes(app):
     approc = get_app_processes(app)
     proc = {}
     for k, v in approc.items():
@@ -434,7 +831,9 @@ def parse_app_processes(app):
 
 def get_app_config(app):
     """ Turn config into ENV """
+    return _cached_config(app, "app_config", lambda: _get_app_config(app))
 
+def _get_app_config(app):
     config = get_config(app)
 
     if "process" not in config:
@@ -489,12 +888,10 @@ def get_app_config(app):
 
 def sanitize_config_data(config):
     env = {}
-    # keys to remove from the config
-    for k in ["env", "scripts", "process"]:
-        if k in config:
-            del config[k]
-
     for k, v in config.items():
+        # keys to skip from the config
+        if k in ["env", "scripts", "process"]:
+            continue
         if isinstance(v, dict):
             env.update({("%s_%s" % (k, vk)).upper(): vv for vk, vv in v.items()})
         else:
@@ -502,33 +899,44 @@ def sanitize_config_data(config):
     return env
 
 def get_app_env(app):
-    return get_config(app).get("env", {})
+    return get_config(app).get("env") or {}
 
 def human_size(fsize, units=[' bytes','KB','MB','GB','TB', 'PB', 'EB']): 
     return "{:.2f}{}".format(float(fsize), units[0]) if fsize < 1024 else human_size(fsize / 1024, units[1:])
 
+def get_metrics_dir(app, kind, ordinal=1):
+    """ The uWSGI metrics-dir of a worker, each one has its own so they don't overwrite each other """
+    return join(METRICS_ROOT, app, "%s.%d" % (kind, ordinal))
+
+def read_app_metrics(app, names=None):
+    """
+    The raw values of the uWSGI metrics of an app, {name: int}, summed over the metrics-dir
+    of its workers (averaged for the avg_* ones). Metrics which are missing or not written yet are left out
+    """
+    app_dir = join(METRICS_ROOT, app)
+    values = defaultdict(list)
+    for worker in (listdir(app_dir) if exists(app_dir) else []):
+        metrics_dir = join(app_dir, worker)
+        if not isdir(metrics_dir):
+            continue
+        for name in names if names is not None else listdir(metrics_dir):
+            try:
+                with open(join(metrics_dir, name)) as f:
+                    v = f.read().strip("\x00 \n").split("\n")
+                values[name].append(int(v[0]))
+            except (OSError, ValueError):
+                pass
+    return {name: sum(v) // len(v) if "avg" in name else sum(v) for name, v in values.items()}
+
 def get_app_metrics(app):
-    metrics_dir = join(METRICS_ROOT, app)
     met = {
         "avg": "core.avg_response_time",
         "rss": "rss_size",
         "vsz": "vsz_size",
         "tx":  "core.total_tx"
     }
-    metrics = {}
-    for fk, fv in met.items():
-        f2 = join(metrics_dir, fv)
-        try:
-            if exists(f2):
-                with open(f2) as f:
-                    v = f.read().strip().split("\n")
-                    metrics[fk] = human_size(int(v[0])) if len(v) > 1 else "-"
-            else:
-                metrics[fk] = "-"            
-        except:
-            pass
-
-    return metrics
+    values = read_app_metrics(app, met.values())
+    return {fk: human_size(values[fv]) if fv in values else "-" for fk, fv in met.items()}
     
 def get_app_runtime(app):
     app_path = join(APP_ROOT, app)
@@ -564,7 +972,123 @@ def run_app_scripts(app, script_type):
         for cmd in scripts:
             call(cmd, cwd=cwd, env=env, shell=True)
 
+@contextmanager
+def deploy_phase(phases, name):
+    """ Time a deploy phase with a monotonic clock, in seconds """
+    started = monotonic()
+    try:
+        yield
+    finally:
+        phases[name] = round(monotonic() - started, 3)
+
+
+def print_deploy_phases(phases, outcome):
+    """ Print where a deploy spent its time """
+    total = sum(phases.values())
+    echo("-------> Deploy {} in {:.2f}s".format("finished" if outcome == "deployed" else outcome, total), fg="green" if outcome == "deployed" else "red")
+    for name, duration in phases.items():
+        share = (duration / total * 100) if total else 0
+        echo("         {:<20} {:>8.2f}s {:>5.1f}%".format(name, duration, share))
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(int(-(-pct * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+@contextmanager
+def deploy_lock(app, blocking=True):
+    """
+    Per-app lock serializing deploys across sailor processes.
+    Yields False if it is held elsewhere and blocking is False
+    """
+    if app in _DEPLOY_LOCKS:
+        yield True
+        return
+    makedirs(LOCK_ROOT, exist_ok=True)
+    with open(join(LOCK_ROOT, "%s.deploy" % app), "a") as lock:
+        try:
+            flock(lock, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            if not blocking:
+                yield False
+                return
+            echo("-------> waiting for the running deploy of '{}'".format(app), fg="yellow")
+            flock(lock, LOCK_EX)
+        _DEPLOY_LOCKS[app] = lock
+        try:
+            yield True
+        finally:
+            del _DEPLOY_LOCKS[app]
+
+
+@contextmanager
+def queue_lock(app):
+    """
+    Per-app lock held by the process draining the deploy queue, only one does.
+    Yields False if another queue worker holds it
+    """
+    makedirs(LOCK_ROOT, exist_ok=True)
+    with open(join(LOCK_ROOT, "%s.queue" % app), "a") as lock:
+        try:
+            flock(lock, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def is_draining_queue(app):
+    """ Whether a queue worker is running for the app """
+    with queue_lock(app) as locked:
+        return not locked
+
+
+def run_deploy_queue(app):
+    """
+    Deploy the queued revisions of an app until its queue is empty.
+    Pushes received while a deploy runs are coalesced, only the latest one is built
+    """
+    app_path = join(APP_ROOT, app)
+    while True:
+        with queue_lock(app) as locked:
+            if not locked:
+                # the queue worker holding the lock picks up our revision, it checks the queue after unlocking
+                return
+            # wait for whatever else holds the app (scale, rollback, the autoscaler...), they don't drain the queue
+            with deploy_lock(app):
+                for rev, coalesced in iter(lambda: pop_queued_deploy(app), None):
+                    if coalesced:
+                        echo("-------> skipped {} intermediate push(es), deploying '{}'".format(coalesced, rev[:12]), fg='yellow')
+                    if not exists(app_path):
+                        write_deployinfo(app, {"created": utcnow()})
+                        echo("-------> Creating app '{}'".format(app), fg='green')
+                        build_release(app, rev)
+                    try:
+                        deploy_app(app, newrev=rev, release=True)
+                    except SystemExit:
+                        # recorded as failed, keep going with the next push
+                        pass
+                    except Exception:
+                        from traceback import format_exc
+                        echo(format_exc(), fg="red")
+                    reload_nginx()
+        # a push may have been queued between the last pop and the unlock
+        if not read_queued_deploy(app):
+            return
+
+
 def deploy_app(app, deltas={}, newrev=None, release=False):
+    """Deploy an app, one deploy at a time per app"""
+    with deploy_lock(app):
+        _deploy_app(app, deltas=deltas, newrev=newrev, release=release)
+
+
+def _deploy_app(app, deltas={}, newrev=None, release=False):
     """Deploy an app by resetting the work directory"""
 
     app_path = join(APP_ROOT, app)
@@ -574,79 +1098,241 @@ def deploy_app(app, deltas={}, newrev=None, release=False):
     # list of paths that must exist
     ensure_paths = [env_path, log_path, conf_path]
     
-    env = {
-        'GIT_WORK_DIR': app_path
-    }
+    env = git_env(GIT_WORK_DIR=app_path)
 
     if exists(app_path):
         echo("-------> Deploying app '{}'".format(app), fg='green')
-        call('git fetch --quiet', cwd=app_path, env=env, shell=True)
-        if newrev:
-            write_deployinfo(app, {"revision": newrev, "received": utcnow(), "deployed": 0, "stopped": 0})
-            call('git reset --hard {}'.format(newrev), cwd=app_path, env=env, shell=True)
-        write_deployinfo(app, {"deployed": utcnow(), "stopped": 0})    
-        call('git submodule init', cwd=app_path, env=env, shell=True)
-        call('git submodule update', cwd=app_path, env=env, shell=True)
-
-        config = get_config(app)
-        workers = parse_app_processes(app)
-    
-        if not config:
-            _error("Invalid sailor.yml for app '%s'." % app)
-
-        elif not workers:
-            _error("Invalid sailor.yml - missing 'processes'")
-        else:
-            # ensure path exist
-            for p in ensure_paths:
-                if not exists(p):
-                    makedirs(p)            
-
-            runtime = get_app_runtime(app)
-            env2 = get_app_config(app)
+        # zero downtime: the new revision is built beside the running one
+        zero_downtime = bool(newrev) and is_zero_downtime(app, newrev)
+        previous_release = None
+        phases = {}
+        outcome = "failed"
+        try:
+            if newrev:
+                # every push gets its own release, the running one is left untouched
+                write_deployinfo(app, {"revision": newrev, "received": utcnow(), "deployed": 0, "stopped": 0})
+                with deploy_phase(phases, "release:build"):
+                    previous_release = build_release(app, newrev)
+            elif not islink(app_path):
+                with deploy_phase(phases, "git:fetch"):
+                    call('git fetch --quiet', cwd=app_path, env=env, shell=True)
+                with deploy_phase(phases, "git:submodules"):
+                    call('git submodule init', cwd=app_path, env=env, shell=True)
+                    call('git submodule update', cwd=app_path, env=env, shell=True)
+            write_deployinfo(app, {"deployed": utcnow(), "stopped": 0})    
+
+            config = get_config(app)
+            workers = parse_app_processes(app)
+        
+            if not config:
+                _error("Invalid sailor.yml for app '%s'." % app)
 
-            if not runtime:
-                echo("-------> Could not detect runtime!", fg="red")
+            elif not workers:
+                _error("Invalid sailor.yml - missing 'processes'")
             else:
-                echo("-------> [%s] app detected." % runtime.upper(), fg="green")
-
-                # Sanity check
-                if "web" in workers:
-                    # domain name
-                    if "NGINX_SERVER_NAME" not in env2:
-                        _error("missing 'server_name' when there is a 'web' process")
-
-                    if runtime == "static":
-                        _cmd = workers["web"].get("cmd")
-                        if not _cmd or not _cmd.startswith("/"):
-                            _error("for static site the webroot must start with a '/' (slash), instead '%s' provided" % _cmd)
-                  
-                # Setup runtime
-                # python
-                if runtime == "python":
-                    setup_python_runtime(app, deltas)
-                    
-                # node
-                elif runtime == "node":
-                    setup_node_runtime(app, deltas)
-                    
-                # static html/php, shell
-                elif runtime in ["static", "shell"]:
-                    setup_shell_runtime(app, deltas)
+                # ensure path exist
+                for p in ensure_paths:
+                    if not exists(p):
+                        makedirs(p)            
 
-                # Scripts ==
-                
-                # Once on git push
-                if release is True:
-                    run_app_scripts(app, "release")
+                runtime = get_app_runtime(app)
+                env2 = get_app_config(app)
+
+                if not runtime:
+                    echo("-------> Could not detect runtime!", fg="red")
+                else:
+                    echo("-------> [%s] app detected." % runtime.upper(), fg="green")
+
+                    # Sanity check
+                    if "web" in workers:
+                        # domain name
+                        if "NGINX_SERVER_NAME" not in env2:
+                            _error("missing 'server_name' when there is a 'web' process")
+
+                        if runtime == "python" and env2.get("WSGI", True) is True:
+                            check_uwsgi_plugins(get_wsgi_concurrency(env2))
+                            get_process_scaling(app, "web")
+
+                        if runtime == "static":
+                            _cmd = workers["web"].get("cmd")
+                            if not _cmd or not _cmd.startswith("/"):
+                                _error("for static site the webroot must start with a '/' (slash), instead '%s' provided" % _cmd)
+
+                    for kind in workers:
+                        wsgi = kind == "web" and runtime == "python" and env2.get("WSGI", True) is True
+                        if workers[kind].get("scaling") and not wsgi:
+                            echo("-------> 'process.%s.scaling' ignored, only python wsgi web workers scale their processes" % kind, fg="yellow")
+                        if workers[kind].get("autoscale"):
+                            if wsgi:
+                                get_process_autoscale(app, kind)
+                            else:
+                                echo("-------> 'process.%s.autoscale' ignored, only python wsgi web workers report their load" % kind, fg="yellow")
+                      
+                    # Setup runtime
+                    with deploy_phase(phases, "runtime:%s" % runtime):
+                        # python
+                        if runtime == "python":
+                            setup_python_runtime(app, deltas)
+                            
+                        # node
+                        elif runtime == "node":
+                            setup_node_runtime(app, deltas)
+                            
+                        # static html/php, shell
+                        elif runtime in ["static", "shell"]:
+                            setup_shell_runtime(app, deltas)
+
+                    # Scripts ==
                     
-                run_app_scripts(app, "predeploy")
-                spawn_app(app, deltas)
-                run_app_scripts(app, "postdeploy")
+                    # Once on git push
+                    if release is True:
+                        with deploy_phase(phases, "scripts:release"):
+                            run_app_scripts(app, "release")
+                        
+                    with deploy_phase(phases, "scripts:predeploy"):
+                        run_app_scripts(app, "predeploy")
+                    try:
+                        with deploy_phase(phases, "spawn"):
+                            spawn_app(app, deltas, zero_downtime=zero_downtime)
+                    except SystemExit:
+                        # the previous release is still serving, point back to it
+                        if zero_downtime and previous_release and previous_release != realpath(app_path):
+                            echo("-------> restoring the previous release", fg="yellow")
+                            swap_symlink(previous_release, app_path)
+                        raise
+                    with deploy_phase(phases, "scripts:postdeploy"):
+                        run_app_scripts(app, "postdeploy")
+                    outcome = "deployed"
+                    if newrev:
+                        with deploy_phase(phases, "release:prune"):
+                            prune_releases(app, int(env2.get("KEEP_RELEASES") or 5))
+        finally:
+            print_deploy_phases(phases, outcome)
+            add_deploy_history(app, {"revision": newrev or read_deployinfo(app).get("revision"), "outcome": outcome,
+                                     "phases": phases, "duration": round(sum(phases.values()), 3)})
     else:
         echo("Error: app '{}' not found.".format(app), fg='red')
 
 
+def is_zero_downtime(app, rev):
+    """ 'zero_downtime' as set in the sailor.yml of the revision being deployed """
+    import yaml
+    try:
+        buffer = check_output(["git", "show", "{}:sailor.yml".format(rev)], cwd=join(GIT_ROOT, app), env=git_env(), stderr=PIPE)
+        config = [c for c in yaml.safe_load(buffer)["apps"] if c.get("name") == app]
+    except Exception:
+        return False
+    return bool(config) and config[0].get("zero_downtime") is True
+
+
+def swap_symlink(target, link):
+    """ Point link to target atomically, replacing a previous symlink """
+    tmp = join(dirname(link), ".%s.%d.tmp" % (basename(link), getpid()))
+    symlink(target, tmp)
+    rename(tmp, link)
+
+
+def snapshot_dir(src, dst):
+    """ Copy a directory tree with reflinks where the filesystem supports them, hardlinks otherwise """
+    if call(['cp', '-a', '--reflink=always', src, dst], stdout=DEVNULL, stderr=DEVNULL) != 0:
+        if exists(dst):
+            rmtree(dst)
+        call(['cp', '-al', src, dst])
+
+
+def git_env(**extra):
+    """ The env of the git commands run on a working copy, without the GIT_* variables set by the hooks """
+    env = {k: v for k, v in environ.items() if not k.startswith("GIT_")}
+    env.update(extra)
+    return env
+
+
+def build_release(app, rev):
+    """
+    Materialize a revision in RELEASES_ROOT/<app>/<rev> and point APP_ROOT/<app> to it.
+    The release is a snapshot of the current one (reflinks or hardlinks, git then rewrites
+    the files that changed as new files), or a fresh clone for the first one.
+    Returns the previous release, if any
+    """
+    app_path = join(APP_ROOT, app)
+    release_path = join(RELEASES_ROOT, app, rev)
+    makedirs(dirname(release_path), exist_ok=True)
+
+    # the hook's GIT_DIR=. would point every command at the bare repo
+    env = git_env()
+
+    # an app deployed in place becomes a release too, its workers keep running from there
+    if exists(app_path) and not islink(app_path):
+        current = check_output('git rev-parse HEAD', cwd=app_path, env=env, shell=True).decode("utf8").strip()
+        current_path = join(RELEASES_ROOT, app, current)
+        if exists(current_path):
+            current_path += ".inplace"
+        rename(app_path, current_path)
+        symlink(current_path, app_path)
+    previous_release = realpath(app_path) if exists(app_path) else None
+
+    if not exists(release_path):
+        echo("-------> Building release '{}'".format(rev), fg='green')
+        tmp_path = join(RELEASES_ROOT, app, ".%s.%d.tmp" % (rev, getpid()))
+        if previous_release:
+            snapshot_dir(previous_release, tmp_path)
+            steps = ['git fetch --quiet', 'git reset --quiet --hard {}'.format(rev)]
+        else:
+            makedirs(tmp_path)
+            steps = ['git clone --quiet --no-checkout {} .'.format(join(GIT_ROOT, app)), 'git checkout --quiet {}'.format(rev)]
+        steps += ['git submodule init', 'git submodule update']
+        for step in steps:
+            if call(step, cwd=tmp_path, env=env, shell=True) != 0:
+                rmtree(tmp_path, ignore_errors=True)
+                _error("ERROR: '{}' failed, release '{}' not built".format(step, rev))
+        head = check_output('git rev-parse HEAD', cwd=tmp_path, env=env, shell=True).decode("utf8").strip()
+        if head != rev:
+            rmtree(tmp_path, ignore_errors=True)
+            _error("ERROR: release '{}' checked out '{}' instead".format(rev, head))
+        rename(tmp_path, release_path)
+
+    swap_symlink(release_path, app_path)
+    write_release_activated(app, rev)
+    return previous_release
+
+
+def get_releases(app):
+    """
+    The releases of an app, the most recently activated first. The order is kept in the
+    state store, the mtimes of releases made before it (or moved by the app) are a fallback
+    """
+    releases_path = join(RELEASES_ROOT, app)
+    if not exists(releases_path):
+        return []
+    activated = read_releases_activated(app)
+    releases = [join(releases_path, r) for r in listdir(releases_path) if not r.startswith(".")]
+    return sorted(releases, key=lambda r: activated.get(basename(r)) or getmtime(r), reverse=True)
+
+
+def get_dependencies_digest(path):
+    """ A digest of the dependency manifests of a release, the ones installed in the shared ENV_ROOT """
+    digest = sha256()
+    for name in DEPENDENCY_MANIFESTS:
+        manifest = join(path, name)
+        if exists(manifest):
+            with open(manifest, "rb") as h:
+                digest.update(name.encode() + b"\0" + h.read() + b"\0")
+    return digest.hexdigest()
+
+
+def prune_releases(app, keep=5):
+    """ Remove the oldest releases, keeping 'keep' of them plus any release a worker still runs from """
+    in_use = {realpath(join(APP_ROOT, app))}
+    for f in glob(join(UWSGI_ENABLED, '{}___*.ini'.format(app))):
+        with open(f) as h:
+            in_use.update(l.split("=", 1)[1].strip() for l in h if l.startswith("chdir"))
+    for release in get_releases(app)[keep:]:
+        if release not in in_use:
+            echo("-------> removing old release '{}'".format(basename(release)))
+            rmtree(release)
+            delete_release(app, basename(release))
+
+
 def get_spawn_env(app):
     env = {}
     # base config from sailor.yml
@@ -701,12 +1387,47 @@ def setup_node_runtime(app, deltas={}):
             echo("-------> Node is installed at {}.".format(version))
 
     if exists(deps):
-        if first_time or getmtime(deps) > getmtime(node_path):
-            copyfile(join(APP_ROOT, app, 'package.json'), join(ENV_ROOT, app, 'package.json'))
-            if not exists(node_modules_symlink):
-                symlink(node_path, node_modules_symlink)
-            echo("-------> Running npm for '{}'".format(app))
-            call('npm install --prefix {} --package-lock=false'.format(npm_prefix), cwd=join(APP_ROOT, app), env=env, shell=True)
+        if not exists(node_modules_symlink) and not islink(node_modules_symlink):
+            symlink(node_path, node_modules_symlink)
+
+        # reinstall when the manifest, the lockfile or the node on PATH changed (native modules
+        # are built for it, a system upgrade counts), mtimes move on every checkout
+        lockfile = join(APP_ROOT, app, 'package-lock.json')
+        manifests = [deps] + ([lockfile] if exists(lockfile) else [])
+        digest = sha256(get_node_version(env).encode())
+        for m in manifests:
+            with open(m, 'rb') as f:
+                digest.update(f.read())
+        digest = digest.hexdigest()
+        digest_file = join(virtualenv_path, '.package.sha256')
+        installed = open(digest_file).read().strip() if exists(digest_file) else None
+
+        if first_time or digest != installed:
+            for m in manifests:
+                copyfile(m, join(npm_prefix, basename(m)))
+            # the npm cache is content addressed and shared by all the apps
+            npm_args = '--prefix {} --cache {} --prefer-offline --no-audit --no-fund'.format(npm_prefix, NPM_CACHE_ROOT)
+            if exists(lockfile):
+                echo("-------> Running npm ci for '{}'".format(app))
+                cmd = 'npm ci {}'.format(npm_args)
+            else:
+                echo("-------> Running npm install for '{}'".format(app))
+                cmd = 'npm install {} --package-lock=false'.format(npm_args)
+            started = monotonic()
+            if call(cmd, cwd=join(APP_ROOT, app), env=env, shell=True) == 0:
+                with open(digest_file, 'w') as f:
+                    f.write(digest)
+            echo("-------> npm done in {:.1f}s".format(monotonic() - started))
+        else:
+            echo("-------> package.json unchanged, skipping npm")
+
+
+def get_node_version(env):
+    """ The version of the node found on the PATH of env (the nodeenv one first), empty if none """
+    try:
+        return check_output("node --version", env=env, shell=True, stderr=DEVNULL).decode("utf8").strip()
+    except (OSError, CalledProcessError):
+        return ""
 
 
 def setup_python_runtime(app, deltas={}):
@@ -728,17 +1449,86 @@ def setup_python_runtime(app, deltas={}):
 
     exec(open(activation_script).read(), dict(__file__=activation_script))
 
-    if first_time or getmtime(requirements) > getmtime(virtualenv_path):
+    if not exists(requirements):
+        return
+
+    # reinstall when requirements.txt or the interpreter changed, mtimes move on every checkout
+    with open(requirements, 'rb') as f:
+        digest = sha256(f.read() + get_venv_python_version(virtualenv_path).encode()).hexdigest()
+    digest_file = join(virtualenv_path, '.requirements.sha256')
+    installed = open(digest_file).read().strip() if exists(digest_file) else None
+
+    if first_time or digest != installed:
         echo("-------> Running pip for '{}'".format(app), fg='green')
-        call('pip install -r {} --upgrade'.format(requirements), cwd=virtualenv_path, shell=True)
+        if install_python_requirements(requirements, virtualenv_path) == 0:
+            with open(digest_file, 'w') as f:
+                f.write(digest)
+    else:
+        echo("-------> requirements unchanged, skipping pip")
+
+
+def get_venv_python_version(virtualenv_path):
+    """ The interpreter version of a virtualenv, from its pyvenv.cfg """
+    cfg = join(virtualenv_path, 'pyvenv.cfg')
+    if exists(cfg):
+        with open(cfg) as f:
+            for line in f:
+                k, _, v = line.partition("=")
+                if k.strip() in ("version", "version_info"):
+                    return v.strip()
+    return command_output(join(virtualenv_path, 'bin', 'python') + ' -V')
+
+
+def requirements_pinned(requirements):
+    """ Whether every requirement is pinned to one version (name==version), so the wheelhouse can't hold a stale one """
+    with open(requirements) as h:
+        lines = h.read().replace("\\\n", " ").splitlines()
+    for line in lines:
+        line = line.split(" #", 1)[0].strip()
+        if not line or line.startswith("#"):
+            continue
+        # includes, editables, urls and index options resolve elsewhere
+        if not re.match(r"^[A-Za-z0-9][A-Za-z0-9._-]*(\[[^\]]*\])?\s*===?\s*[^\s,;*]+(\s*;[^,]*)?(\s+--hash=\S+)*$", line):
+            return False
+    return True
+
+
+def install_python_requirements(requirements, virtualenv_path):
+    """
+    Install requirements offline from the shared wheelhouse (WHEELS_ROOT).
+    Wheels missing from it are built or downloaded once, then reused by every app.
+    Unpinned requirements are resolved against the index first, a wheel in the
+    wheelhouse only satisfies them if it's still the version the index gives
+    """
+    makedirs(WHEELS_ROOT, exist_ok=True)
+    offline = 'pip install --no-index --find-links {} -r {}'.format(WHEELS_ROOT, requirements)
+    if requirements_pinned(requirements):
+        if call(offline + ' --quiet', cwd=virtualenv_path, shell=True, stdout=DEVNULL, stderr=DEVNULL) == 0:
+            echo("-------> installed from the wheelhouse")
+            return 0
+    else:
+        echo("-------> unpinned requirements, resolving them against the index")
+
+    # one build at a time, apps pushed together often need the same wheels
+    with open(join(WHEELS_ROOT, '.lock'), 'a') as lock:
+        flock(lock, LOCK_EX)
+        call('pip wheel --find-links {0} --wheel-dir {0} -r {1}'.format(WHEELS_ROOT, requirements), cwd=virtualenv_path, shell=True)
+    code = call(offline, cwd=virtualenv_path, shell=True)
+    if code != 0:
+        echo("-------> wheelhouse install failed, installing from the index", fg='yellow')
+        code = call('pip install -r {}'.format(requirements), cwd=virtualenv_path, shell=True)
+    return code
 
 
 def setup_shell_runtime(app, deltas={}):
     pass
 
 
-def spawn_app(app, deltas={}):
-    """Create all workers for an app"""
+def spawn_app(app, deltas={}, check_nginx=True, zero_downtime=False):
+    """
+    Create all workers for an app.
+    zero_downtime: start the web workers on the other slot, flip nginx once they answer, then drain the old ones
+    """
 
     app_path = join(APP_ROOT, app)
     runtime = get_app_runtime(app)
@@ -748,7 +1538,30 @@ def spawn_app(app, deltas={}):
         worker_count["cron"] = 1
     virtualenv_path = join(ENV_ROOT, app)
     scaling = read_settings(app, 'SCALING')
-    
+
+    # Configured worker count
+    if scaling:
+        worker_count.update({k.lower(): int(v) for k, v in scaling.items() if k.lower() in workers})
+
+    app_env = get_spawn_env(app)
+    # decided before the slot flips: without nginx the web workers restart in place, on their ports
+    if zero_downtime and 'web' in workers and str(app_env.get('NGINX_SERVER_NAME', '')).strip() == SKIP_NGINX_USE_UWSGI_SERVER_NAME:
+        echo("-------> zero downtime deploys require nginx, restarting in place", fg="yellow")
+        zero_downtime = False
+
+    # web workers alternate between two slots of ordinals on zero downtime deploys
+    web_slot = int(read_deployinfo(app).get("web_slot") or 0)
+    if zero_downtime:
+        web_slot = 1 - web_slot
+
+    to_create = {}
+    for k, v in worker_count.items():
+        base = web_slot * WEB_SLOT_SIZE if k == 'web' else 0
+        to_create[k] = range(base + 1, base + worker_count[k] + 1)
+        if k in deltas and deltas[k]:
+            to_create[k] = range(base + 1, base + worker_count[k] + deltas[k] + 1)
+            worker_count[k] = worker_count[k]+deltas[k]
+
     # Bootstrap environment
     env = {
         'APP': app,
@@ -775,25 +1588,48 @@ def spawn_app(app, deltas={}):
         env["PATH"] = ':'.join([join(node_path, ".bin"), env['PATH']])
 
     # Update the env with app env
-    env.update(get_spawn_env(app))
+    env.update(app_env)
     
     if env.get("HTTPS_ONLY") is True and env.get("SSL") is False:
         env["SSL"] = True
 
+    nginx_buffer = None
     if 'web' in workers:
-        # Pick a port if none defined
-        if 'PORT' not in env or not env.get("PORT"):
-            env['PORT'] = str(get_free_port())
-            echo("-------> picking free port %s" % env["PORT"])
+        # One port per web worker, PORT is the first one
+        web_ports = assign_web_ports(app, env, to_create['web'] or [web_slot * WEB_SLOT_SIZE + 1])
+        env['PORT'] = str(web_ports[min(web_ports)])
 
         # NGINX: Set up nginx if we have NGINX_SERVER_NAME set
         if env.get('NGINX_SERVER_NAME') and env.get('NGINX_SERVER_NAME', '').strip() != SKIP_NGINX_USE_UWSGI_SERVER_NAME:
-            nginx = command_output("nginx -V")
+            # enable the fastest protocols and transfer options this nginx supports
+            capabilities = nginx_capabilities()
             nginx_ssl = "443 ssl"
-            if "--with-http_v2_module" in nginx:
-                nginx_ssl += " http2"
-            elif "--with-http_spdy_module" in nginx and "nginx/1.6.2" not in nginx:
+            protocols = []
+            if capabilities.get("http2"):
+                if capabilities.get("http2_directive"):
+                    protocols.append("http2 on;")
+                else:
+                    nginx_ssl += " http2"
+            elif capabilities.get("spdy"):
                 nginx_ssl += " spdy"
+            # opt-in: clients only fall back to TCP after QUIC on udp 443 times out
+            if capabilities.get("http3") and env.get("NGINX_HTTP3") is True:
+                # 'reuseport' goes on one app per address, see balance_quic_reuseport()
+                protocols += ["listen              %s:443 quic;" % env[a] for a in ("NGINX_IPV6_ADDRESS", "NGINX_IPV4_ADDRESS")]
+                protocols.append("add_header Alt-Svc 'h3=\":443\"; ma=86400' always;")
+            # 0-RTT requests can be replayed, the app gets 'Early-Data: 1' to refuse unsafe ones
+            early_data = capabilities.get("ssl_early_data") and env.get("NGINX_EARLY_DATA") is True
+            if early_data:
+                protocols.append("ssl_early_data on;")
+            env['INTERNAL_NGINX_PROTOCOLS'] = "\n  ".join(protocols)
+            env['INTERNAL_NGINX_COMPRESSION'] = INTERNAL_NGINX_BROTLI if capabilities.get("brotli") and env.get("NGINX_BROTLI") is not False else ""
+            env['INTERNAL_NGINX_EARLY_DATA'] = ""
+            if early_data:
+                env['INTERNAL_NGINX_EARLY_DATA'] = "uwsgi_param HTTP_EARLY_DATA $ssl_early_data;" if get_uwsgi_socket(app, env) else "proxy_set_header Early-Data $ssl_early_data;"
+            nginx_aio = "aio threads;" if capabilities.get("aio_threads") else ""
+            if capabilities:
+                features = [f for f in ("http2", "http3", "brotli", "aio_threads", "ssl_early_data") if capabilities.get(f)]
+                echo("-------> nginx {}: {}".format(capabilities["version"], ", ".join(features) or "no optional features"))
             nginx_conf = join(NGINX_ROOT, "%s.conf" % app)
 
             env.update({
@@ -802,9 +1638,43 @@ def spawn_app(app, deltas={}):
                 'ACME_WWW': ACME_WWW,
             })
 
-            env['INTERNAL_NGINX_UWSGI_SETTINGS'] = 'proxy_pass http://{BIND_ADDRESS:s}:{PORT:s};'.format(**env)
-            env['NGINX_SOCKET'] = "{BIND_ADDRESS:s}:{PORT:s}".format(**env)
-            echo("-------> nginx will look for app '{}' on {}".format(app, env['NGINX_SOCKET']))
+            balance = str(env.get('NGINX_BALANCE') or 'round_robin').strip()
+            if balance.startswith('hash '):
+                balance_method = "%s consistent;" % balance
+            elif balance in NGINX_BALANCE_METHODS:
+                balance_method = NGINX_BALANCE_METHODS[balance]
+            else:
+                _error("invalid 'nginx.balance' in app: %s, must be one of: %s" % (app, ", ".join(NGINX_BALANCE_METHODS)))
+
+            # every web worker is a server of the upstream
+            uwsgi_socket = get_uwsgi_socket(app, env)
+            backends = [get_web_backend(app, env, w) for w in sorted(web_ports)]
+            env['NGINX_SOCKET'] = backends[0]
+            upstream = (["  %s" % balance_method] if balance_method else []) + ["  server %s;" % b for b in backends]
+
+            # keep a pool of idle connections to the backends ('nginx.keepalive: 0' to disable)
+            # the uwsgi protocol closes the connection after each request, only http can use the pool
+            keepalive = int(env.get('NGINX_KEEPALIVE', 32) or 0)
+            # nginx variables are global: every byte other than [A-Za-z0-9] is escaped, my-app and my_app differ
+            connection_var = "$sailor_connection_%s" % re.sub(
+                r'[^A-Za-z0-9]', lambda m: "".join("_%02x" % b for b in m.group(0).encode("utf8")), app)
+            env['INTERNAL_NGINX_MAPS'] = expandvars(INTERNAL_NGINX_CONNECTION_MAP, locals())
+            env['INTERNAL_NGINX_CONNECTION'] = connection_var
+            if keepalive > 0 and not uwsgi_socket:
+                upstream += [
+                    "  keepalive %d;" % keepalive,
+                    "  keepalive_requests %s;" % env.get('NGINX_KEEPALIVE_REQUESTS', 1000),
+                    "  keepalive_timeout %s;" % env.get('NGINX_KEEPALIVE_TIMEOUT', '60s'),
+                ]
+            else:
+                env['INTERNAL_NGINX_MAPS'] = ''
+                env['INTERNAL_NGINX_CONNECTION'] = '"upgrade"'
+            env['INTERNAL_NGINX_UPSTREAM'] = "\n".join(upstream)
+            if uwsgi_socket:
+                env['INTERNAL_NGINX_UWSGI_SETTINGS'] = expandvars(INTERNAL_NGINX_UWSGI_SETTINGS, env)
+            else:
+                env['INTERNAL_NGINX_UWSGI_SETTINGS'] = 'proxy_pass http://{APP:s};'.format(**env)
+            echo("-------> nginx will look for app '{}' on {}".format(app, ", ".join(backends)))
 
             # SSL          
             if env.get("SSL") is True:
@@ -827,8 +1697,9 @@ def spawn_app(app, deltas={}):
                 if not exists(nginx_conf):
                     echo("-------> writing temporary nginx conf")
                     buffer = expandvars(NGINX_ACME_FIRSTRUN_TEMPLATE, env)
-                    with open(nginx_conf, "w") as h:
-                        h.write(buffer)
+                    write_nginx_conf(app, buffer)
+                    # the stub must be live before acme.sh runs
+                    reload_nginx()
                     sleep(2)
                     
                 if not exists(key) or not exists(join(ACME_ROOT, domain, domain + ".key")):
@@ -875,7 +1746,7 @@ def spawn_app(app, deltas={}):
             env['INTERNAL_NGINX_PORTMAP'] = ""
 
             if "static" not in runtime:
-                env['INTERNAL_NGINX_PORTMAP'] = expandvars(NGINX_PORTMAP_FRAGMENT, env)
+                env['INTERNAL_NGINX_PORTMAP'] = expandvars(NGINX_UWSGI_PORTMAP_FRAGMENT if uwsgi_socket else NGINX_PORTMAP_FRAGMENT, env)
             env['INTERNAL_NGINX_COMMON'] = expandvars(NGINX_COMMON_FRAGMENT, env)
 
             echo("-------> nginx will map app '{}' to hostname '{}'".format(app, env['NGINX_SERVER_NAME']))
@@ -886,71 +1757,217 @@ def spawn_app(app, deltas={}):
             else:
                 buffer = expandvars(NGINX_TEMPLATE, env)
 
-            with open(nginx_conf, "w") as h:
-                h.write(buffer)
-            # prevent broken config from breaking other deploys
-            try:
-                nginx_config_test = str(check_output("nginx -t 2>&1 | grep {}".format(app), env=environ, shell=True))
-            except:
-                nginx_config_test = None
-            if nginx_config_test:
-                echo("!!!!!!!FATAL ERROR!!!!!!!", fg='red')
-                echo("!!!!!!!FATAL ERROR: [nginx config] {}".format(nginx_config_test), fg='red')
-                echo("!!!!!!!FATAL ERROR: removing broken nginx config.", fg='red')
-                unlink(nginx_conf)
-                echo("!!!!!!!FATAL ERROR: exited.", fg='red')
-                exit(1)
-
-    # Configured worker count
-    if scaling:
-        worker_count.update({k.lower(): int(v) for k, v in scaling.items() if k.lower() in workers})
-
-    to_create = {}
-    to_destroy = {}
-    for k, v in worker_count.items():
-        to_create[k] = range(1, worker_count[k] + 1)
-        if k in deltas and deltas[k]:
-            to_create[k] = range(1, worker_count[k] + deltas[k] + 1)
-            if deltas[k] < 0:
-                to_destroy[k] = range(worker_count[k], worker_count[k] + deltas[k], -1)
-            worker_count[k] = worker_count[k]+deltas[k]
+            # written once the web workers are created
+            nginx_buffer = buffer
 
-    # Cleanup env
+    # Cleanup env, the nginx only variables don't go to the workers
     for k, v in list(env.items()):
-        if k.startswith('INTERNAL_'):
+        if k.startswith('INTERNAL_') or k in ['NGINX_ACL']:
             del env[k]
 
+    env_ini = join(UWSGI_AVAILABLE, '%s.env.ini' % app)
+    previous = None
+    if zero_downtime:
+        # put back if the new web workers fail, the running ones restart with their own env
+        previous = {section: read_settings(app, section) for section in ('ENV', 'SCALING')}
+        previous['env.ini'] = open(env_ini).read() if exists(env_ini) else None
+
     # Save current settings
     write_settings(app, 'ENV', env)
     write_settings(app, 'SCALING', worker_count)
 
-    # auto restart
-    if env.get("AUTO_RESTART", False) is True:
-        echo("-------> auto-restart triggered", fg="green")
-        cleanup_uwsgi_enabled_ini(app)
+    # running workers are only restarted when their rendered config changed,
+    # and on auto restart or zero downtime deploys only (the release moved)
+    restart = env.get("AUTO_RESTART", False) is True or zero_downtime
+    spawned = defaultdict(list)
+
+    # env shared by all the workers, they include it and only set what differs
+    write_file_if_changed(env_ini, render_uwsgi_env(env))
+
+    def spawn(kinds):
+        for k in kinds:
+            for w in to_create[k]:
+                state = spawn_worker(app, k, workers[k]["cmd"], env, w, restart=restart)
+                if state:
+                    spawned[state].append("{}.{}".format(k, w))
+                    if state in ("added", "restarted"):
+                        echo("-------> '{}:{}.{}' {}".format(app, k, w, state), fg='green')
+
+    # Create new workers, the web ones first
+    spawn([k for k in to_create if k == 'web'])
+
+    # the current web workers keep serving until the new ones answer
+    if zero_downtime and runtime != 'static' and to_create.get('web'):
+        backends = [get_web_backend(app, env, w) for w in to_create['web']]
+        path = str(env.get('ZERO_DOWNTIME_HEALTH_PATH', '/'))
+        host = (env.get('NGINX_SERVER_NAME') or 'localhost').split()[0]
+        echo("-------> waiting for the new web workers to answer '{}' on {}".format(path, ", ".join(backends)))
+        failed = wait_for_backends(backends, float(env.get('ZERO_DOWNTIME_TIMEOUT', 60)), path, host)
+        if failed:
+            failures = ["{} ({})".format(b, status or "no answer") for b, status in failed.items()]
+            echo("!!!!!!!ERROR: web workers failing on {}, keeping the current ones.".format(", ".join(failures)), fg='red')
+            for w in to_create['web']:
+                enabled = join(UWSGI_ENABLED, '{app:s}___web.{w:d}.ini'.format(**locals()))
+                if exists(enabled):
+                    unlink(enabled)
+            for section in ('ENV', 'SCALING'):
+                replace_settings(app, section, previous[section])
+            if previous['env.ini'] is None:
+                unlink(env_ini)
+            else:
+                write_file_if_changed(env_ini, previous['env.ini'])
+            exit(1)
+
+    if nginx_buffer and not write_nginx_conf(app, nginx_buffer):
+        echo("-------> nginx conf unchanged")
+    elif nginx_buffer:
+        # prevent broken config from breaking other deploys
+        # (bulk commands check all the apps at once, when they are done)
+        nginx_config_test = nginx_config_errors().get(app) if check_nginx else None
+        if nginx_config_test:
+            echo("!!!!!!!FATAL ERROR!!!!!!!", fg='red')
+            echo("!!!!!!!FATAL ERROR: [nginx config] {}".format(nginx_config_test), fg='red')
+            echo("!!!!!!!FATAL ERROR: removing broken nginx config.", fg='red')
+            remove_nginx_conf(app)
+            echo("!!!!!!!FATAL ERROR: exited.", fg='red')
+            exit(1)
 
-    # Create new workers
-    for k, v in to_create.items():
-        for w in v:
-            enabled = join(UWSGI_ENABLED, '{app:s}___{k:s}.{w:d}.ini'.format(**locals()))
-            if not exists(enabled):
-                echo("-------> spawning '{app:s}:{k:s}.{w:d}'".format(**locals()), fg='green')
-                _cmd = workers[k]["cmd"]
-                spawn_worker(app, k, _cmd, env, w)
+    if zero_downtime:
+        # flip nginx to the new web workers
+        reload_nginx()
+        write_deployinfo(app, {"web_slot": web_slot})
+
+    # other workers restart on the new release on zero downtime deploys
+    spawn([k for k in to_create if k != 'web'])
+
+    # workers not wanted anymore: scaled down, gone from sailor.yml or the previous web slot
+    wanted = {'{}___{}.{}.ini'.format(app, k, w) for k in to_create for w in to_create[k]}
+    stale = [f for f in sorted(glob(join(UWSGI_ENABLED, '{}___*.ini'.format(app)))) if basename(f) not in wanted]
+    if [f for f in stale if basename(f).startswith('{}___web.'.format(app))]:
+        # nginx applies reloads asynchronously (incron), then finishes the in-flight requests
+        # of the workers it stopped using: they keep running meanwhile
+        drain = float(env.get('ZERO_DOWNTIME_DRAIN', 10))
+        if zero_downtime:
+            echo("-------> draining the previous web workers ({:.0f}s)".format(drain))
+            sleep(drain)
+        elif _NGINX_PENDING["changed"] is not None:
+            # Take the web workers out of the upstream before stopping them
+            reload_nginx()
+            echo("-------> draining the web workers scaled down ({:.0f}s)".format(drain))
+            sleep(drain)
 
     # Remove unnecessary workers (leave logfiles)
-    for k, v in to_destroy.items():
-        for w in v:
-            enabled = join(UWSGI_ENABLED, '{app:s}___{k:s}.{w:d}.ini'.format(**locals()))
-            if exists(enabled):
-                echo("-------> terminating '{app:s}:{k:s}.{w:d}'".format(**locals()))
-                unlink(enabled)
+    for f in stale:
+        name = basename(f)[:-4].split("___", 1)[1]
+        echo("-------> terminating '{}:{}'".format(app, name))
+        unlink(f)
+        rmtree(join(METRICS_ROOT, app, name), ignore_errors=True)
+        spawned["removed"].append(name)
+
+    for state in ["kept", "outdated", "restarted", "added", "removed"]:
+        if spawned[state]:
+            echo("-------> {} {}: {}".format(len(spawned[state]), state, ", ".join(spawned[state])))
+    if spawned["outdated"]:
+        echo("-------> 'auto_restart' is off, the outdated workers run their previous config until 'reload'", fg="yellow")
 
     return env
 
 
-def spawn_worker(app, kind, command, env, ordinal=1):
-    """Set up and deploy a single worker of a given kind"""
+def get_uwsgi_socket(app, env, ordinal=1):
+    """ The unix socket of a python wsgi web worker when 'uwsgi.unix_socket' is on, None when it uses http """
+    if env.get("UWSGI_UNIX_SOCKET") is True and env.get("WSGI", True) is True and get_app_runtime(app) == "python":
+        return join(NGINX_ROOT, "%s.%d.sock" % (app, ordinal))
+    return None
+
+
+def assign_web_ports(app, env, ordinals):
+    """
+    Return {ordinal: port} for the web workers. Ports are kept in the state store
+    and reused, so running workers and nginx agree across spawns.
+    A PORT set in the config is used by the first worker
+    """
+    assigned = read_ports(app, 'web')
+    ports = {}
+    for w in ordinals:
+        port = env.get('PORT') if w == 1 and env.get('PORT') else assigned.get(('web', w))
+        if not port:
+            port = get_free_port()
+            echo("-------> picking free port %s for web.%d" % (port, w))
+        ports[w] = int(port)
+        if assigned.get(('web', w)) != ports[w]:
+            write_port(app, 'web', w, ports[w])
+    return ports
+
+
+def _backend_status(backend, path="/", host="localhost"):
+    """
+    The HTTP status a web worker answers a GET on 'path' with, None when it doesn't answer.
+    host:port speaks HTTP, unix:path the uwsgi protocol (as nginx's uwsgi_pass)
+    """
+    import struct
+    s = socket(AF_UNIX if backend.startswith("unix:") else AF_INET, SOCK_STREAM)
+    s.settimeout(5)
+    try:
+        if backend.startswith("unix:"):
+            s.connect(backend[5:])
+            path_info, _, query = path.partition("?")
+            variables = {"REQUEST_METHOD": "GET", "REQUEST_URI": path, "PATH_INFO": path_info, "QUERY_STRING": query,
+                         "SERVER_PROTOCOL": "HTTP/1.0", "SERVER_NAME": host, "SERVER_PORT": "80",
+                         "HTTP_HOST": host, "REMOTE_ADDR": "127.0.0.1"}
+            # uwsgi packet: modifier1, size, modifier2, then the (size, key, size, value) pairs
+            body = b"".join(struct.pack("<H", len(k)) + k + struct.pack("<H", len(v)) + v
+                            for k, v in ((k.encode(), v.encode()) for k, v in variables.items()))
+            s.sendall(struct.pack("<BHB", 0, len(body), 0) + body)
+        else:
+            address, port = backend.rsplit(":", 1)
+            s.connect((address, int(port)))
+            s.sendall("GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n".format(path, host).encode())
+        response = b""
+        while b"\r\n" not in response and len(response) < 4096:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        match = re.match(rb"HTTP/\d(?:\.\d)? (\d{3})", response)
+        return int(match.group(1)) if match else None
+    except (OSError, ValueError):
+        return None
+    finally:
+        s.close()
+
+
+def wait_for_backends(backends, timeout=60, path="/", host="localhost"):
+    """
+    Wait for the web workers to answer a GET on 'path' without a server error (5xx),
+    return {backend: last status} for the ones still failing after timeout
+    """
+    deadline = monotonic() + timeout
+    pending = {b: None for b in backends}
+    while True:
+        for backend in list(pending):
+            status = pending[backend] = _backend_status(backend, path, host)
+            if status is not None and status < 500:
+                del pending[backend]
+        if not pending or monotonic() > deadline:
+            return pending
+        sleep(0.5)
+
+
+def get_web_backend(app, env, ordinal=1):
+    """ The address nginx uses to reach a web worker """
+    uwsgi_socket = get_uwsgi_socket(app, env, ordinal)
+    if uwsgi_socket:
+        return "unix:%s" % uwsgi_socket
+    port = read_ports(app, 'web').get(('web', ordinal)) or env['PORT']
+    return "{}:{}".format(env['BIND_ADDRESS'], port)
+
+
+def spawn_worker(app, kind, command, env, ordinal=1, restart=True):
+    """
+    Set up and deploy a single worker of a given kind. The vassal ini is only
+    written when its content changed (the emperor restarts a vassal when its ini is touched).
+    Returns 'added', 'restarted', 'kept', 'outdated' (changed but restart is False) or None
+    """
 
     app_kind = kind
     runtime = get_app_runtime(app)
@@ -962,10 +1979,13 @@ def spawn_worker(app, kind, command, env, ordinal=1):
             app_kind = "wsgi" if config.get("WSGI", True) is True else "shell"
         elif runtime == "node":
             app_kind = "shell"
+    scaling = get_process_scaling(app, kind) if app_kind == 'wsgi' else None
 
-    env['PROC_TYPE'] = app_kind
+    # the shared env is left untouched, every worker has its own copy
+    shared_env = env
+    env = dict(env, PROC_TYPE=app_kind)
     env_path = join(ENV_ROOT, app)
-    metrics_path = join(METRICS_ROOT, app)
+    metrics_path = get_metrics_dir(app, kind, ordinal)
     available = join(UWSGI_AVAILABLE, '{app:s}___{kind:s}.{ordinal:d}.ini'.format(**locals()))
     enabled = join(UWSGI_ENABLED, '{app:s}___{kind:s}.{ordinal:d}.ini'.format(**locals()))
     log_file = join(LOG_ROOT, app, app_kind)
@@ -975,12 +1995,13 @@ def spawn_worker(app, kind, command, env, ordinal=1):
         makedirs(metrics_path)
 
     settings = [
-        ('chdir',join(APP_ROOT, app)),
+        # the release itself, so running workers are not moved by a new deploy
+        ('chdir',realpath(join(APP_ROOT, app))),
         ('master','true'),
         ('project',app),
         ('max-requests',env.get('UWSGI_MAX_REQUESTS', '1024')),
         ('listen',env.get('UWSGI_LISTEN', '16')),
-        ('processes',env.get('UWSGI_PROCESSES', '1')),
+        ('processes',scaling['max'] if scaling else env.get('UWSGI_PROCESSES', '1')),
         ('procname-prefix','{app:s}:{kind:s}'.format(**locals())),
         ('enable-threads',env.get('UWSGI_ENABLE_THREADS', 'true').lower()),
         ('log-x-forwarded-for',env.get('UWSGI_LOG_X_FORWARDED_FOR', 'false').lower()),
@@ -988,6 +2009,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
         ('logto2','{log_file:s}.{ordinal:d}.log'.format(**locals())),
         ('log-backupname','{log_file:s}.{ordinal:d}.log.old'.format(**locals())),
         ('metrics-dir',metrics_path),
+        ('stats',get_uwsgi_stats_socket(app, kind, ordinal)),
         ('uid',getpwuid(getuid()).pw_name),
         ('gid',getgrgid(getgid()).gr_name),
         ('logfile-chown','%s:%s' % (getpwuid(getuid()).pw_name, getgrgid(getgid()).gr_name)),
@@ -998,16 +2020,30 @@ def spawn_worker(app, kind, command, env, ordinal=1):
     if exists(join(env_path, "bin", "activate_this.py")):
         settings.append(('virtualenv', env_path))
 
+    # each web worker listens on its own port
+    if kind == 'web':
+        env = dict(env, PORT=str(read_ports(app, 'web').get(('web', ordinal)) or env['PORT']))
+
     # wsgi -> web for python
     if app_kind == 'wsgi':
         http = '{BIND_ADDRESS:s}:{PORT:s}'.format(**env)
-        settings.extend([('module', command), ('threads', env.get('UWSGI_THREADS', '4'))])
-        settings.extend([('plugin', 'python3'), ])
-        if 'UWSGI_ASYNCIO' in env:
-            settings.extend([('plugin', 'asyncio_python3'), ])
-
-        echo("-------> nginx will talk to uWSGI via %s" % http)
-        settings.extend([('http', http), ('http-socket', http)])
+        settings.append(('module', command))
+        settings.extend(get_wsgi_concurrency(env))
+        settings.extend(get_cheaper_settings(scaling))
+
+        uwsgi_socket = get_uwsgi_socket(app, env, ordinal)
+        if uwsgi_socket:
+            echo("-------> nginx will talk to uWSGI via %s" % uwsgi_socket)
+            settings.extend([
+                ('socket', uwsgi_socket),
+                ('chmod-socket', '660'),
+                ('chown-socket', '%s:%s' % (getpwuid(getuid()).pw_name, getgrgid(getgid()).gr_name)),
+            ])
+        else:
+            echo("-------> nginx will talk to uWSGI via %s" % http)
+            settings.extend([('http', http), ('http-socket', http)])
+            if int(env.get('NGINX_KEEPALIVE', 32) or 0) > 0:
+                settings.append(('http-keepalive', '1'))
 
     # wshell / for other web
     elif app_kind == 'shell':
@@ -1032,23 +2068,372 @@ def spawn_worker(app, kind, command, env, ordinal=1):
         settings.append(
             ('log-format', '%%(addr) - %%(user) [%%(ltime)] "%%(method) %%(uri) %%(proto)" %%(status) %%(size) "%%(referer)" "%%(uagent)" %%(msecs)ms'))
 
-    # remove unnecessary variables from the env in nginx.ini
-    for k in ['NGINX_ACL']:
-        if k in env:
-            del env[k]
-
     # insert user defined uwsgi settings if set
     settings += parse_settings(join(APP_ROOT, app, env.get("UWSGI_INCLUDE_FILE"))).items() if env.get("UWSGI_INCLUDE_FILE") else []
 
+    # the shared env file, then what this worker overrides (PROC_TYPE, PORT...)
+    shared = render_uwsgi_env(shared_env)
+    settings.append(('ini', join(UWSGI_AVAILABLE, '{app:s}.env.ini'.format(**locals()))))
     for k, v in env.items():
-        settings.append(('env', '{k:s}={v}'.format(**locals())))
+        if k not in shared_env or shared_env[k] != v:
+            settings.append(('env', '{k:s}={v}'.format(**locals())))
+
+    if kind == 'static':
+        return None
+    # the emperor only watches the vassal ini: the digest of the shared env restarts the worker when it changes
+    buffer = '[uwsgi]\n; env {}\n'.format(sha256(shared.encode("utf8")).hexdigest()) + \
+        ''.join("{k:s} = {v}\n".format(k=k, v=v) for k, v in settings)
+    if not exists(enabled):
+        state = "added"
+    elif file_digest(enabled) == sha256(buffer.encode("utf8")).hexdigest():
+        return "kept"
+    elif not restart:
+        return "outdated"
+    else:
+        state = "restarted"
+    write_file_if_changed(available, buffer)
+    write_file_atomic(enabled, buffer)
+    return state
+
+
+def get_wsgi_concurrency(env):
+    """
+    uWSGI settings for the concurrency of a python wsgi worker: threads by default,
+    or the gevent/asyncio loop engine ('uwsgi.gevent'/'uwsgi.asyncio': true or the number of async cores)
+    """
+    def positive_int(key, value, maximum=None):
+        try:
+            value = int(value)
+            assert value >= 1 and (maximum is None or value <= maximum)
+        except (TypeError, ValueError, AssertionError):
+            _error("invalid '%s': %s, must be a number from 1%s" % (key, value, " to %d" % maximum if maximum else ""))
+        return value
+
+    positive_int("uwsgi.processes", env.get("UWSGI_PROCESSES", 1))
+    threads = positive_int("threads", env.get("UWSGI_THREADS", 4))
+    engines = {}
+    for engine in ["gevent", "asyncio"]:
+        value = env.get("UWSGI_%s" % engine.upper())
+        if value not in (None, False):
+            engines[engine] = positive_int("uwsgi.%s" % engine, UWSGI_ASYNC_CORES if value is True else value, 10000)
+
+    if not engines:
+        return [('plugin', 'python3'), ('threads', threads)]
+    if len(engines) > 1:
+        _error("'uwsgi.gevent' and 'uwsgi.asyncio' can't be used together")
+    # the loop engines run one thread per process, concurrency comes from the async cores
+    if threads > 1 and "UWSGI_THREADS" in env:
+        _error("'threads' can't be used with 'uwsgi.%s', remove it or set it to 1" % list(engines)[0])
+
+    if "gevent" in engines:
+        return [('plugin', 'python3'), ('plugin', 'gevent_python3'),
+                ('gevent', engines["gevent"]), ('gevent-monkey-patch', 'true')]
+    return [('plugin', 'python3'), ('plugin', 'asyncio_python3'), ('plugin', 'greenlet_python3'),
+            ('asyncio', engines["asyncio"]), ('greenlet', 'true')]
+
+
+def check_uwsgi_plugins(settings):
+    """ Stop the deploy when a plugin loaded by these uWSGI settings isn't installed """
+    if not exists(UWSGI_PLUGINS_DIR):
+        return
+    for key, plugin in settings:
+        if key == 'plugin' and not exists(join(UWSGI_PLUGINS_DIR, "%s_plugin.so" % plugin)):
+            _error("the uWSGI plugin '{}' is not installed ('uwsgi-plugin-{}' package)".format(plugin, plugin.replace("_", "-")))
+
+
+def get_process_scaling(app, kind):
+    """
+    The 'process.<kind>.scaling' block of an app, None when the process has a fixed number of uWSGI processes.
+    Returns {min, max, initial, step, algo, overload}, uWSGI's cheaper subsystem keeps between min and max processes
+    """
+    scaling = parse_app_processes(app).get(kind, {}).get("scaling")
+    if not scaling:
+        return None
+    if not isinstance(scaling, dict):
+        _error("invalid 'process.%s.scaling', must be a mapping with 'min' and 'max'" % kind)
+
+    def positive_int(key, default):
+        value = scaling.get(key, default)
+        try:
+            value = int(value)
+            assert value >= 1
+        except (TypeError, ValueError, AssertionError):
+            _error("invalid 'process.%s.scaling.%s': %s, must be a number from 1" % (kind, key, value))
+        return value
+
+    if "max" not in scaling:
+        _error("missing 'process.%s.scaling.max'" % kind)
+    minimum = positive_int("min", 1)
+    maximum = positive_int("max", None)
+    initial = positive_int("initial", minimum)
+    if not minimum <= initial <= maximum:
+        _error("invalid 'process.%s.scaling': min (%d) <= initial (%d) <= max (%d) expected" % (kind, minimum, initial, maximum))
+    algo = scaling.get("algo", UWSGI_CHEAPER_ALGOS[0])
+    if algo not in UWSGI_CHEAPER_ALGOS:
+        _error("invalid 'process.%s.scaling.algo': %s, must be one of %s" % (kind, algo, ", ".join(UWSGI_CHEAPER_ALGOS)))
+    return {
+        "min": minimum,
+        "max": maximum,
+        "initial": initial,
+        "step": positive_int("step", 1),
+        "algo": algo,
+        "overload": positive_int("overload", None) if scaling.get("overload") is not None else None,
+    }
+
+
+def get_process_autoscale(app, kind):
+    """
+    The 'process.<kind>.autoscale' policy of an app, None when its worker count only changes with 'scale'.
+    Returns {min, max, step, cooldown, latency, backlog, busy}: the process gets more workers when
+    a signal reaches its threshold, and fewer when all of them are under half of it
+    """
+    policy = parse_app_processes(app).get(kind, {}).get("autoscale")
+    if not policy:
+        return None
+    if not isinstance(policy, dict):
+        _error("invalid 'process.%s.autoscale', must be a mapping with 'min' and 'max'" % kind)
+
+    def number(key, default, minimum=1, maximum=None):
+        value = policy.get(key, default)
+        try:
+            value = int(value)
+            assert value >= minimum and (maximum is None or value <= maximum)
+        except (TypeError, ValueError, AssertionError):
+            _error("invalid 'process.%s.autoscale.%s': %s, must be a number from %d%s"
+                   % (kind, key, value, minimum, " to %d" % maximum if maximum else ""))
+        return value
+
+    if "max" not in policy:
+        _error("missing 'process.%s.autoscale.max'" % kind)
+    minimum = number("min", 1)
+    maximum = number("max", None)
+    if minimum > maximum:
+        _error("invalid 'process.%s.autoscale': min (%d) is over max (%d)" % (kind, minimum, maximum))
+    return {
+        "min": minimum,
+        "max": maximum,
+        "step": number("step", 1),
+        "cooldown": number("cooldown", AUTOSCALE_COOLDOWN, 0),
+        "latency": number("latency", None) if policy.get("latency") is not None else None,
+        "backlog": number("backlog", 1),
+        "busy": number("busy", 80, 1, 100),
+    }
+
+
+def get_cheaper_settings(scaling):
+    """ uWSGI cheaper settings of a python wsgi worker, none when it has a fixed number of processes """
+    # the cheaper subsystem needs at least one process to spawn on demand
+    if not scaling or scaling["min"] == scaling["max"]:
+        return []
+    settings = [
+        ('cheaper-algo', scaling['algo']),
+        ('cheaper', scaling['min']),
+        ('cheaper-initial', scaling['initial']),
+        ('cheaper-step', scaling['step']),
+    ]
+    if scaling['overload']:
+        settings.append(('cheaper-overload', scaling['overload']))
+    return settings
+
+
+def get_uwsgi_stats_socket(app, kind, ordinal=1):
+    """ The uWSGI stats server of a worker """
+    return join(UWSGI_ROOT, "%s___%s.%d.stats.sock" % (app, kind, ordinal))
+
+
+def read_uwsgi_stats(path):
+    """ The stats of a running uWSGI worker (its master dumps them as json and closes), None when it is down """
+    try:
+        s = socket(AF_UNIX, SOCK_STREAM)
+        s.settimeout(1)
+        s.connect(path)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        s.close()
+        return json.loads(b"".join(chunks).decode("utf8", "ignore"))
+    except (OSError, ValueError):
+        return None
+
+
+def read_app_processes_stats(app):
+    """
+    The uWSGI stats of the running workers of an app, {kind: [stats, ...]}.
+    Workers which are down or not answering are left out
+    """
+    stats = defaultdict(list)
+    for ini in sorted(glob(join(UWSGI_ENABLED, "%s___*.ini" % app))):
+        match = re.match(r"^%s___(.+)\.(\d+)\.ini$" % re.escape(app), basename(ini))
+        if not match:
+            continue
+        data = read_uwsgi_stats(get_uwsgi_stats_socket(app, match.group(1), int(match.group(2))))
+        if data:
+            stats[match.group(1)].append(data)
+    return dict(stats)
+
+
+def get_process_signals(stats):
+    """
+    The load of a process from the uWSGI stats of its workers: {latency, backlog, busy}.
+    latency: average response time in ms (None before any request), backlog: requests waiting
+    in the listen queues, busy: % of the processes serving a request (cheap ones included)
+    """
+    processes = [w for data in stats for w in data.get("workers", [])]
+    # avg_rt is in microseconds
+    served = [w["avg_rt"] for w in processes if w.get("requests") and w.get("avg_rt")]
+    return {
+        "latency": round(sum(served) / len(served) / 1000.0, 1) if served else None,
+        "backlog": sum(data.get("listen_queue", 0) for data in stats),
+        "busy": round(100.0 * len([w for w in processes if w.get("status") == "busy"]) / len(processes)) if processes else 0,
+    }
+
+
+def read_process_usage(pids):
+    """ (cpu ticks, rss bytes) used by these processes, from /proc. Processes which are gone count for nothing """
+    page_size = sysconf("SC_PAGE_SIZE")
+    cpu = rss = 0
+    for pid in pids:
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                # the fields after the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/%d/statm" % pid) as f:
+                pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu += int(fields[11]) + int(fields[12])
+        rss += pages * page_size
+    return cpu, rss
+
+
+def sample_process(stats):
+    """ A record of SERIES_FIELDS for a process, from the uWSGI stats of its workers """
+    processes = [w for data in stats for w in data.get("workers", [])]
+    signals = get_process_signals(stats)
+    pids = [data.get("pid") for data in stats] + [w.get("pid") for w in processes] + \
+        [d.get("pid") for data in stats for d in data.get("daemons", [])]
+    cpu, rss = read_process_usage({pid for pid in pids if pid})
+    latency = signals["latency"]
+    return {
+        "time": time(),
+        "requests": sum(w.get("requests", 0) for w in processes),
+        "tx": sum(w.get("tx", 0) for w in processes),
+        "cpu": cpu,
+        "rss": rss,
+        "latency": float("nan") if latency is None else latency,
+        "busy": signals["busy"],
+        "backlog": signals["backlog"],
+        "workers": len(stats),
+        "processes": len([w for w in processes if w.get("status") != "cheap"]),
+    }
+
+
+def get_series_file(app, kind):
+    return join(SERIES_ROOT, app, "%s.ring" % kind)
 
-    if kind != 'static':
-        with open(available, 'w') as h:
-            h.write('[uwsgi]\n')
-            for k, v in settings:
-                h.write("{k:s} = {v}\n".format(**locals()))
-        copyfile(available, enabled)
+
+def append_series(app, kind, record):
+    """
+    Append a record to the ring buffer of a process: a fixed size file holding the
+    last SERIES_SLOTS records, written in place through mmap
+    """
+    import mmap
+    import struct
+    header, item = struct.Struct("<8sIQ"), struct.Struct(SERIES_FORMAT)
+    filename = get_series_file(app, kind)
+    size = header.size + SERIES_SLOTS * item.size
+    if not exists(filename) or getsize(filename) != size:
+        # a new ring, or SERIES_SLOTS changed: start over
+        makedirs(dirname(filename), exist_ok=True)
+        tmp = join(dirname(filename), ".%s.%d.tmp" % (basename(filename), getpid()))
+        with open(tmp, "wb") as f:
+            f.write(header.pack(SERIES_MAGIC, SERIES_SLOTS, 0))
+            f.truncate(size)
+        rename(tmp, filename)
+    with open(filename, "r+b") as f, mmap.mmap(f.fileno(), size) as ring:
+        magic, slots, count = header.unpack_from(ring)
+        item.pack_into(ring, header.size + (count % slots) * item.size, *[record[k] for k in SERIES_FIELDS])
+        # readers only look at the slots the count covers
+        header.pack_into(ring, 0, magic, slots, count + 1)
+
+
+def read_series(app, kind, since=None, last=None):
+    """
+    The records of a process, oldest first: the ones after 'since' (a timestamp),
+    or the 'last' ones only, read without loading the whole ring
+    """
+    import struct
+    header, item = struct.Struct("<8sIQ"), struct.Struct(SERIES_FORMAT)
+    records = []
+    try:
+        with open(get_series_file(app, kind), "rb") as f:
+            magic, slots, count = header.unpack(f.read(header.size))
+            if magic != SERIES_MAGIC:
+                return []
+            first = max(0, count - slots, count - last if last else 0)
+            for n in range(first, count):
+                f.seek(header.size + (n % slots) * item.size)
+                record = dict(zip(SERIES_FIELDS, item.unpack(f.read(item.size))))
+                if since is None or record["time"] >= since:
+                    records.append(record)
+    except (OSError, struct.error):
+        return []
+    return records
+
+
+def series_rates(records):
+    """
+    The rows shown from consecutive records: {time, rps, latency, rss, cpu, busy, backlog, workers, processes}.
+    Counters going down (workers restarted) give no rate for that interval
+    """
+    ticks = sysconf("SC_CLK_TCK")
+    rows = []
+    for previous, record in zip(records, records[1:]):
+        elapsed = record["time"] - previous["time"]
+        if elapsed <= 0:
+            continue
+        requests = record["requests"] - previous["requests"]
+        cpu = record["cpu"] - previous["cpu"]
+        rows.append({
+            "time": record["time"],
+            "rps": requests / elapsed if requests >= 0 else None,
+            "cpu": 100.0 * cpu / ticks / elapsed if cpu >= 0 else None,
+            "latency": None if record["latency"] != record["latency"] else record["latency"],
+            "rss": record["rss"],
+            "busy": record["busy"],
+            "backlog": record["backlog"],
+            "workers": record["workers"],
+            "processes": record["processes"],
+        })
+    return rows
+
+
+def list_series(app):
+    """ The processes of an app which have a metrics history """
+    return sorted(splitext(f)[0] for f in listdir(join(SERIES_ROOT, app)) if f.endswith(".ring")) \
+        if exists(join(SERIES_ROOT, app)) else []
+
+
+def sample_app(app):
+    """ Append a record to the metrics history of each running process of an app """
+    for kind, stats in read_app_processes_stats(app).items():
+        append_series(app, kind, sample_process(stats))
+
+
+def parse_duration(value):
+    """ Seconds in a duration like '90s', '30m', '1h' or '2d' (seconds without unit) """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$", str(value))
+    if not match:
+        _error("invalid duration '%s', ie: 30m, 1h, 2d" % value)
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+
+def render_uwsgi_env(env):
+    """ The env shared by the workers of an app, as an ini they include """
+    return '[uwsgi]\n' + ''.join("env = {}={}\n".format(k, v) for k, v in env.items())
 
 
 def cleanup_uwsgi_enabled_ini(app):
@@ -1059,85 +2444,524 @@ def cleanup_uwsgi_enabled_ini(app):
         return True
 
 
-def remove_nginx_conf(app):
-    nginx_conf = join(NGINX_ROOT, "%s.conf" % app)
-    if exists(nginx_conf):
-        remove(nginx_conf)
+def write_file_atomic(filename, buffer):
+    """ Write a file through a hidden temp file and a rename, readers never see a partial file """
+    tmp = join(dirname(filename), ".%s.%d.tmp" % (basename(filename), getpid()))
+    with open(tmp, "w") as h:
+        h.write(buffer)
+    rename(tmp, filename)
 
-def multi_tail(app, filenames, catch_up=20):
-    """Tails multiple log files"""
 
-    # Seek helper
-    def peek(handle):
-        where = handle.tell()
-        line = handle.readline()
-        if not line:
-            handle.seek(where)
-            return None
-        return line
+def file_digest(filename):
+    """ sha256 of a file content, None if it doesn't exist """
+    if not exists(filename):
+        return None
+    with open(filename, "rb") as h:
+        return sha256(h.read()).hexdigest()
 
-    inodes = {}
-    files = {}
-    prefixes = {}
 
-    # Set up current state for each log file
-    for f in filenames:
-        prefixes[f] = splitext(basename(f))[0]
-        files[f] = open(f, "rt", encoding="utf-8", errors="ignore")
-        inodes[f] = stat(f).st_ino
-        files[f].seek(0, 2)
+def write_file_if_changed(filename, buffer):
+    """ Write a file atomically unless it already has this content, return whether it was written """
+    if file_digest(filename) == sha256(buffer.encode("utf8")).hexdigest():
+        return False
+    write_file_atomic(filename, buffer)
+    return True
 
-    longest = max(map(len, prefixes.values()))
 
-    # Grab a little history (if any)
-    for f in filenames:
-        for line in deque(open(f, "rt", encoding="utf-8", errors="ignore"), catch_up):
-            yield "{} | {}".format(prefixes[f].ljust(longest), line)
+def write_nginx_conf(app, buffer):
+    """ Stage the nginx conf of an app, nginx picks it up on the next reload_nginx(). Returns False if unchanged """
+    nginx_conf = join(NGINX_ROOT, "%s.conf" % app)
+    if exists(nginx_conf):
+        # the app keeps the quic 'reuseport' it holds
+        with open(nginx_conf) as h:
+            held = {address for _, address, reuseport in NGINX_QUIC_LISTEN.findall(h.read()) if reuseport}
+        buffer = NGINX_QUIC_LISTEN.sub(lambda m: "{}{}:443 quic{};".format(
+            m.group(1), m.group(2), " reuseport" if m.group(2) in held else ""), buffer)
+    if not write_file_if_changed(nginx_conf, buffer):
+        return False
+    nginx_conf_changed()
+    return True
 
-    while True:
-        updated = False
-        # Check for updates on every file
-        for f in filenames:
-            line = peek(files[f])
-            if line:
-                updated = True
-                yield "{} | {}".format(prefixes[f].ljust(longest), line)
-
-        if not updated:
-            sleep(1)
-            # Check if logs rotated
-            for f in filenames:
-                if exists(f):
-                    if stat(f).st_ino != inodes[f]:
-                        files[f] = open(f)
-                        inodes[f] = stat(f).st_ino
-                else:
-                    filenames.remove(f)
 
-def _delete_app(app, delete_app=True, remove_certs=True):
-    
-    # on destroy
-    run_app_scripts(app, "destroy")
-    
-    l = [SETTINGS_ROOT, LOG_ROOT, METRICS_ROOT]
-    if delete_app:
-        l.extend([APP_ROOT, GIT_ROOT, ENV_ROOT])
-        
-    nginx_l = ['conf', 'sock']
+def remove_nginx_conf(app):
+    nginx_conf = join(NGINX_ROOT, "%s.conf" % app)
+    if exists(nginx_conf):
+        remove(nginx_conf)
+        nginx_conf_changed()
+
+
+def nginx_conf_changed():
+    """ Mark an nginx conf as changed, for the next reload_nginx() """
+    with _NGINX_PENDING_LOCK:
+        _NGINX_PENDING["changed"] = time()
+
+
+def reload_nginx():
+    """
+    Request a single reload for all the changes made by this process, once the confs
+    changed since the last successful 'nginx -t' (by any sailor process) are validated.
+    Reloads are spaced by NGINX_RELOAD_WINDOW, and skipped when another sailor process
+    already reloaded after our changes and there was nothing left to validate.
+    """
+    changed = _NGINX_PENDING["changed"]
+    if changed is None:
+        return
+    with open(NGINX_RELOAD_LOCK, "a") as lock:
+        flock(lock, LOCK_EX)
+        started = monotonic()
+        balance_quic_reuseport()
+        # an earlier reload may have validated before our conf was written, or not at all
+        validated = read_nginx_validated()
+        try:
+            pending = any(getmtime(conf) >= validated for conf in glob(join(NGINX_ROOT, "*.conf")))
+        except OSError:
+            # a conf removed meanwhile
+            pending = True
+        removed = remove_broken_nginx_confs() if pending else {}
+        last = read_nginx_reload_stats()["last"]
+        if last and last >= changed and not removed:
+            echo("-------> nginx reload already done by another deploy")
+        else:
+            if last and time() - last < NGINX_RELOAD_WINDOW:
+                sleep(NGINX_RELOAD_WINDOW - (time() - last))
+            requested = time()
+            with open(NGINX_RELOAD_TRIGGER, "w") as h:
+                h.write("%f\n" % requested)
+            duration = monotonic() - started
+            add_nginx_reload(requested, duration, removed)
+            echo("-------> nginx reload requested ({:.2f}s)".format(duration))
+    with _NGINX_PENDING_LOCK:
+        # a conf changed by another thread meanwhile waits for the next reload
+        if _NGINX_PENDING["changed"] == changed:
+            _NGINX_PENDING["changed"] = None
+
+def balance_quic_reuseport():
+    """
+    nginx wants 'reuseport' on exactly one 'quic' listen per address: keep it on the app
+    holding it, or move it to the first app listening there, and drop it from the others
+    """
+    confs = {}
+    for conf in sorted(glob(join(NGINX_ROOT, "*.conf"))):
+        try:
+            with open(conf) as h:
+                confs[conf] = h.read()
+        except OSError:
+            continue
+    first, holders = {}, {}
+    for conf, buffer in confs.items():
+        for _, address, reuseport in NGINX_QUIC_LISTEN.findall(buffer):
+            first.setdefault(address, conf)
+            if reuseport:
+                holders.setdefault(address, conf)
+    owners = dict(first, **holders)
+    for conf, buffer in confs.items():
+        def listen(match):
+            reuseport = " reuseport" if owners[match.group(2)] == conf else ""
+            return "{}{}:443 quic{};".format(match.group(1), match.group(2), reuseport)
+        write_file_if_changed(conf, NGINX_QUIC_LISTEN.sub(listen, buffer))
+
+
+def read_nginx_validated():
+    """ When the last successful 'nginx -t' started: the confs older than that are valid """
+    try:
+        with open(NGINX_VALIDATED) as h:
+            return float(h.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def nginx_config_errors():
+    """ Run 'nginx -t' once, return {app: error} for the app confs it complains about """
+    started = time()
+    try:
+        check_output("nginx -t", stderr=STDOUT, env=environ, shell=True)
+        write_file_atomic(NGINX_VALIDATED, "%f\n" % started)
+        return {}
+    except Exception as e:
+        output = getattr(e, "output", b"") or b""
+        output = output.decode("utf8", "ignore")
+    pattern = re.escape(NGINX_ROOT) + r"/([^/\s:]+)\.conf"
+    errors = {}
+    for line in output.splitlines():
+        match = re.search(pattern, line)
+        if match:
+            errors.setdefault(match.group(1), line)
+    return errors
+
+
+def remove_broken_nginx_confs():
+    """ Remove the app confs rejected by 'nginx -t', until nginx accepts the config. Returns the apps removed """
+    removed = {}
+    while True:
+        errors = {k: v for k, v in nginx_config_errors().items() if k not in removed}
+        if not errors:
+            return removed
+        for app, error in errors.items():
+            echo("!!!!!!!ERROR: [nginx config] {}".format(error), fg='red')
+            echo("!!!!!!!ERROR: removing broken nginx config for '{}'.".format(app), fg='red')
+            remove_nginx_conf(app)
+            removed[app] = error
+
+
+class _QuantileSketch(object):
+    """
+    Streaming percentiles with a bounded relative error: values are counted in log-spaced
+    buckets (as DDSketch), memory grows with the range of the values, not their number
+    """
+
+    def __init__(self, accuracy=0.01):
+        import math
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.log = math.log
+        self.buckets = defaultdict(int)
+        self.zeros = self.count = self.total = 0
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            self.buckets[int(-(-self.log(value) // self.log_gamma))] += 1
+
+    def percentile(self, pct):
+        """ Nearest-rank percentile, as percentile() """
+        if not self.count:
+            return None
+        rank = max(int(-(-pct * self.count // 100)), 1)
+        seen = self.zeros
+        if seen >= rank:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # the middle of the bucket, never over the largest value seen
+                return min(self.max, 2 * self.gamma ** index / (self.gamma + 1))
+        return self.max
+
+
+def parse_log_time(value, _cache={}):
+    """ Timestamp of a uWSGI 'ltime' (18/Oct/2026:19:04:50 +0000), None if it isn't one """
+    # parsing is slow, the minutes are cached and the seconds added
+    key = value[:17] + value[20:]
+    minute = _cache.get(key)
+    if minute is None:
+        try:
+            minute = datetime.strptime(key, "%d/%b/%Y:%H:%M %z").timestamp()
+        except ValueError:
+            return None
+        if len(_cache) > 1024:
+            _cache.clear()
+        _cache[key] = minute
+    try:
+        return minute + int(value[18:20])
+    except ValueError:
+        return None
+
+
+def parse_access_line(line):
+    """ (time, method, uri, status, msecs) of an access log line, None for the other lines """
+    match = re.search(ACCESS_LOG_REGEXP, line)
+    if not match:
+        return None
+    when = parse_log_time(match.group("time"))
+    if when is None:
+        return None
+    return when, match.group("method"), match.group("uri"), int(match.group("status")), int(match.group("msecs"))
+
+
+def seek_log_since(handle, since):
+    """
+    Move a binary log file handle to the first line at or after 'since', by bisecting on
+    the times of its access lines, so only the window is read. Lines are in time order.
+    Returns False when no dated line was found, the handle is then left anywhere
+    """
+    def time_at(offset):
+        handle.seek(offset)
+        if offset:
+            # the end of the line we landed in
+            handle.readline()
+        for _ in range(100):
+            start = handle.tell()
+            line = handle.readline()
+            if not line:
+                return None, start
+            entry = parse_access_line(line.decode("utf8", "ignore"))
+            if entry:
+                return entry[0], start
+        return None, start
+
+    low, high = 0, handle.seek(0, 2)
+    dated = False
+    while high - low > 4096:
+        middle = (low + high) // 2
+        when, _ = time_at(middle)
+        dated = dated or when is not None
+        if when is None or when >= since:
+            high = middle
+        else:
+            low = middle
+    if not dated and time_at(low)[0] is None:
+        return False
+    handle.seek(low)
+    if low:
+        handle.readline()
+    return True
+
+
+def normalize_uri(uri):
+    """ The path of a URI with its ids (numbers, uuids, hashes) replaced, so they aggregate """
+    path = uri.split("?", 1)[0]
+    return "/".join(":id" if re.match(r"^(\d+|[0-9a-fA-F-]{16,})$", part) else part for part in path.split("/"))
+
+
+def read_access_stats(filenames, since=None, until=None):
+    """
+    Stream access log files into bounded aggregates: a latency sketch, counts per status
+    and per minute, and {uri: [count, total msecs, max msecs]} for the slowest URIs
+    """
+    stats = {"latency": _QuantileSketch(), "status": defaultdict(int), "minutes": defaultdict(int), "uris": {}}
+    for filename in filenames:
+        try:
+            handle = open(filename, "rb")
+        except OSError:
+            continue
+        with handle:
+            if since:
+                seek_log_since(handle, since)
+            for line in handle:
+                entry = parse_access_line(line.decode("utf8", "ignore"))
+                if not entry:
+                    continue
+                when, method, uri, status, msecs = entry
+                if (since and when < since) or (until and when > until):
+                    continue
+                stats["latency"].add(msecs)
+                stats["status"][status] += 1
+                stats["minutes"][int(when // 60) * 60] += 1
+                key = "%s %s" % (method, normalize_uri(uri))
+                item = stats["uris"].get(key)
+                if item is None:
+                    if len(stats["uris"]) >= STATS_URI_LIMIT:
+                        # drop the least seen half, the next eviction is STATS_URI_LIMIT / 2 URIs away
+                        kept = sorted(stats["uris"].items(), key=lambda i: i[1][0], reverse=True)[:STATS_URI_LIMIT // 2]
+                        stats["uris"] = dict(kept)
+                    item = stats["uris"][key] = [0, 0, 0]
+                item[0] += 1
+                item[1] += msecs
+                item[2] = max(item[2], msecs)
+    return stats
+
+
+class _Inotify(object):
+    """ Names of the files changing in a directory, from inotify through ctypes (Linux) """
+
+    IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_CLOEXEC, IN_NONBLOCK = 0x4000, 0o2000000, 0o4000
+
+    def __init__(self, path):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC | self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        mask = self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            self.close()
+            raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+    def wait(self, timeout):
+        """
+        The names changed since the last call, waiting up to 'timeout' seconds for one.
+        None when the event queue overflowed: any file may have changed
+        """
+        import os
+        import struct
+        from select import select
+        if not select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        names, offset = set(), 0
+        # struct inotify_event: wd, mask, cookie, len, then the name padded with NULs
+        while offset + 16 <= len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, offset)
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            names.add(data[offset + 16:offset + 16 + length].rstrip(b"\0").decode("utf8", "ignore"))
+            offset += 16 + length
+        return names
+
+    def close(self):
+        import os
+        os.close(self.fd)
+
+
+def tail_lines(handle, count):
+    """ The last 'count' lines of a binary file handle, reading blocks from its end """
+    end = position = handle.seek(0, 2)
+    data = b""
+    while position > 0 and data.count(b"\n") <= count:
+        position = max(0, position - 8192)
+        handle.seek(position)
+        data = handle.read(end - position)
+    handle.seek(end)
+    lines = data.splitlines(True)
+    # the first one may be cut
+    return lines[-count:] if count else []
+
+
+def multi_tail(app, process='*', catch_up=20, since=None, grep=None, follow=True):
+    """
+    Tail the logs of an app matching 'process', yielding '<log> | <line>'.
+    Starts with the last 'catch_up' lines of each log, or the lines after 'since' (a timestamp).
+    Follows new lines as they are written (inotify, or polling every LOG_POLL_INTERVAL),
+    rotated logs and logs created later. 'grep' is a regular expression the lines must match
+    """
+    from fnmatch import fnmatch
+    log_dir = join(LOG_ROOT, app)
+    pattern = process + '.*.log'
+    files = {}
+    grep = re.compile(grep) if grep else None
+
+    def accept(line):
+        if grep and not grep.search(line):
+            return False
+        if since:
+            entry = parse_access_line(line)
+            if entry and entry[0] < since:
+                return False
+        return True
+
+    def output(name, lines):
+        longest = max(map(len, [splitext(n)[0] for n in files] + [splitext(name)[0]]))
+        for line in lines:
+            line = line.decode("utf8", "ignore")
+            if accept(line):
+                yield "{} | {}".format(splitext(name)[0].ljust(longest), line)
+
+    def open_log(name, history):
+        """ Track a log, starting with its history: the last lines, the ones after 'since', or none """
+        try:
+            handle = open(join(log_dir, name), "rb")
+        except OSError:
+            return []
+        files[name] = {"handle": handle, "inode": fstat(handle.fileno()).st_ino, "partial": b""}
+        if not history:
+            return []
+        if since:
+            if fstat(handle.fileno()).st_mtime < since:
+                # nothing was written in the window
+                handle.seek(0, 2)
+                return []
+            if seek_log_since(handle, since):
+                return read_lines(name, final=not follow)
+            # no timestamps to bisect on, the lines since can't be told apart
+            echo("-----> '{}' has no timestamps, showing its last {} lines".format(name, catch_up), fg='yellow', err=True)
+        return tail_lines(handle, catch_up)
+
+    def read_lines(name, final=False):
+        """ The complete lines written since the last read, a partial one waits for its end """
+        state = files[name]
+        data = state["partial"] + state["handle"].read()
+        lines = data.splitlines(True)
+        state["partial"] = b""
+        if lines and not lines[-1].endswith(b"\n") and not final:
+            state["partial"] = lines.pop()
+        return lines
+
+    def check(name):
+        """ New lines of a log, following it when it is rotated, truncated or removed """
+        path = join(log_dir, name)
+        try:
+            st = stat(path)
+        except OSError:
+            st = None
+        lines = []
+        if name in files:
+            state = files[name]
+            lines = read_lines(name)
+            if st is None or st.st_ino != state["inode"] or st.st_size < state["handle"].tell():
+                # rotated: what was left in the old file, then the new one from its start
+                lines += read_lines(name, final=True)
+                state["handle"].close()
+                del files[name]
+        if st is not None and name not in files and fnmatch(name, pattern):
+            open_log(name, history=False)
+            lines += read_lines(name)
+        return lines
+
+    names = sorted(n for n in listdir(log_dir) if fnmatch(n, pattern)) if exists(log_dir) else []
+    if not names:
+        return
+    for name in names:
+        for line in output(name, open_log(name, history=True)):
+            yield line
+    if not follow:
+        for state in files.values():
+            state["handle"].close()
+        return
+
+    try:
+        inotify = _Inotify(log_dir)
+    except (OSError, AttributeError):
+        inotify = None
+    try:
+        while True:
+            if inotify:
+                changed = inotify.wait(1)
+            else:
+                sleep(LOG_POLL_INTERVAL)
+                changed = None
+            if changed is None:
+                # polling, or events were lost: check every file
+                changed = set(listdir(log_dir)) | set(files)
+            for name in sorted(changed):
+                if name in files or fnmatch(name, pattern):
+                    for line in output(name, check(name)):
+                        yield line
+    finally:
+        if inotify:
+            inotify.close()
+        for state in files.values():
+            state["handle"].close()
+
+
+def _delete_app(app, delete_app=True, remove_certs=True):
+    
+    # on destroy
+    run_app_scripts(app, "destroy")
+    
+    delete_settings(app)
+    l = [SETTINGS_ROOT, LOG_ROOT, METRICS_ROOT, SERIES_ROOT]
+    if delete_app:
+        # 'start' keeps them: the web ports, the web slot and the releases outlive a restart
+        delete_app_state(app)
+        l.extend([APP_ROOT, GIT_ROOT, ENV_ROOT, RELEASES_ROOT])
+        
+    nginx_l = ['conf', 'sock']
     if remove_certs:
         nginx_l.extend(['key', 'cert'])
                 
     for p in [join(x, app) for x in l]:
-        if exists(p):
+        if islink(p):
+            unlink(p)
+        elif exists(p):
             rmtree(p)
 
-    for p in [join(x, '{}*.ini'.format(app)) for x in [UWSGI_AVAILABLE, UWSGI_ENABLED]]:
+    for p in [join(x, '{}*.ini'.format(app)) for x in [UWSGI_AVAILABLE, UWSGI_ENABLED]] + [join(UWSGI_ROOT, '{}___*.stats.sock'.format(app))]:
         g = glob(p)
         if len(g):
             for f in g:
                 remove(f)
 
+    remove_nginx_conf(app)
     nginx_files = [join(NGINX_ROOT, "{}.{}".format(app, x)) for x in nginx_l]
+    nginx_files += glob(join(NGINX_ROOT, "{}.*.sock".format(app)))
     for f in nginx_files:
         if exists(f):
             remove(f)
@@ -1207,26 +3031,485 @@ def _show_info(app, enabled_files, minimal=False, show_workers=True, show_metric
         if show_workers:
             env = read_settings(app, 'SCALING')
             if env:
+                stats = read_app_processes_stats(app) if running else {}
                 print()      
                 print(":: Processes workers")
                 for k, v in env.items():
-                    print(" - %s: %s" % (k, v)) 
+                    # SCALING keys are upper-cased by write_settings, the stats are keyed by kind
+                    live = [w for data in stats.get(k.lower(), []) for w in data.get("workers", [])]
+                    if live:
+                        # processes the cheaper subsystem stopped are reported as 'cheap'
+                        active = [w for w in live if w.get("status") != "cheap"]
+                        busy = [w for w in active if w.get("status") == "busy"]
+                        print(" - %s: %s (processes: %d/%d live, %d busy)" % (k, v, len(active), len(live), len(busy)))
+                    else:
+                        print(" - %s: %s" % (k, v)) 
         
         if show_envs:  
-            env_file = join(SETTINGS_ROOT, app, 'ENV')
-            if exists(env_file):
+            if settings:
                 print()   
                 print(":: Envs")
                 print("")   
-                print(open(env_file).read().strip()) 
-                print("")             
+                for section in ['ENV', 'CUSTOM', 'SCALING']:
+                    data = read_settings(app, section)
+                    if data:
+                        print("[%s]" % section)
+                        for k, v in data.items():
+                            print("%s = %s" % (k, v))
+                        print("")             
             else:
                 print("Error: no workers found for app '%s'." % app)
         print()
     
 
+class _ThreadOutput(object):
+    """ Stand-in for sys.stdout/sys.stderr sending the writes of a bulk worker thread to its own buffer """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        return (getattr(self.local, "buffer", None) or self.stream).write(data)
+
+    def flush(self):
+        (getattr(self.local, "buffer", None) or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def call(*args, **kwargs):
+    """
+    subprocess.call, except in bulk worker threads: the output of the command is captured
+    into the thread's buffer instead of going to fd 1 mixed with the other jobs
+    """
+    if getattr(getattr(sys.stdout, "local", None), "buffer", None) is None or "stdout" in kwargs:
+        return subprocess.call(*args, **kwargs)
+    kwargs.setdefault("stderr", STDOUT)
+    result = subprocess.run(*args, stdout=PIPE, **kwargs)
+    sys.stdout.write(result.stdout.decode("utf8", "replace"))
+    return result.returncode
+
+
+def run_bulk(apps, func, jobs=None, summary=True):
+    """
+    Run func(app) for many apps on a bounded thread pool.
+    Each app's output is buffered and printed in the order of 'apps',
+    a failing app (exception or exit) doesn't stop the others.
+    Returns {app: (ok, duration)}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = max(1, int(jobs or cpu_count() or 1))
+    _stdout, _stderr = sys.stdout, sys.stderr
+    # the agent already routes each thread's output
+    if not isinstance(_stdout, _ThreadOutput):
+        sys.stdout, sys.stderr = _ThreadOutput(_stdout), _ThreadOutput(_stderr)
+
+    def run(app):
+        buffer = StringIO()
+        sys.stdout.local.buffer = sys.stderr.local.buffer = buffer
+        started = monotonic()
+        ok = True
+        try:
+            func(app)
+        except SystemExit as e:
+            ok = e.code in (None, 0)
+        except Exception as e:
+            echo("-------> '{}' failed: {}".format(app, e), fg='red')
+            ok = False
+        finally:
+            sys.stdout.local.buffer = sys.stderr.local.buffer = None
+        return ok, monotonic() - started, buffer.getvalue()
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [(app, pool.submit(run, app)) for app in apps]
+            for app, future in futures:
+                ok, duration, output = future.result()
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                results[app] = (ok, duration)
+    finally:
+        sys.stdout, sys.stderr = _stdout, _stderr
+
+    if summary and results:
+        print()
+        print(":: Summary")
+        longest = max(map(len, results))
+        for app, (ok, duration) in results.items():
+            echo(" - %s  %s  %6.2fs" % (app.ljust(longest), "ok    " if ok else "failed", duration), fg=None if ok else "red")
+        failed = len([1 for ok, _ in results.values() if not ok])
+        print(" %d app(s), %d failed, %.2fs total" % (len(results), failed, sum(d for _, d in results.values())))
+    return results
+
+
+def list_apps():
+    """ All the apps, sorted """
+    return sorted(sanitize_app_name(a) for a in listdir(APP_ROOT) if not a.startswith((".", "_")))
+
+
+def autoscale_decision(policy, workers, signals, last_change=None, now=None):
+    """
+    What the autoscaler does with a process running 'workers' workers: (action, target, reason).
+    action is 'up' or 'down', 'blocked' when it would scale up but is at max or cooling down, or 'hold'
+    """
+    now = now or time()
+    if workers < policy["min"]:
+        return "up", policy["min"], "under min (%d)" % policy["min"]
+    if workers > policy["max"]:
+        return "down", policy["max"], "over max (%d)" % policy["max"]
+    over, under = [], True
+    for key, unit in [("latency", "ms"), ("backlog", ""), ("busy", "%")]:
+        threshold, value = policy[key], signals.get(key)
+        if threshold is None or value is None:
+            continue
+        if value >= threshold:
+            over.append("%s %s%s >= %s%s" % (key, value, unit, threshold, unit))
+        if value >= threshold / 2.0:
+            under = False
+    if over:
+        action, target, reason = "up", min(policy["max"], workers + policy["step"]), ", ".join(over)
+        if target == workers:
+            return "blocked", workers, reason + ", at max"
+    elif under:
+        action, target, reason = "down", max(policy["min"], workers - policy["step"]), "all signals under half their threshold"
+        # idle at min, or about to scale back in after a change: nothing worth logging
+        if target == workers or (last_change and now - last_change < policy["cooldown"]):
+            return "hold", workers, reason
+    else:
+        return "hold", workers, "within thresholds"
+    if last_change and now - last_change < policy["cooldown"]:
+        return "blocked", workers, reason + ", cooldown (%ds left)" % (policy["cooldown"] - (now - last_change))
+    return action, target, reason
+
+
+def autoscale_app(app, dry_run=False):
+    """
+    Sample the running processes of an app which have an autoscale policy, log the decisions
+    and apply them through spawn_app. Skipped while the app is deploying.
+    Returns {kind: (action, workers, target)}
+    """
+    # only python wsgi web workers report their load
+    if get_app_runtime(app) != "python" or get_app_config(app).get("WSGI", True) is not True:
+        return {}
+    policies = {kind: get_process_autoscale(app, kind) for kind in parse_app_processes(app) if kind == "web"}
+    policies = {k: v for k, v in policies.items() if v}
+    if not policies:
+        return {}
+    # a scale down holds the deploy lock while its workers drain: pushes go first,
+    # the queue worker waits for the lock and deploys them with the scaling read back
+    with deploy_lock(app, blocking=False) as locked:
+        if not locked or read_queued_deploy(app):
+            echo("-------> '{}' is deploying, autoscale skipped".format(app), fg="yellow")
+            return {}
+        counts = {k.lower(): int(v) for k, v in read_settings(app, 'SCALING').items()}
+        stats = read_app_processes_stats(app)
+        metrics = read_app_metrics(app, ["core.avg_response_time", "rss_size"])
+        decisions, deltas = {}, {}
+        for kind, policy in sorted(policies.items()):
+            # stopped, scaled to 0 by hand or not answering
+            if not counts.get(kind) or kind not in stats:
+                continue
+            workers = counts[kind]
+            signals = get_process_signals(stats[kind])
+            last = read_autoscale_decisions(app, 1, kind, ["up", "down"])
+            action, target, reason = autoscale_decision(policy, workers, signals, last[0]["time"] if last else None)
+            decisions[kind] = (action, workers, target)
+            if action == "hold":
+                continue
+            echo("-------> {}:{} {} {} -> {} ({}){}".format(app, kind, action, workers, target, reason,
+                                                          " [dry run]" if dry_run else ""),
+                 fg="yellow" if action == "blocked" else "green")
+            if dry_run:
+                continue
+            add_autoscale_decision(app, kind, action, {"workers": workers, "target": target, "reason": reason,
+                                                       "signals": signals, "metrics": metrics, "policy": policy})
+            if target != workers:
+                deltas[kind] = target - workers
+        if deltas:
+            spawn_app(app, deltas=deltas)
+            reload_nginx()
+    return decisions
+
+
+def run_every(interval, func, once=False):
+    """
+    Call func(app) for all the apps every 'interval' seconds, an app failing doesn't stop the others.
+    Exits when sailor.py changes, to be restarted by its supervisor
+    """
+    script_mtime = getmtime(BOX_SCRIPT)
+    signal(SIGTERM, lambda *args: exit(0))
+    while True:
+        started = monotonic()
+        for app in list_apps():
+            try:
+                func(app)
+            except SystemExit:
+                # invalid config, already reported
+                pass
+            except Exception as e:
+                echo("-------> '{}' failed: {}".format(app, e), fg="red")
+        if once:
+            return
+        sleep(max(0, interval - (monotonic() - started)))
+        if getmtime(BOX_SCRIPT) != script_mtime:
+            echo("-------> '{}' changed, stopping".format(BOX_SCRIPT))
+            return
+
+
+def run_autoscaler(interval=AUTOSCALE_INTERVAL, once=False, dry_run=False):
+    """ Apply the autoscale policies of all the apps every 'interval' seconds """
+    if not once:
+        echo("-------> autoscaler sampling every {}s (pid {})".format(interval, getpid()), fg="green")
+    run_every(interval, lambda app: autoscale_app(app, dry_run=dry_run), once=once)
+
+
+def run_sampler(interval=SAMPLE_INTERVAL, once=False):
+    """ Record the metrics of the running processes of all the apps every 'interval' seconds """
+    if not once:
+        echo("-------> sampler recording every {}s to '{}' (pid {})".format(interval, SERIES_ROOT, getpid()), fg="green")
+    run_every(interval, sample_app, once=once)
+
+
+# --- Internal commands ---
+
+
+def cmd_init():
+    """Initialize Sailor for 1st time"""
+
+    print_title()
+    echo("-------> running in Python {}".format(".".join(map(str, version_info))))
+
+    # Create required paths
+    for p in [APP_ROOT, GIT_ROOT, ACME_WWW, ENV_ROOT, UWSGI_ROOT, RELEASES_ROOT, WHEELS_ROOT, NPM_CACHE_ROOT, LOCK_ROOT,
+                UWSGI_AVAILABLE, UWSGI_ENABLED, LOG_ROOT, 
+                SETTINGS_ROOT, NGINX_ROOT, METRICS_ROOT, SERIES_ROOT]:
+        if not exists(p):
+            echo("Creating '{}'.".format(p), fg='green')
+            makedirs(p)
+
+    # Set up the uWSGI emperor config
+    settings = [
+        ('chdir',           UWSGI_ROOT),
+        ('emperor',         UWSGI_ENABLED),
+        ('log-maxsize',     UWSGI_LOG_MAXSIZE),
+        ('logto',           join(UWSGI_ROOT, 'uwsgi.log')),
+        ('log-backupname',  join(UWSGI_ROOT, 'uwsgi.old.log')),
+        ('socket',          join(UWSGI_ROOT, 'uwsgi.sock')),
+        ('uid',             getpwuid(getuid()).pw_name),
+        ('gid',             getgrgid(getgid()).gr_name),
+        ('enable-threads',  'true'),
+        ('threads',         '{}'.format((cpu_count() or 1) * 2)),
+    ]
+    with open(join(UWSGI_ROOT, 'uwsgi.ini'), 'w') as h:
+        h.write('[uwsgi]\n')
+        for k, v in settings:
+            h.write("{k:s} = {v}\n".format(**locals()))
+
+    # incron needs the file to exist to watch it
+    if not exists(NGINX_RELOAD_TRIGGER):
+        with open(NGINX_RELOAD_TRIGGER, 'w') as h:
+            h.write('')
+
+    # mark this script as executable (in case we were invoked via interpreter)
+    if not(stat(BOX_SCRIPT).st_mode & S_IXUSR):
+        echo("Setting '{}' as executable.".format(BOX_SCRIPT))
+        chmod(BOX_SCRIPT, stat(BOX_SCRIPT).st_mode | S_IXUSR)
+
+    # ACME
+    install_acme_sh()
+
+
+
+def cmd_git_hook(app):
+    """INTERNAL: Post-receive git hook"""
+
+    app = sanitize_app_name(app)
+
+    # a push updating several refs is deployed once, at its last revision
+    newrev = None
+    for line in stdin:
+        oldrev, rev, refname = line.strip().split(" ")
+        # deleted refs have an all-zero revision
+        if rev.strip("0"):
+            newrev = rev
+    if not newrev:
+        return
+
+    coalesced = enqueue_deploy(app, newrev)
+    echo("-------> '{}' queued for deploy{}".format(newrev[:12], " (replaces a waiting push)" if coalesced else ""), fg='green')
+
+    # the deploy runs detached, the push returns right away
+    log_path = join(LOG_ROOT, app)
+    makedirs(log_path, exist_ok=True)
+    log_file = join(log_path, "deploy.log")
+    offset = getsize(log_file) if exists(log_file) else 0
+    with open(log_file, "a") as log:
+        # the worker doesn't run in the hook's repo: no GIT_DIR, GIT_QUARANTINE_PATH, push options...
+        Popen([sys.executable, BOX_SCRIPT, "deploy-queue", app], cwd=BOX_ROOT, env=git_env(),
+              stdin=DEVNULL, stdout=log, stderr=STDOUT, start_new_session=True)
+
+    push_options = [environ.get("GIT_PUSH_OPTION_%d" % i) for i in range(int(environ.get("GIT_PUSH_OPTION_COUNT", 0)))]
+    if "follow" in push_options:
+        follow_deploy_log(app, log_file, offset)
+    else:
+        echo("-------> deploy log: {} ('git push -o follow' streams it)".format(log_file))
+
+
+def follow_deploy_log(app, log_file, offset=0):
+    """
+    Stream the deploy log of an app until its queue is drained, or no queue worker
+    picked up the waiting push within DEPLOY_FOLLOW_GRACE seconds
+    """
+    idle = monotonic()
+    with open(log_file) as h:
+        h.seek(offset)
+        while True:
+            line = h.readline()
+            if line:
+                stdout.write(line)
+                stdout.flush()
+            elif is_draining_queue(app):
+                idle = monotonic()
+                sleep(0.2)
+            elif read_queued_deploy(app) and monotonic() - idle < DEPLOY_FOLLOW_GRACE:
+                # the worker is starting, or between its unlock and its last queue check
+                sleep(0.2)
+            else:
+                stdout.write(h.read())
+                if read_queued_deploy(app):
+                    echo("-------> no deploy worker picked up the push, push again to deploy it", fg='yellow')
+                break
+
+
+def cmd_git_receive_pack(app):
+    """INTERNAL: Handle git pushes for an app"""
+
+    app = sanitize_app_name(app)
+    app_dir = join(GIT_ROOT, app)
+    hook_path = join(app_dir, 'hooks', 'post-receive')
+    env = globals()
+    env.update(locals())
+
+    if not exists(hook_path):
+        makedirs(app_dir)
+        # Initialize the repository with a hook to this script
+        call("git init --quiet --bare " + app, cwd=GIT_ROOT, shell=True)
+        call("git config receive.advertisePushOptions true", cwd=app_dir, shell=True)
+        with open(hook_path, 'w') as h:
+            h.write("""#!/usr/bin/env bash
+set -e; set -o pipefail;
+cat | BOX_ROOT="{BOX_ROOT:s}" {BOX_SCRIPT:s} git-hook {app:s}""".format(**env))
+        # Make the hook executable by our user
+        chmod(hook_path, stat(hook_path).st_mode | S_IXUSR)
+
+    elif "advertisepushoptions" not in open(join(app_dir, "config")).read().lower():
+        # repos created before the deploy queue: allow 'git push -o follow'
+        call("git config receive.advertisePushOptions true", cwd=app_dir, shell=True)
+
+    call('git-shell -c "{}" '.format(argv[1] + " '{}'".format(app)), cwd=GIT_ROOT, shell=True)
+
+
+def cmd_git_upload_pack(app):
+    """INTERNAL: Handle git upload pack for an app"""
+    app = sanitize_app_name(app)
+    env = globals()
+    env.update(locals())
+    # Handle the actual receive. Will be called with 'git-hook' after it happens
+    call('git-shell -c "{}" '.format(argv[1] + " '{}'".format(app)), cwd=GIT_ROOT, shell=True)
+
+
+def main():
+    _argvs = sys.argv
+    script_name = sys.argv[0].split('/')[-1]
+
+    try:
+        # Internal GIT command
+        if _argvs and len(_argvs) >= 2 and _argvs[1] in INTERNAL_COMMANDS:
+            cmd = sys.argv[1]
+
+            if cmd == "init":
+                cmd_init()
+            elif len(_argvs) >= 3:
+                app = sys.argv[2]
+                if cmd == "git-hook":
+                    cmd_git_hook(app)
+                elif cmd == "deploy-queue":
+                    run_deploy_queue(sanitize_app_name(app))
+                elif cmd == "git-upload-pack":
+                    cmd_git_upload_pack(app)
+                elif cmd == "git-receive-pack":
+                    cmd_git_receive_pack(app)
+        else:
+            cli()
+    finally:
+        # one nginx reload for everything the command changed
+        reload_nginx()
+
+
+def agent_running():
+    """ Whether an agent answers on AGENT_SOCKET """
+    try:
+        with socket(AF_UNIX, SOCK_STREAM) as conn:
+            conn.connect(AGENT_SOCKET)
+        return True
+    except OSError:
+        return False
+
+
+def agent_request(argv):
+    """
+    Run a command through the agent, streaming its output.
+    Returns the exit code, or None when the agent can't take it
+    """
+    try:
+        conn = socket(AF_UNIX, SOCK_STREAM)
+        conn.connect(AGENT_SOCKET)
+    except OSError:
+        return None
+    def messages():
+        # socket errors only, a closed stdout is the caller's
+        try:
+            conn.sendall((json.dumps({"argv": argv, "color": stdout.isatty()}) + "\n").encode("utf8"))
+            for line in conn.makefile(encoding="utf8"):
+                yield json.loads(line)
+        except OSError:
+            pass
+
+    answered = False
+    with conn:
+        for message in messages():
+            if "exit" in message:
+                return message["exit"]
+            answered = True
+            stdout.write(message["out"])
+            stdout.flush()
+    if not answered:
+        return None
+    echo("-------> the agent stopped during the command", fg="red")
+    return 1
+
+
+# Internal commands (git over SSH, deploy queue) are done before click and the
+# user commands are loaded
+if __name__ == "__main__" and len(argv) >= 2 and argv[1] in INTERNAL_COMMANDS:
+    main()
+    exit(0)
+
+# so are the commands the agent serves, in-process only when it doesn't answer
+if __name__ == "__main__" and len(argv) >= 2 and argv[1] in AGENT_COMMANDS and exists(AGENT_SOCKET):
+    _code = agent_request(argv[1:])
+    if _code is not None:
+        exit(_code)
+
+
 # === CLI commands ===
 
+import click
+
+
 @click.group()
 def cli():
     """
@@ -1244,14 +3527,14 @@ https://github.com/mardix/sailor/
 
 @cli.command("ls")
 @click.argument('expanded', required=False)
-def cmd_apps(expanded=None):
+@click.option("-j", "--jobs", type=int, default=None, help="Apps to process concurrently (default: cpu count)")
+def cmd_apps(expanded=None, jobs=None):
     """List all apps"""
     print_title("All apps")
     enabled_files= {a.split("___")[0] for a in listdir(UWSGI_ENABLED) if "___" in a}
-    for app in listdir(APP_ROOT):
-        if not app.startswith((".", "_")):
-            minimal = not expanded
-            _show_info(app, enabled_files=enabled_files, minimal=minimal, show_envs=False)
+    minimal = not expanded
+    run_bulk(list_apps(), lambda app: _show_info(app, enabled_files=enabled_files, minimal=minimal, show_envs=False),
+             jobs=jobs, summary=False)
     print()
 
 @cli.command("start")
@@ -1264,14 +3547,14 @@ def cmd_deploy(app):
     _delete_app(app, delete_app=False, remove_certs=False)
     deploy_app(app)
 
-def _reload_app(app):
+def _reload_app(app, check_nginx=True):
     check_app(app)
     app = sanitize_app_name(app)
     remove_nginx_conf(app)
     write_deployinfo(app, {"deployed": utcnow(), "stopped": 0}) 
     cleanup_uwsgi_enabled_ini(app)
     echo("-------> reloading '{}'...".format(app))
-    spawn_app(app)
+    spawn_app(app, check_nginx=check_nginx)
 
 
 @cli.command("reload")
@@ -1283,14 +3566,21 @@ def cmd_reload(app):
 
 
 @cli.command("reload-all")
-def cmd_reload_all():
+@click.option("-j", "--jobs", type=int, default=None, help="Apps to reload concurrently (default: cpu count)")
+def cmd_reload_all(jobs=None):
     """Reload all apps"""
     print("= Reload all")
-    for app in listdir(APP_ROOT):
-        if not app.startswith((".", "_")):
-            _reload_app(app)
+    run_bulk(list_apps(), lambda app: _reload_app(app, check_nginx=False), jobs=jobs)
+    # validate and reload nginx once for all the apps
+    reload_nginx()
     
 
+def _stop_app(app):
+    remove_nginx_conf(app)
+    cleanup_uwsgi_enabled_ini(app)
+    write_deployinfo(app, {"deployed": 0, "stopped": utcnow()}) 
+    echo("-------> '%s' stopped" % app)
+
 @cli.command("stop")
 @click.argument('app')
 def cmd_stop(app):
@@ -1298,22 +3588,14 @@ def cmd_stop(app):
     echo("Stopping app", fg="green")
     check_app(app)
     app = sanitize_app_name(app)
-    remove_nginx_conf(app)
-    cleanup_uwsgi_enabled_ini(app)
-    write_deployinfo(app, {"deployed": 0, "stopped": utcnow()}) 
-    echo("-------> '%s' stopped" % app)
+    _stop_app(app)
 
 @cli.command("stop-all")
-def cmd_stop_all():
+@click.option("-j", "--jobs", type=int, default=None, help="Apps to stop concurrently (default: cpu count)")
+def cmd_stop_all(jobs=None):
     """Stop all apps"""
     echo("Stopping all apps", fg="green")
-    for app in listdir(APP_ROOT):
-        if not app.startswith((".", "_")):
-            app = sanitize_app_name(app)
-            remove_nginx_conf(app)
-            cleanup_uwsgi_enabled_ini(app)
-            write_deployinfo(app, {"deployed": 0, "stopped": utcnow()}) 
-            echo("-------> '%s' stopped" % app)
+    run_bulk(list_apps(), _stop_app, jobs=jobs)
 
 
 @cli.command("rm")
@@ -1338,16 +3620,26 @@ def cmd_destroy(app, force=False):
 @cli.command("log")
 @click.argument('app')
 @click.argument('process', nargs=1, default='*')
-def cmd_logs(app, process):
+@click.option("--since", default=None, help="Start with the lines logged since, ie: 30m, 1h, 2d")
+@click.option("--grep", default=None, help="Only the lines matching this regular expression")
+@click.option("--no-follow", is_flag=True, default=False, help="Print the lines logged so far and exit")
+@click.option("-n", "--lines", type=int, default=20, help="Lines to start with per log, without --since")
+def cmd_logs(app, process, since=None, grep=None, no_follow=False, lines=20):
     """Tail running logs - [<app>] *[<proc>]"""
 
     check_app(app)
     app = sanitize_app_name(app)
-    logfiles = glob(join(LOG_ROOT, app, process + '.*.log'))
-    if len(logfiles):
-        for line in multi_tail(app, logfiles):
-            print(line.strip())
-    else:
+    if grep:
+        try:
+            re.compile(grep)
+        except re.error as e:
+            _error("invalid --grep '%s': %s" % (grep, e))
+    found = False
+    for line in multi_tail(app, process, catch_up=lines, since=time() - parse_duration(since) if since else None,
+                           grep=grep, follow=not no_follow):
+        found = True
+        print(line.rstrip(), flush=True)
+    if not found and not glob(join(LOG_ROOT, app, process + '.*.log')):
         print("No logs found for app '{}'.".format(app))
 
 
@@ -1389,6 +3681,76 @@ def cmd_ps_scale(app, settings):
             return
     deploy_app(app, deltas)
 
+@cli.command("rollback")
+@click.argument('app')
+@click.argument('rev', required=False)
+@click.option("--force", is_flag=True, help="Roll back even if the release has other dependencies")
+def cmd_rollback(app, rev=None, force=False):
+    """Roll back to a previous release: [<app> [<rev>]]"""
+    check_app(app)
+    app = sanitize_app_name(app)
+    app_path = join(APP_ROOT, app)
+    current = realpath(app_path)
+    releases = [r for r in get_releases(app) if r != current]
+    if rev:
+        releases = [r for r in releases if basename(r).startswith(rev)]
+    if not releases:
+        available = ", ".join(basename(r)[:12] for r in get_releases(app) if r != current) or "none"
+        _error("ERROR: no release to roll back to for '%s' (available: %s)" % (app, available))
+
+    # the release already has its code, only the workers restart: the virtualenv and
+    # node_modules are shared by the releases and keep the dependencies of the current one
+    release = releases[0]
+    rev = basename(release).replace(".inplace", "")
+    if get_dependencies_digest(release) != get_dependencies_digest(current) and not force:
+        _error("ERROR: release '{}' has other dependencies ({}) than the current one, "
+               "push it again to deploy it with its dependencies, or use --force".format(rev, ", ".join(DEPENDENCY_MANIFESTS)))
+    with deploy_lock(app):
+        echo("-------> rolling back '{}' to release '{}'".format(app, rev), fg="green")
+        swap_symlink(release, app_path)
+        write_release_activated(app, basename(release))
+        write_deployinfo(app, {"revision": rev, "deployed": utcnow(), "stopped": 0})
+        zero_downtime = get_app_config(app).get("ZERO_DOWNTIME") is True
+        if not zero_downtime:
+            cleanup_uwsgi_enabled_ini(app)
+        spawn_app(app, zero_downtime=zero_downtime)
+        add_deploy_history(app, {"revision": rev, "outcome": "rollback"})
+
+
+@cli.command("deploys")
+@click.argument('app')
+@click.option("-n", "--limit", type=int, default=20, help="Number of deploys to show")
+def cmd_deploys(app, limit=20):
+    """Show deploy history and phase timings: [<app>]"""
+    check_app(app)
+    app = sanitize_app_name(app)
+    history = read_deploy_history(app, limit)
+    print_title("Deploys", app=app)
+    if not history:
+        print("No deploys recorded for app '{}'.".format(app))
+        return
+    for item in history:
+        duration = item.get("duration")
+        echo("{:<28} {:<14} {:<10} {}".format(str(item.get("created")), (item.get("revision") or "-")[:12],
+                                              item.get("outcome") or "-",
+                                              "{:.2f}s".format(duration) if duration is not None else "-"))
+
+    # percentiles of successful deploys only, failures stop half way
+    timings = {}
+    for item in history:
+        if item.get("outcome") != "deployed" or "phases" not in item:
+            continue
+        timings.setdefault("total", []).append(item.get("duration") or 0)
+        for name, duration in item["phases"].items():
+            timings.setdefault(name, []).append(duration)
+    if timings:
+        print(" ")
+        echo("{:<20} {:>9} {:>9} {:>9} {:>6}".format("phase", "p50", "p90", "p99", "runs"), fg="green")
+        for name, values in sorted(timings.items(), key=lambda kv: kv[0] == "total"):
+            echo("{:<20} {:>8.2f}s {:>8.2f}s {:>8.2f}s {:>6}".format(
+                name, percentile(values, 50), percentile(values, 90), percentile(values, 99), len(values)))
+
+
 @cli.command("reset-ssl")
 @click.argument('app')
 def cmd_reload(app):
@@ -1415,10 +3777,37 @@ def cmd_version():
     echo("%s v.%s" % (NAME, VERSION), fg="green")
 
 
+@cli.command("x:startup")
+@click.option("--budget", type=float, default=STARTUP_IMPORT_BUDGET, help="Import time budget in ms")
+def cmd_startup(budget):
+    """ Check the import time of the git paths against a budget """
+    # 'git-upload-pack' without an app goes through the git dispatch and does nothing
+    output = check_output([sys.executable, "-X", "importtime", BOX_SCRIPT, "git-upload-pack"],
+                          stdin=DEVNULL, stderr=STDOUT).decode("utf8")
+    imports = []
+    for line in output.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            imports.append((match.group(3), int(match.group(1)) / 1000, not match.group(2)))
+    total = sum(ms for _, ms, top in imports if top)
+    loaded = sorted({name for name, _, _ in imports if name.split(".")[0] in STARTUP_LAZY_MODULES})
+
+    print_title("Startup")
+    for name, ms in sorted(((name, ms) for name, ms, top in imports if top), key=lambda i: -i[1])[:8]:
+        echo("         {:<30} {:>7.2f}ms".format(name, ms))
+    echo("-------> imports: {:.2f}ms (budget {:.0f}ms)".format(total, budget), fg="green" if total <= budget else "red")
+    if loaded:
+        echo("-------> should be imported lazily: {}".format(", ".join(loaded)), fg="red")
+    if total > budget or loaded:
+        exit(1)
+
+
 @cli.command("x:update")
 @click.argument('branch',required=False, default="master")
 def cmd_update(branch):
     """ Update Sailor to the latest from Github. x:update $branch """
+    import urllib.request
+    from tempfile import NamedTemporaryFile
     print_title("Updating Sailor...")
     url = "https://raw.githubusercontent.com/mardix/sailor/%s/sailor.py" % branch
     echo("...downloading: 'sailor.py' - on branch: %s " % branch)
@@ -1437,6 +3826,8 @@ def cmd_update(branch):
 @click.argument('public_key_file')
 def cmd_setup_ssh(public_key_file):
     """Set up a new SSH key (use - for stdin)"""
+    from tempfile import NamedTemporaryFile
+    from traceback import format_exc
 
     def add_helper(key_file):
         if exists(key_file):
@@ -1457,122 +3848,474 @@ def cmd_setup_ssh(public_key_file):
             echo("Error: public key file '{}' not found.".format(key_file), fg='red')
 
     add_helper(public_key_file)
-    
-# --- Internal commands ---
 
 
-def cmd_init():
-    """Initialize Sailor for 1st time"""
-
-    print_title()
-    echo("-------> running in Python {}".format(".".join(map(str, version_info))))
+@cli.command("autoscale")
+@click.argument('app')
+@click.option("-n", "--limit", type=int, default=20, help="Number of decisions to show")
+def cmd_autoscale(app, limit=20):
+    """Show the decisions of the autoscaler: [<app>]"""
+    check_app(app)
+    app = sanitize_app_name(app)
+    print_title("Autoscale", app=app)
+    for kind in parse_app_processes(app):
+        policy = get_process_autoscale(app, kind)
+        if policy:
+            print("{}: {}".format(kind, ", ".join("{}={}".format(k, v) for k, v in policy.items())))
+    decisions = read_autoscale_decisions(app, limit)
+    if not decisions:
+        print("No autoscale decisions recorded for app '{}'.".format(app))
+        return
+    print(" ")
+    for item in decisions:
+        signals = item.get("signals") or {}
+        echo("{:<28} {:<8} {:<8} {:>3} -> {:<3} {:>9} {:>5} {:>5}  {}".format(
+            str(item.get("created")), item.get("kind"), item.get("action"), item.get("workers"), item.get("target"),
+            "-" if signals.get("latency") is None else "%sms" % signals["latency"],
+            signals.get("backlog", "-"), "%s%%" % signals.get("busy", "-"), item.get("reason")),
+            fg="yellow" if item.get("action") == "blocked" else None)
+
+
+def _format_metric(value, fmt, empty="-"):
+    return empty if value is None else fmt.format(value)
+
+
+def render_top(apps):
+    """ The lines of 'top': the latest rates of each process with a metrics history """
+    now = time()
+    lines = ["{:<20} {:<8} {:>7} {:>6} {:>8} {:>9} {:>6} {:>7} {:>11} {:>6} {:>5}".format(
+        "APP", "PROC", "WORKERS", "PROCS", "REQ/S", "AVG", "BUSY", "BACKLOG", "RSS", "CPU", "AGE")]
+    for app in apps:
+        for kind in list_series(app):
+            # the last two records give the current rates
+            rows = series_rates(read_series(app, kind, last=2))
+            if not rows:
+                continue
+            row = rows[-1]
+            age = now - row["time"]
+            lines.append("{:<20} {:<8} {:>7} {:>6} {:>8} {:>9} {:>6} {:>7} {:>11} {:>6} {:>5}".format(
+                app[:20], kind[:8], row["workers"], row["processes"], _format_metric(row["rps"], "{:.1f}"),
+                _format_metric(row["latency"], "{:.1f}ms"), "{:.0f}%".format(row["busy"]), row["backlog"],
+                human_size(row["rss"]), _format_metric(row["cpu"], "{:.0f}%"),
+                # the process stopped, or the sampler did
+                "{:.0f}s".format(age) if age < 3 * SAMPLE_INTERVAL else "stale"))
+    if len(lines) == 1:
+        lines.append("No metrics recorded, is 'x:sampler' running?")
+    return lines
+
+
+@cli.command("top")
+@click.argument('app', required=False)
+@click.option("-n", "--interval", type=float, default=5, help="Seconds between refreshes")
+@click.option("--once", is_flag=True, default=False, help="Print once and exit")
+def cmd_top(app=None, interval=5, once=False):
+    """Live metrics of the apps: *[<app>]"""
+    if app:
+        check_app(app)
+    apps = [sanitize_app_name(app)] if app else list_apps()
+    while True:
+        lines = render_top(apps)
+        if not once and stdout.isatty():
+            click.clear()
+        print("Sailor top - {} (sampled every {}s)".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), SAMPLE_INTERVAL))
+        print("\n".join(lines))
+        if once:
+            return
+        try:
+            sleep(interval)
+        except KeyboardInterrupt:
+            return
 
-    # Create required paths
-    for p in [APP_ROOT, GIT_ROOT, ACME_WWW, ENV_ROOT, UWSGI_ROOT, 
-                UWSGI_AVAILABLE, UWSGI_ENABLED, LOG_ROOT, 
-                SETTINGS_ROOT, NGINX_ROOT, METRICS_ROOT]:
-        if not exists(p):
-            echo("Creating '{}'.".format(p), fg='green')
-            makedirs(p)
 
-    # Set up the uWSGI emperor config
-    settings = [
-        ('chdir',           UWSGI_ROOT),
-        ('emperor',         UWSGI_ENABLED),
-        ('log-maxsize',     UWSGI_LOG_MAXSIZE),
-        ('logto',           join(UWSGI_ROOT, 'uwsgi.log')),
-        ('log-backupname',  join(UWSGI_ROOT, 'uwsgi.old.log')),
-        ('socket',          join(UWSGI_ROOT, 'uwsgi.sock')),
-        ('uid',             getpwuid(getuid()).pw_name),
-        ('gid',             getgrgid(getgid()).gr_name),
-        ('enable-threads',  'true'),
-        ('threads',         '{}'.format(cpu_count() * 2)),
-    ]
-    with open(join(UWSGI_ROOT, 'uwsgi.ini'), 'w') as h:
-        h.write('[uwsgi]\n')
-        for k, v in settings:
-            h.write("{k:s} = {v}\n".format(**locals()))
+@cli.command("metrics")
+@click.argument('app')
+@click.argument('process', required=False)
+@click.option("--since", default="1h", help="History to show, ie: 30m, 1h, 2d")
+@click.option("-n", "--points", type=int, default=30, help="Rows to show per process, samples are averaged per row")
+def cmd_metrics(app, process=None, since="1h", points=30):
+    """Metrics history: [<app>] *[<proc>] [--since 1h]"""
+    check_app(app)
+    app = sanitize_app_name(app)
+    window = parse_duration(since)
+    start = time() - window
+    width = window / max(1, points)
+    print_title("Metrics since %s" % since, app=app)
+    kinds = [process] if process else list_series(app)
+    for kind in kinds:
+        rows = series_rates(read_series(app, kind, since=start))
+        if not rows:
+            print("No metrics recorded for '{}:{}' since {}.".format(app, kind, since))
+            continue
+        buckets = defaultdict(list)
+        for row in rows:
+            buckets[int((row["time"] - start) // width)].append(row)
+        echo("{:<20} {:<8} {:>6} {:>8} {:>9} {:>6} {:>7} {:>11} {:>6}".format(
+            "TIME", "PROC", "PROCS", "REQ/S", "AVG", "BUSY", "BACKLOG", "RSS", "CPU"), fg="green")
+        for bucket in sorted(buckets):
+            items = buckets[bucket]
+
+            def mean(key):
+                values = [r[key] for r in items if r[key] is not None]
+                return sum(values) / len(values) if values else None
+            print("{:<20} {:<8} {:>6} {:>8} {:>9} {:>6} {:>7} {:>11} {:>6}".format(
+                datetime.fromtimestamp(items[-1]["time"]).strftime("%Y-%m-%d %H:%M:%S"), kind[:8],
+                max(r["processes"] for r in items), _format_metric(mean("rps"), "{:.1f}"),
+                _format_metric(mean("latency"), "{:.1f}ms"), "{:.0f}%".format(mean("busy")),
+                max(r["backlog"] for r in items), human_size(max(r["rss"] for r in items)),
+                _format_metric(mean("cpu"), "{:.0f}%")))
+        print(" ")
+
+
+@cli.command("stats")
+@click.argument('app')
+@click.argument('process', nargs=1, default='*')
+@click.option("--since", default="1h", help="Window to look at, ie: 30m, 1h, 2d")
+@click.option("-t", "--top", type=int, default=10, help="Number of slow URIs to show")
+@click.option("-n", "--points", type=int, default=30, help="Rows of the throughput per minute")
+def cmd_stats(app, process='*', since="1h", top=10, points=30):
+    """Request latency and status stats from the logs: [<app>] *[<proc>] [--since 1h]"""
+    check_app(app)
+    app = sanitize_app_name(app)
+    window = parse_duration(since)
+    start = time() - window
+    filenames = sorted(glob(join(LOG_ROOT, app, process + '.*.log.old'))) + sorted(glob(join(LOG_ROOT, app, process + '.*.log')))
+    stats = read_access_stats(filenames, since=start)
+    latency = stats["latency"]
+    print_title("Requests since %s" % since, app=app)
+    if not latency.count:
+        print("No requests logged for app '{}' since {}.".format(app, since))
+        return
+    minutes = stats["minutes"]
+    peak = max(minutes, key=minutes.get)
+    print("Requests: {} ({:.1f}/min, peak {}/min at {})".format(
+        latency.count, latency.count / (window / 60.0), minutes[peak], datetime.fromtimestamp(peak).strftime("%Y-%m-%d %H:%M")))
+    print("Latency:  p50 {}ms, p90 {}ms, p99 {}ms, max {}ms, avg {:.1f}ms".format(
+        *["{:.0f}".format(latency.percentile(pct)) for pct in (50, 90, 99)] + [latency.max, latency.total / latency.count]))
+    print(" ")
+    echo("{:<8} {:>10} {:>7}".format("STATUS", "REQUESTS", "SHARE"), fg="green")
+    for status, count in sorted(stats["status"].items()):
+        print("{:<8} {:>10} {:>6.1f}%".format(status, count, 100.0 * count / latency.count))
 
-    # mark this script as executable (in case we were invoked via interpreter)
-    if not(stat(BOX_SCRIPT).st_mode & S_IXUSR):
-        echo("Setting '{}' as executable.".format(BOX_SCRIPT))
-        chmod(BOX_SCRIPT, stat(BOX_SCRIPT).st_mode | S_IXUSR)
+    # throughput per minute, summed into at most 'points' rows
+    print(" ")
+    width = max(60, -(-int(window // max(1, points)) // 60) * 60)
+    origin = int(start // 60) * 60
+    rows = defaultdict(int)
+    for minute, count in minutes.items():
+        rows[int((minute - origin) // width)] += count
+    echo("{:<20} {:>10}".format("TIME", "REQ/MIN"), fg="green")
+    for row in sorted(rows):
+        print("{:<20} {:>10.1f}".format(datetime.fromtimestamp(origin + row * width).strftime("%Y-%m-%d %H:%M"),
+                                        rows[row] / (width / 60.0)))
 
-    # ACME
-    install_acme_sh()
+    print(" ")
+    echo("{:<50} {:>9} {:>9} {:>9}".format("SLOWEST URIS", "REQUESTS", "AVG", "MAX"), fg="green")
+    slowest = sorted(stats["uris"].items(), key=lambda kv: kv[1][1] / kv[1][0], reverse=True)[:top]
+    for uri, (count, total, longest) in slowest:
+        print("{:<50} {:>9} {:>7.1f}ms {:>7}ms".format(uri[:50], count, total / count, longest))
+
+
+@cli.command("x:agent")
+def cmd_agent():
+    """ Run the resident agent serving CLI requests """
+    run_agent()
+
+@cli.command("x:autoscale")
+@click.option("-i", "--interval", type=int, default=AUTOSCALE_INTERVAL, help="Seconds between samples")
+@click.option("--once", is_flag=True, default=False, help="Sample and scale once, then exit")
+@click.option("--dry-run", is_flag=True, default=False, help="Show the decisions without scaling")
+def cmd_x_autoscale(interval, once, dry_run):
+    """ Run the autoscaler applying the 'autoscale' policies """
+    run_autoscaler(interval, once=once, dry_run=dry_run)
+
+@cli.command("x:sampler")
+@click.option("-i", "--interval", type=int, default=SAMPLE_INTERVAL, help="Seconds between samples")
+@click.option("--once", is_flag=True, default=False, help="Sample once, then exit")
+def cmd_x_sampler(interval, once):
+    """ Run the sampler recording the metrics history of the apps """
+    run_sampler(interval, once=once)
+
+@cli.command("x:exporter")
+@click.option("-b", "--bind", default=EXPORTER_BIND, help="Address to listen on")
+@click.option("-p", "--port", type=int, default=EXPORTER_PORT, help="Port to listen on")
+@click.option("--once", is_flag=True, default=False, help="Print the metrics and exit")
+def cmd_x_exporter(bind, port, once):
+    """ Serve the metrics of all the apps for Prometheus on /metrics """
+    if once:
+        stdout.write(render_exporter_metrics())
+        return
+    run_exporter(bind, port)
 
+# --- Agent ---
 
+class _AgentStream(object):
+    """ Output of an agent request, sent to the client as JSON lines """
 
-def cmd_git_hook(app):
-    """INTERNAL: Post-receive git hook"""
+    def __init__(self, conn):
+        self.conn = conn
 
-    app = sanitize_app_name(app)
-    repo_path = join(GIT_ROOT, app)
-    app_path = join(APP_ROOT, app)
+    def send(self, message):
+        try:
+            self.conn.sendall((json.dumps(message) + "\n").encode("utf8"))
+        except OSError:
+            # the client went away, the command still runs to the end
+            pass
 
-    for line in stdin:
-        oldrev, newrev, refname = line.strip().split(" ")
-        if not exists(app_path):
-            write_deployinfo(app, {"created": utcnow()})
-            echo("-------> Creating app '{}'".format(app), fg='green')
-            makedirs(app_path)
-            call('git clone --quiet {} {}'.format(repo_path, app), cwd=APP_ROOT, shell=True)
+    def write(self, data):
+        if data:
+            self.send({"out": data})
+        return len(data)
 
-        deploy_app(app, newrev=newrev, release=True)
+    def flush(self):
+        pass
 
+    def isatty(self):
+        return False
 
-def cmd_git_receive_pack(app):
-    """INTERNAL: Handle git pushes for an app"""
 
-    app = sanitize_app_name(app)
-    app_dir = join(GIT_ROOT, app)
-    hook_path = join(app_dir, 'hooks', 'post-receive')
-    env = globals()
-    env.update(locals())
+def _serve_agent_request(conn):
+    stream = _AgentStream(conn)
+    sys.stdout.local.buffer = sys.stderr.local.buffer = stream
+    code = 0
+    try:
+        request = json.loads(conn.makefile(encoding="utf8").readline())
+        if not request["argv"] or request["argv"][0] not in AGENT_COMMANDS:
+            # closed without a reply, the client runs the command itself
+            code = None
+            return
+        try:
+            code = cli.main(args=request["argv"], prog_name="sailor", standalone_mode=False, color=request.get("color")) or 0
+        finally:
+            reload_nginx()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except click.ClickException as e:
+        e.show(file=stream)
+        code = e.exit_code
+    except click.Abort:
+        code = 1
+    except Exception:
+        from traceback import format_exc
+        echo(format_exc(), fg="red")
+        code = 1
+    finally:
+        sys.stdout.local.buffer = sys.stderr.local.buffer = None
+        if code is not None:
+            stream.send({"exit": code})
+        conn.close()
+
+
+def run_agent():
+    """
+    Serve CLI requests on AGENT_SOCKET, keeping the parsed configs and the
+    state store connections between commands. Exits when sailor.py changes,
+    to be restarted by its supervisor
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if agent_running():
+        _error("ERROR: an agent is already running on '%s'" % AGENT_SOCKET)
+    if exists(AGENT_SOCKET):
+        unlink(AGENT_SOCKET)
+    server = socket(AF_UNIX, SOCK_STREAM)
+    server.bind(AGENT_SOCKET)
+    chmod(AGENT_SOCKET, S_IRUSR | S_IWUSR)
+    server.listen(32)
+    script_mtime = getmtime(BOX_SCRIPT)
+    # stopped by the supervisor: clean up the socket
+    signal(SIGTERM, lambda *args: exit(0))
+    sys.stdout, sys.stderr = _ThreadOutput(sys.stdout), _ThreadOutput(sys.stderr)
+    echo("-------> agent listening on '{}' (pid {})".format(AGENT_SOCKET, getpid()), fg="green")
+    try:
+        with ThreadPoolExecutor(max_workers=(cpu_count() or 1) * 2) as pool:
+            while True:
+                conn, _ = server.accept()
+                if getmtime(BOX_SCRIPT) != script_mtime:
+                    # closed without a reply, the client runs the command itself
+                    conn.close()
+                    echo("-------> '{}' changed, stopping".format(BOX_SCRIPT))
+                    break
+                pool.submit(_serve_agent_request, conn)
+    finally:
+        server.close()
+        if exists(AGENT_SOCKET):
+            unlink(AGENT_SOCKET)
+
+
+# --- Exporter ---
+
+# state store -> (signature, metrics), dir -> ((mtime_ns, size), names). The metrics-dir files
+# are re-read every time: uWSGI updates them in place through mmap, their mtime can stay put
+_EXPORTER_STATE = {}
+_EXPORTER_DIRS = {}
+
+
+def _exporter_cached(cache, path, read):
+    """ read(path), cached until the path changes. None when it doesn't exist """
+    try:
+        st = stat(path)
+    except OSError:
+        cache.pop(path, None)
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = cache.get(path)
+    if cached is None or cached[0] != key:
+        cached = cache[path] = (key, read(path))
+    return cached[1]
+
+
+def _read_metric_file(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip("\x00 \n").split("\n")[0])
+    except (OSError, ValueError):
+        return None
+
+
+def uwsgi_metric_name(name):
+    """ A uWSGI metric as a Prometheus name and labels: worker.1.core.0.requests -> sailor_uwsgi_worker_core_requests {worker: 1, core: 0} """
+    parts, labels = [], {}
+    for part in name.split("."):
+        if part.isdigit() and parts:
+            labels[parts[-1]] = part
+        else:
+            parts.append(re.sub(r"[^a-zA-Z0-9_]", "_", part))
+    return "sailor_uwsgi_" + "_".join(parts), labels
 
-    if not exists(hook_path):
-        makedirs(app_dir)
-        # Initialize the repository with a hook to this script
-        call("git init --quiet --bare " + app, cwd=GIT_ROOT, shell=True)
-        with open(hook_path, 'w') as h:
-            h.write("""#!/usr/bin/env bash
-set -e; set -o pipefail;
-cat | BOX_ROOT="{BOX_ROOT:s}" {BOX_SCRIPT:s} git-hook {app:s}""".format(**env))
-        # Make the hook executable by our user
-        chmod(hook_path, stat(hook_path).st_mode | S_IXUSR)
 
-    call('git-shell -c "{}" '.format(argv[1] + " '{}'".format(app)), cwd=GIT_ROOT, shell=True)
+class _MetricFamilies(object):
+    """ Samples grouped by metric, rendered in the Prometheus text format """
 
+    def __init__(self):
+        self.families = {}
 
-def cmd_git_upload_pack(app):
-    """INTERNAL: Handle git upload pack for an app"""
-    app = sanitize_app_name(app)
-    env = globals()
-    env.update(locals())
-    # Handle the actual receive. Will be called with 'git-hook' after it happens
-    call('git-shell -c "{}" '.format(argv[1] + " '{}'".format(app)), cwd=GIT_ROOT, shell=True)
+    def add(self, name, kind, help, value, labels):
+        if value is None or value != value:
+            return
+        self.families.setdefault(name, (kind, help, []))[2].append((dict(labels), value))
+
+    def render(self):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        lines = []
+        for name, (kind, help, samples) in self.families.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                # summaries are sent as their _sum and _count
+                suffix = labels.get("_suffix", "")
+                rendered = ",".join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()) if k != "_suffix")
+                lines.append("%s%s%s %s" % (name, suffix, "{%s}" % rendered if rendered else "", repr(float(value)) if isinstance(value, float) else value))
+        return "\n".join(lines) + "\n"
+
+
+def _exporter_state_metrics():
+    """ The metrics kept in the state store, as (name, kind, help, value, labels) """
+    db = state_db()
+    metrics = []
+    workers = {(app, key.lower()): int(value) for app, key, value in
+               db.execute("SELECT app, key, value FROM settings WHERE section = 'SCALING' ORDER BY rowid")}
+    for (app, kind), count in sorted(workers.items()):
+        metrics.append(("sailor_workers", "gauge", "Workers configured per process", count, {"app": app, "process": kind}))
+    for app, outcome, count, duration, timed in db.execute(
+            "SELECT app, outcome, COUNT(*), SUM(json_extract(data, '$.duration')), COUNT(json_extract(data, '$.duration')) "
+            "FROM deploys GROUP BY app, outcome"):
+        labels = {"app": app, "outcome": outcome or "unknown"}
+        metrics.append(("sailor_deploys_total", "counter", "Deploys by outcome", count, labels))
+        metrics.append(("sailor_deploy_duration_seconds", "summary", "Duration of the timed deploys",
+                        float(duration or 0), dict(labels, _suffix="_sum")))
+        metrics.append(("sailor_deploy_duration_seconds", "summary", "Duration of the timed deploys",
+                        timed, dict(labels, _suffix="_count")))
+    for app, kind, action, count in db.execute("SELECT app, kind, action, COUNT(*) FROM autoscale GROUP BY app, kind, action"):
+        metrics.append(("sailor_autoscale_decisions", "gauge", "Autoscaler decisions kept in the log",
+                        count, {"app": app, "process": kind, "action": action}))
+    count, duration, last = db.execute("SELECT COUNT(*), SUM(duration), MAX(requested) FROM nginx_reloads").fetchone()
+    metrics.append(("sailor_nginx_reloads_total", "counter", "nginx reloads requested", count, {}))
+    metrics.append(("sailor_nginx_reload_duration_seconds", "summary", "Time spent validating and requesting nginx reloads",
+                    float(duration or 0), {"_suffix": "_sum"}))
+    metrics.append(("sailor_nginx_reload_duration_seconds", "summary", "Time spent validating and requesting nginx reloads",
+                    count, {"_suffix": "_count"}))
+    metrics.append(("sailor_nginx_last_reload_timestamp_seconds", "gauge", "Time of the last nginx reload", last, {}))
+    return metrics
 
 
-def main():
-    _argvs = sys.argv
-    script_name = sys.argv[0].split('/')[-1]
+def render_exporter_metrics():
+    """
+    The metrics of all the apps in the Prometheus text format: their uWSGI metrics-dir,
+    the latest sample of each process, and what the state store knows (workers, deploys, nginx reloads).
+    Directory listings and the state store are only read again when they change
+    """
+    families = _MetricFamilies()
+    ticks = sysconf("SC_CLK_TCK")
+    for app in list_apps():
+        app_dir = join(METRICS_ROOT, app)
+        for worker in _exporter_cached(_EXPORTER_DIRS, app_dir, listdir) or []:
+            match = re.match(r"^(.+)\.(\d+)$", worker)
+            metrics_dir = join(app_dir, worker)
+            if not match:
+                continue
+            for name in _exporter_cached(_EXPORTER_DIRS, metrics_dir, lambda path: listdir(path) if isdir(path) else []) or []:
+                value = _read_metric_file(join(metrics_dir, name))
+                metric, uwsgi_labels = uwsgi_metric_name(name)
+                labels = {"app": app, "process": match.group(1), "ordinal": match.group(2)}
+                # worker.1.app.0.requests: uWSGI's own labels don't replace ours
+                labels.update(("uwsgi_" + k if k in labels else k, v) for k, v in uwsgi_labels.items())
+                families.add(metric, "untyped", "uWSGI metric %s" % re.sub(r"\.\d+(?=\.|$)", ".N", name), value, labels)
+        for kind in list_series(app):
+            last = read_series(app, kind, last=1)
+            if not last:
+                continue
+            record, labels = last[0], {"app": app, "process": kind}
+            families.add("sailor_process_requests_total", "counter", "Requests served", record["requests"], labels)
+            families.add("sailor_process_transmitted_bytes_total", "counter", "Bytes sent", record["tx"], labels)
+            families.add("sailor_process_cpu_seconds_total", "counter", "CPU time of the uWSGI processes", record["cpu"] / ticks, labels)
+            families.add("sailor_process_resident_memory_bytes", "gauge", "RSS of the uWSGI processes", record["rss"], labels)
+            families.add("sailor_process_latency_seconds", "gauge", "Average response time", record["latency"] / 1000.0, labels)
+            families.add("sailor_process_busy_ratio", "gauge", "Share of the uWSGI processes serving a request", record["busy"] / 100.0, labels)
+            families.add("sailor_process_listen_queue", "gauge", "Requests waiting in the listen queues", record["backlog"], labels)
+            families.add("sailor_process_uwsgi_processes", "gauge", "uWSGI processes running (not cheap)", record["processes"], labels)
+            families.add("sailor_process_sample_timestamp_seconds", "gauge", "Time of the latest sample", record["time"], labels)
+    # the WAL takes the writes, the db file changes on checkpoints
+    def signature(path):
+        try:
+            st = stat(path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+    key = (signature(STATE_DB_FILE + "-wal"), signature(STATE_DB_FILE))
+    cached = _EXPORTER_STATE.get(STATE_DB_FILE)
+    if cached is None or cached[0] != key:
+        cached = _EXPORTER_STATE[STATE_DB_FILE] = (key, _exporter_state_metrics())
+    for name, kind, help, value, labels in cached[1]:
+        families.add(name, kind, help, value, labels)
+    return families.render()
+
+
+def run_exporter(bind=EXPORTER_BIND, port=EXPORTER_PORT):
+    """ Serve render_exporter_metrics() on http://bind:port/metrics """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_exporter_metrics().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
 
-    # Internal GIT command
-    if _argvs and len(_argvs) >= 2 and _argvs[1] in ["init", "git-hook", "git-upload-pack", "git-receive-pack"]:
-        cmd = sys.argv[1]
-
-        if cmd == "init":
-            cmd_init()
-        elif len(_argvs) >= 3:
-            app = sys.argv[2]
-            if cmd == "git-hook":
-                cmd_git_hook(app)
-            elif cmd == "git-upload-pack":
-                cmd_git_upload_pack(app)
-            elif cmd == "git-receive-pack":
-                cmd_git_receive_pack(app)
-    else:
-        cli()
+    signal(SIGTERM, lambda *args: exit(0))
+    server = ThreadingHTTPServer((bind, port), Handler)
+    echo("-------> exporter listening on http://{}:{}/metrics (pid {})".format(bind, port, getpid()), fg="green")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == "__main__":
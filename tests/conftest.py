@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# sailor.py derives its paths from HOME when it is imported, keep them out of the real one
+os.environ["HOME"] = tempfile.mkdtemp(prefix="sailor-tests-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sailor  # noqa: E402
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """ A fresh state store, and the lock files next to it """
+    monkeypatch.setattr(sailor, "STATE_DB_FILE", str(tmp_path / "state.db"))
+    monkeypatch.setattr(sailor, "LOCK_ROOT", str(tmp_path / "locks"))
+    sailor._STATE_DB.db = None
+    yield sailor
+    if getattr(sailor._STATE_DB, "db", None) is not None:
+        sailor._STATE_DB.db.close()
+    sailor._STATE_DB.db = None
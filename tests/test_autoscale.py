@@ -0,0 +1,28 @@
+import pytest
+
+import sailor
+
+POLICY = {"min": 2, "max": 6, "step": 2, "cooldown": 60, "latency": 200, "backlog": 10, "busy": None}
+
+
+@pytest.mark.parametrize("workers, signals, expected", [
+    (1, {}, ("up", 2)),
+    (8, {}, ("down", 6)),
+    (2, {"latency": 250, "backlog": 0}, ("up", 4)),
+    (5, {"latency": 10, "backlog": 12}, ("up", 6)),
+    (6, {"latency": 500}, ("blocked", 6)),
+    (4, {"latency": 150, "backlog": 0}, ("hold", 4)),
+    (4, {"latency": 50, "backlog": 1}, ("down", 2)),
+    (2, {"latency": 50, "backlog": 1}, ("hold", 2)),
+])
+def test_autoscale_decision(workers, signals, expected):
+    assert sailor.autoscale_decision(POLICY, workers, signals)[:2] == expected
+
+
+def test_autoscale_cooldown():
+    now = 10000
+    action, target, reason = sailor.autoscale_decision(POLICY, 2, {"latency": 300}, last_change=now - 10, now=now)
+    assert (action, target) == ("blocked", 2) and "cooldown (50s left)" in reason
+    # scaling back in right after a change isn't even logged
+    assert sailor.autoscale_decision(POLICY, 4, {"latency": 1}, last_change=now - 10, now=now)[0] == "hold"
+    assert sailor.autoscale_decision(POLICY, 4, {"latency": 1}, last_change=now - 60, now=now)[:2] == ("down", 2)
@@ -0,0 +1,68 @@
+import io
+import threading
+import time
+from os import makedirs
+from os.path import join
+
+import sailor
+
+
+def test_pushes_are_coalesced(state):
+    assert sailor.enqueue_deploy("app", "rev1") == 0
+    assert sailor.enqueue_deploy("app", "rev2") == 1
+    assert sailor.enqueue_deploy("app", "rev3") == 2
+    assert sailor.read_queued_deploy("app") == "rev3"
+    assert sailor.pop_queued_deploy("app") == ("rev3", 2)
+    assert sailor.pop_queued_deploy("app") is None
+    assert sailor.read_queued_deploy("app") is None
+
+
+def test_queues_are_per_app(state):
+    sailor.enqueue_deploy("one", "a")
+    sailor.enqueue_deploy("two", "b")
+    assert sailor.pop_queued_deploy("one") == ("a", 0)
+    assert sailor.read_queued_deploy("two") == "b"
+
+
+def test_queue_worker_waits_for_the_deploy_lock(state, tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "APP_ROOT", str(tmp_path / "apps"))
+    makedirs(join(sailor.APP_ROOT, "app"))
+    deployed = []
+    monkeypatch.setattr(sailor, "deploy_app", lambda app, newrev=None, release=False: deployed.append(newrev))
+    monkeypatch.setattr(sailor, "reload_nginx", lambda: None)
+
+    # another command (scale, rollback, the autoscaler) holds the app
+    holding, release = threading.Event(), threading.Event()
+
+    def hold():
+        # its own handle: the flock conflicts as between two processes
+        with open(join(sailor.LOCK_ROOT, "app.deploy"), "a") as lock:
+            sailor.flock(lock, sailor.LOCK_EX)
+            holding.set()
+            release.wait()
+
+    makedirs(sailor.LOCK_ROOT, exist_ok=True)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    holding.wait()
+    sailor.enqueue_deploy("app", "rev")
+    threading.Timer(0.3, release.set).start()
+    started = time.monotonic()
+    sailor.run_deploy_queue("app")
+    holder.join()
+
+    assert deployed == ["rev"]
+    assert time.monotonic() - started >= 0.3
+    assert sailor.read_queued_deploy("app") is None
+
+
+def test_follow_gives_up_without_a_queue_worker(state, tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "DEPLOY_FOLLOW_GRACE", 0.2)
+    monkeypatch.setattr(sailor, "stdout", io.StringIO())
+    log = tmp_path / "deploy.log"
+    log.write_text("queued\n")
+    sailor.enqueue_deploy("app", "rev")
+    started = time.monotonic()
+    sailor.follow_deploy_log("app", str(log))
+    assert time.monotonic() - started < 5
+    assert sailor.stdout.getvalue() == "queued\n"
@@ -0,0 +1,78 @@
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import StreamRequestHandler, UnixStreamServer
+
+import pytest
+
+import sailor
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(500 if self.path == "/broken" else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class UwsgiHandler(StreamRequestHandler):
+    """ Answers with the status in the PATH_INFO of the uwsgi packet, /204 -> 204 """
+    def handle(self):
+        _, size, _ = struct.unpack("<BHB", self.rfile.read(4))
+        body, variables = self.rfile.read(size), {}
+        while body:
+            (length,), body = struct.unpack("<H", body[:2]), body[2:]
+            key, body = body[:length], body[length:]
+            (length,), body = struct.unpack("<H", body[:2]), body[2:]
+            variables[key.decode()], body = body[:length].decode(), body[length:]
+        self.server.requests.append(variables)
+        self.wfile.write("HTTP/1.1 {} OK\r\n\r\n".format(variables["PATH_INFO"][1:]).encode())
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def http_backend():
+    server = serve(HTTPServer(("127.0.0.1", 0), HTTPHandler))
+    yield "127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def uwsgi_backend(tmp_path):
+    server = UnixStreamServer(str(tmp_path / "web.sock"), UwsgiHandler)
+    server.requests = []
+    serve(server)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_backend_status(http_backend):
+    assert sailor._backend_status(http_backend) == 200
+    assert sailor._backend_status(http_backend, "/broken") == 500
+
+
+def test_uwsgi_backend_status(uwsgi_backend):
+    backend = "unix:%s" % uwsgi_backend.server_address
+    assert sailor._backend_status(backend, "/204?x=1", host="example.com") == 204
+    variables = uwsgi_backend.requests[0]
+    assert variables["PATH_INFO"] == "/204" and variables["QUERY_STRING"] == "x=1"
+    assert variables["HTTP_HOST"] == "example.com"
+
+
+def test_backend_not_answering(tmp_path):
+    assert sailor._backend_status("unix:%s" % (tmp_path / "missing.sock")) is None
+    assert sailor._backend_status("127.0.0.1:1") is None
+
+
+def test_wait_for_backends(http_backend, uwsgi_backend):
+    backends = [http_backend, "unix:%s" % uwsgi_backend.server_address]
+    assert sailor.wait_for_backends(backends, timeout=1, path="/200") == {}
+    assert sailor.wait_for_backends(backends, timeout=0, path="/503") == {backends[1]: 503}
@@ -0,0 +1,27 @@
+import sailor
+
+
+def test_info_shows_live_processes_per_kind(state, monkeypatch, capsys):
+    monkeypatch.setattr(sailor, "get_app_runtime", lambda app: "python")
+    monkeypatch.setattr(sailor, "parse_app_processes", lambda app: {"web": {}, "worker": {}})
+    monkeypatch.setattr(sailor, "read_app_processes_stats", lambda app: {"web": [
+        {"workers": [{"status": "busy"}, {"status": "idle"}, {"status": "cheap"}]},
+        {"workers": [{"status": "idle"}]},
+    ]})
+    # write_settings upper-cases the kinds, the stats are keyed by the lower-case ones
+    sailor.write_settings("app", "SCALING", {"web": 2, "worker": 1})
+
+    sailor._show_info("app", enabled_files=["app"], show_metrics=False, show_envs=False)
+    out = capsys.readouterr().out
+    assert " - WEB: 2 (processes: 3/4 live, 1 busy)" in out
+    assert " - WORKER: 1\n" in out
+
+
+def test_info_without_running_workers(state, monkeypatch, capsys):
+    monkeypatch.setattr(sailor, "get_app_runtime", lambda app: "python")
+    monkeypatch.setattr(sailor, "parse_app_processes", lambda app: {"web": {}})
+    monkeypatch.setattr(sailor, "read_app_processes_stats", lambda app: 1 / 0)
+    sailor.write_settings("app", "SCALING", {"web": 2})
+
+    sailor._show_info("app", enabled_files=[], show_metrics=False, show_envs=False)
+    assert " - WEB: 2\n" in capsys.readouterr().out
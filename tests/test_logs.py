@@ -0,0 +1,61 @@
+import os
+import time
+
+import sailor
+
+from test_stats import access_line
+
+
+def write_access_log(path, start, count, step=1):
+    with open(path, "w") as h:
+        for i in range(count):
+            h.write(access_line(start + i * step, "/%d" % i))
+
+
+def test_seek_log_since_bisects_to_the_window(tmp_path):
+    log = tmp_path / "web.1.log"
+    start = int(time.time()) - 20000
+    write_access_log(log, start, 20000)
+    with open(log, "rb") as h:
+        assert sailor.seek_log_since(h, start + 15000)
+        offset = h.tell()
+        lines = h.readlines()
+    # the window starts at most a bisection block (4KB) early, never late
+    assert offset > 0
+    assert sailor.parse_access_line(lines[0].decode())[0] <= start + 15000
+    assert len(lines) < 5000 + 4096 // 60
+    assert any(sailor.parse_access_line(l.decode())[0] == start + 15000 for l in lines)
+
+
+def test_seek_log_since_small_and_undated_logs(tmp_path):
+    dated = tmp_path / "web.1.log"
+    write_access_log(dated, int(time.time()) - 10, 10)
+    with open(dated, "rb") as h:
+        assert sailor.seek_log_since(h, time.time() - 5)
+        assert h.tell() == 0
+
+    undated = tmp_path / "worker.1.log"
+    undated.write_text("".join("job %d done\n" % i for i in range(50000)))
+    with open(undated, "rb") as h:
+        assert not sailor.seek_log_since(h, time.time() - 60)
+
+
+def test_log_since_never_reads_whole_undated_logs(tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "LOG_ROOT", str(tmp_path))
+    log_dir = tmp_path / "app"
+    log_dir.mkdir()
+    (log_dir / "worker.1.log").write_text("".join("job %d done\n" % i for i in range(50000)))
+    old = log_dir / "cron.1.log"
+    old.write_text("nightly run\n")
+    os.utime(old, (0, 0))
+    write_access_log(log_dir / "web.1.log", int(time.time()) - 300, 300)
+
+    lines = list(sailor.multi_tail("app", catch_up=5, since=time.time() - 60, follow=False))
+    by_log = {}
+    for line in lines:
+        name, _, rest = line.partition(" | ")
+        by_log.setdefault(name.strip(), []).append(rest)
+    assert "cron.1" not in by_log
+    assert len(by_log["worker.1"]) == 5
+    assert by_log["worker.1"][-1] == "job 49999 done\n"
+    assert 55 <= len(by_log["web.1"]) <= 61
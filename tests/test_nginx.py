@@ -0,0 +1,71 @@
+import pytest
+
+import sailor
+
+SERVER = """server {
+  listen              [::]:443 ssl;
+  listen              [::]:443 quic%s;
+  listen              0.0.0.0:443 quic%s;
+}
+"""
+
+
+@pytest.fixture
+def confs(tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "NGINX_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def reuseport(confs):
+    """ {address: [confs with reuseport on it]} """
+    found = {}
+    for conf in sorted(confs.glob("*.conf")):
+        for _, address, flag in sailor.NGINX_QUIC_LISTEN.findall(conf.read_text()):
+            found.setdefault(address, [])
+            if flag:
+                found[address].append(conf.stem)
+    return found
+
+
+def test_reuseport_once_per_address(confs):
+    for app in ("b", "c", "d"):
+        (confs / ("%s.conf" % app)).write_text(SERVER % ("", ""))
+    # c already holds it on one address
+    (confs / "c.conf").write_text(SERVER % ("", " reuseport"))
+    sailor.balance_quic_reuseport()
+    assert reuseport(confs) == {"[::]": ["b"], "0.0.0.0": ["c"]}
+
+
+def test_reuseport_moves_when_its_app_goes(confs):
+    for app in ("b", "c"):
+        (confs / ("%s.conf" % app)).write_text(SERVER % ("", ""))
+    sailor.balance_quic_reuseport()
+    (confs / "b.conf").unlink()
+    sailor.balance_quic_reuseport()
+    assert reuseport(confs) == {"[::]": ["c"], "0.0.0.0": ["c"]}
+
+
+def test_duplicate_reuseport_is_dropped(confs):
+    for app in ("b", "c"):
+        (confs / ("%s.conf" % app)).write_text(SERVER % (" reuseport", " reuseport"))
+    sailor.balance_quic_reuseport()
+    assert reuseport(confs) == {"[::]": ["b"], "0.0.0.0": ["b"]}
+
+
+def test_rewritten_conf_keeps_its_reuseport(confs, monkeypatch):
+    monkeypatch.setattr(sailor, "_NGINX_PENDING", {"changed": None})
+    (confs / "b.conf").write_text(SERVER % (" reuseport", " reuseport"))
+    # spawn_app renders the conf without it
+    assert not sailor.write_nginx_conf("b", SERVER % ("", ""))
+    assert sailor._NGINX_PENDING["changed"] is None
+
+
+def test_probe_nginx():
+    output = ("nginx version: nginx/1.25.3 built with OpenSSL 3.0.2 configure arguments: "
+              "--with-http_ssl_module --with-http_v2_module --with-http_v3_module --with-threads")
+    capabilities = sailor.probe_nginx(output)
+    assert capabilities["version"] == "1.25.3"
+    assert capabilities["http2"] and capabilities["http2_directive"] and capabilities["http3"]
+    assert capabilities["aio_threads"] and capabilities["ssl_early_data"]
+    assert not sailor.probe_nginx("nginx version: nginx/1.18.0")["http3"]
+
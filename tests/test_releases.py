@@ -0,0 +1,63 @@
+import os
+import time
+
+import pytest
+
+import sailor
+
+
+@pytest.fixture
+def releases(state, tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "RELEASES_ROOT", str(tmp_path / "releases"))
+    root = tmp_path / "releases" / "app"
+    for name in ("aaa", "bbb", "ccc"):
+        (root / name).mkdir(parents=True)
+    return root
+
+
+def names(paths):
+    return [os.path.basename(p) for p in paths]
+
+
+def test_releases_ordered_by_activation_not_mtime(releases):
+    for name in ("ccc", "aaa", "bbb"):
+        sailor.write_release_activated("app", name)
+        time.sleep(0.01)
+    # the app touching its directory doesn't reorder the releases
+    os.utime(releases / "ccc")
+    assert names(sailor.get_releases("app")) == ["bbb", "aaa", "ccc"]
+
+    # a rollback makes a release the most recent again
+    sailor.write_release_activated("app", "ccc")
+    assert names(sailor.get_releases("app"))[0] == "ccc"
+
+
+def test_releases_before_the_state_store_fall_back_to_mtime(releases):
+    os.utime(releases / "aaa", (1000, 1000))
+    os.utime(releases / "bbb", (2000, 2000))
+    os.utime(releases / "ccc", (3000, 3000))
+    sailor.write_release_activated("app", "aaa")
+    assert names(sailor.get_releases("app")) == ["aaa", "ccc", "bbb"]
+
+
+def test_pruned_releases_are_forgotten(releases, monkeypatch, tmp_path):
+    monkeypatch.setattr(sailor, "APP_ROOT", str(tmp_path / "apps"))
+    monkeypatch.setattr(sailor, "UWSGI_ENABLED", str(tmp_path / "enabled"))
+    for name in ("aaa", "bbb", "ccc"):
+        sailor.write_release_activated("app", name)
+        time.sleep(0.01)
+    sailor.prune_releases("app", keep=1)
+    assert names(sailor.get_releases("app")) == ["ccc"]
+    assert list(sailor.read_releases_activated("app")) == ["ccc"]
+
+
+def test_dependencies_digest(releases):
+    (releases / "aaa" / "requirements.txt").write_text("flask\n")
+    (releases / "bbb" / "requirements.txt").write_text("flask\n")
+    (releases / "ccc" / "requirements.txt").write_text("flask==3.0\n")
+    digest = sailor.get_dependencies_digest
+    assert digest(str(releases / "aaa")) == digest(str(releases / "bbb"))
+    assert digest(str(releases / "aaa")) != digest(str(releases / "ccc"))
+    # a manifest moved to another name isn't the same set of dependencies
+    (releases / "bbb" / "requirements.txt").rename(releases / "bbb" / "package.json")
+    assert digest(str(releases / "aaa")) != digest(str(releases / "bbb"))
@@ -0,0 +1,58 @@
+import pytest
+
+import sailor
+
+
+def record(n, **values):
+    base = {"time": 1000.0 + 30 * n, "requests": 100 * n, "tx": 0, "cpu": 10 * n, "rss": 1 << 20,
+            "latency": 12.5, "busy": 50.0, "backlog": 0, "workers": 2, "processes": 4}
+    base.update(values)
+    return base
+
+
+@pytest.fixture
+def series(tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "SERIES_ROOT", str(tmp_path / "series"))
+    monkeypatch.setattr(sailor, "SERIES_SLOTS", 8)
+    return sailor
+
+
+def test_ring_keeps_the_last_slots(series):
+    for n in range(20):
+        sailor.append_series("app", "web", record(n))
+    records = sailor.read_series("app", "web")
+    assert [r["requests"] for r in records] == [100 * n for n in range(12, 20)]
+    assert [r["requests"] for r in sailor.read_series("app", "web", last=2)] == [1800, 1900]
+    assert [r["time"] for r in sailor.read_series("app", "web", since=1000.0 + 30 * 18)] == [1540.0, 1570.0]
+    assert sailor.list_series("app") == ["web"]
+
+
+def test_ring_starts_over_when_resized(series, monkeypatch):
+    for n in range(3):
+        sailor.append_series("app", "web", record(n))
+    monkeypatch.setattr(sailor, "SERIES_SLOTS", 16)
+    sailor.append_series("app", "web", record(3))
+    assert [r["requests"] for r in sailor.read_series("app", "web")] == [300]
+
+
+def test_missing_ring(series):
+    assert sailor.read_series("app", "web") == []
+    assert sailor.list_series("app") == []
+
+
+def test_series_rates_skip_counter_resets(monkeypatch):
+    monkeypatch.setattr(sailor, "sysconf", lambda name: 100)
+    rows = sailor.series_rates([record(0), record(1), record(2, requests=10, cpu=0)])
+    assert rows[0]["rps"] == pytest.approx(100 / 30.0)
+    assert rows[0]["cpu"] == pytest.approx(100.0 * 10 / 100 / 30)
+    assert rows[1]["rps"] is None and rows[1]["cpu"] is None
+
+
+@pytest.mark.parametrize("value, seconds", [("90", 90), ("90s", 90), ("30m", 1800), ("1.5h", 5400), ("2d", 172800)])
+def test_parse_duration(value, seconds):
+    assert sailor.parse_duration(value) == seconds
+
+
+def test_parse_duration_rejects_garbage():
+    with pytest.raises(SystemExit):
+        sailor.parse_duration("soon")
@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import sailor
+
+
+@pytest.fixture
+def legacy(state, tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "DEPLOYINFO_FILE", str(tmp_path / "DEPLOYINFO"))
+    monkeypatch.setattr(sailor, "SETTINGS_ROOT", str(tmp_path / "settings"))
+    return tmp_path
+
+
+def test_legacy_ini_files_are_migrated_once(legacy):
+    (legacy / "DEPLOYINFO").write_text("[app]\nrevision = abc\ndeployed = 2024-01-01\n")
+    (legacy / "settings" / "app").mkdir(parents=True)
+    (legacy / "settings" / "app" / "ENV").write_text("[ENV]\nPORT = 8080\n\n[CUSTOM]\nDEBUG = 1\n")
+
+    assert sailor.read_deployinfo("app") == {"revision": "abc", "deployed": "2024-01-01"}
+    assert sailor.read_settings("app", "ENV") == {"PORT": "8080"}
+    assert sailor.read_settings("app", "CUSTOM") == {"DEBUG": "1"}
+    assert (legacy / "DEPLOYINFO.migrated").exists()
+    assert not (legacy / "settings" / "app" / "ENV").exists()
+    version = sailor.state_db().execute("PRAGMA user_version").fetchone()[0]
+    assert version == sailor.STATE_DB_VERSION
+
+
+def test_older_schema_gets_the_new_tables(legacy):
+    db = sqlite3.connect(sailor.STATE_DB_FILE)
+    db.execute("CREATE TABLE deployinfo (app TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (app, key))")
+    db.execute("INSERT INTO deployinfo VALUES ('app', 'revision', 'abc')")
+    db.execute("PRAGMA user_version = 5")
+    db.commit()
+    db.close()
+    # a newer DEPLOYINFO left around isn't imported again over the state store
+    (legacy / "DEPLOYINFO").write_text("[app]\nrevision = old\n")
+
+    sailor.write_release_activated("app", "abc")
+    assert sailor.read_deployinfo("app") == {"revision": "abc"}
+    assert list(sailor.read_releases_activated("app")) == ["abc"]
+
+
+def test_deployinfo_is_merged(state):
+    sailor.write_deployinfo("app", {"revision": "abc", "web_slot": 1})
+    sailor.write_deployinfo("app", {"deployed": "now", "stopped": 0})
+    assert sailor.read_deployinfo("app") == {"revision": "abc", "web_slot": "1", "deployed": "now", "stopped": "0"}
+
+
+def test_start_keeps_ports_slot_and_releases(state, monkeypatch):
+    monkeypatch.setattr(sailor, "run_app_scripts", lambda app, name: None)
+    sailor.write_deployinfo("app", {"web_slot": 1})
+    sailor.write_port("app", "web", 101, 9000)
+    sailor.write_release_activated("app", "abc")
+    sailor.write_settings("app", "ENV", {"port": 9000})
+
+    # 'start' resets the settings only
+    sailor._delete_app("app", delete_app=False, remove_certs=False)
+    assert sailor.read_settings("app", "ENV") == {}
+    assert sailor.read_deployinfo("app") == {"web_slot": "1"}
+    assert sailor.read_ports("app") == {("web", 101): 9000}
+    assert list(sailor.read_releases_activated("app")) == ["abc"]
+
+    # 'destroy' forgets the app
+    sailor._delete_app("app")
+    assert sailor.read_deployinfo("app") == {}
+    assert sailor.read_ports("app") == {}
+    assert sailor.read_releases_activated("app") == {}
@@ -0,0 +1,59 @@
+import random
+import time
+
+import sailor
+
+
+def access_line(when, uri="/", status=200, msecs=10):
+    stamp = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(when))
+    return '127.0.0.1 - - [%s] "GET %s HTTP/1.1" %d 12 "-" "curl" %dms\n' % (stamp, uri, status, msecs)
+
+
+def test_sketch_percentiles_within_accuracy():
+    random.seed(1)
+    values = [random.lognormvariate(3, 1) for _ in range(20000)]
+    sketch = sailor._QuantileSketch(accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+    for pct in (50, 90, 99):
+        exact = sailor.percentile(values, pct)
+        assert abs(sketch.percentile(pct) - exact) <= 0.02 * exact
+    assert sketch.percentile(100) == max(values)
+    assert sketch.count == len(values)
+
+
+def test_sketch_zeros_and_empty():
+    sketch = sailor._QuantileSketch()
+    assert sketch.percentile(50) is None
+    for value in (0, 0, 0, 100):
+        sketch.add(value)
+    assert sketch.percentile(50) == 0
+    assert sketch.percentile(100) == 100
+
+
+def test_parse_access_line():
+    now = int(time.time())
+    when, method, uri, status, msecs = sailor.parse_access_line(access_line(now, "/a?b=1", 502, 37))
+    assert (when, method, uri, status, msecs) == (now, "GET", "/a?b=1", 502, 37)
+    assert sailor.parse_access_line("spawned uWSGI worker 1 (pid: 12)") is None
+
+
+def test_normalize_uri():
+    assert sailor.normalize_uri("/users/42/posts?page=2") == "/users/:id/posts"
+    assert sailor.normalize_uri("/f/0b8e4c0a-4a4f-4d5e-9d71-1b2c3d4e5f60") == "/f/:id"
+
+
+def test_access_stats_window_and_uri_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "STATS_URI_LIMIT", 100)
+    now = int(time.time())
+    log = tmp_path / "web.1.log"
+    with open(log, "w") as h:
+        h.write(access_line(now - 7200, "/old"))
+        # every URI seen twice: the limit has to hold anyway
+        for i in range(1000):
+            h.write(access_line(now - 60, "/p%d" % (i // 2), msecs=i))
+    stats = sailor.read_access_stats([str(log)], since=now - 3600)
+    assert stats["latency"].count == 1000
+    assert stats["status"] == {200: 1000}
+    assert len(stats["uris"]) <= 100
+    assert "GET /old" not in stats["uris"]
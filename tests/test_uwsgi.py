@@ -0,0 +1,40 @@
+import pytest
+
+import sailor
+
+
+def test_threads_by_default():
+    assert sailor.get_wsgi_concurrency({}) == [("plugin", "python3"), ("threads", 4)]
+    assert sailor.get_wsgi_concurrency({"UWSGI_THREADS": 8}) == [("plugin", "python3"), ("threads", 8)]
+
+
+def test_loop_engines():
+    assert sailor.get_wsgi_concurrency({"UWSGI_GEVENT": True}) == [
+        ("plugin", "python3"), ("plugin", "gevent_python3"), ("gevent", sailor.UWSGI_ASYNC_CORES),
+        ("gevent-monkey-patch", "true")]
+    settings = sailor.get_wsgi_concurrency({"UWSGI_ASYNCIO": 50})
+    assert ("plugin", "greenlet_python3") in settings
+    assert ("asyncio", 50) in settings
+    # off is the same as unset
+    assert sailor.get_wsgi_concurrency({"UWSGI_ASYNCIO": False}) == sailor.get_wsgi_concurrency({})
+
+
+@pytest.mark.parametrize("env", [
+    {"UWSGI_THREADS": 0},
+    {"UWSGI_PROCESSES": "many"},
+    {"UWSGI_GEVENT": 20000},
+    {"UWSGI_GEVENT": True, "UWSGI_ASYNCIO": True},
+    {"UWSGI_GEVENT": True, "UWSGI_THREADS": 4},
+])
+def test_invalid_concurrency_stops_the_deploy(env):
+    with pytest.raises(SystemExit):
+        sailor.get_wsgi_concurrency(env)
+
+
+def test_missing_plugins_stop_the_deploy(tmp_path, monkeypatch):
+    monkeypatch.setattr(sailor, "UWSGI_PLUGINS_DIR", str(tmp_path))
+    (tmp_path / "python3_plugin.so").touch()
+    (tmp_path / "asyncio_python3_plugin.so").touch()
+    sailor.check_uwsgi_plugins(sailor.get_wsgi_concurrency({}))
+    with pytest.raises(SystemExit):
+        sailor.check_uwsgi_plugins(sailor.get_wsgi_concurrency({"UWSGI_ASYNCIO": True}))
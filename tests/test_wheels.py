@@ -0,0 +1,21 @@
+import pytest
+
+import sailor
+
+
+@pytest.mark.parametrize("requirements, pinned", [
+    ("flask==3.0.0\nrequests===2.31.0\n", True),
+    ("# comment\n\nflask[async]==3.0.0  # web\n", True),
+    ("flask==3.0.0 ; python_version >= '3.8'\n", True),
+    ("flask==3.0.0 \\\n    --hash=sha256:abc\n", True),
+    ("flask\n", False),
+    ("flask>=3.0\n", False),
+    ("flask==3.*\n", False),
+    ("-r base.txt\n", False),
+    ("-e .\n", False),
+    ("git+https://example.com/app.git\n", False),
+])
+def test_requirements_pinned(tmp_path, requirements, pinned):
+    path = tmp_path / "requirements.txt"
+    path.write_text(requirements)
+    assert sailor.requirements_pinned(str(path)) is pinned